@@ -0,0 +1,196 @@
+﻿# assistant/admission.py
+import os
+import time
+import threading
+from collections import deque
+from typing import Optional
+
+from . import metrics
+
+"""
+Admission control for the model leg of ask(): the kiosk stays responsive when the
+upstream is slow or failing.
+
+- Budget: per-request latency budget (ASK_LATENCY_BUDGET seconds from the start of the
+  request); the model call gets what is left minus DEGRADED_RESERVE, which is kept for
+  the local fallback answer
+- CircuitBreaker: recent upstream calls (BREAKER_WINDOW seconds) -> p95 latency and error
+  rate; opens when the error rate reaches BREAKER_ERROR_RATE or the p95 exceeds the budget
+  (at least BREAKER_MIN_CALLS calls), stays open BREAKER_COOLDOWN seconds, then lets a
+  single probe call through (half-open): success closes it, failure reopens it.
+  degrade_reason() also refuses a call whose expected latency (recent p95) no longer fits
+  the remaining budget
+- ModelGate: bounded queue in front of the model, per worker: MODEL_MAX_CONCURRENCY calls
+  in flight, MODEL_QUEUE_MAX waiting; a full queue sheds the request (Shed -> "try again"
+  response), a wait longer than the budget degrades it (QueueTimeout)
+
+Degraded = the ranked local fragments instead of the model answer (views._degraded_answer).
+Only upstream-health failures count as errors (timeouts, connection errors, 429, 5xx).
+"""
+
+# ===== Config =====
+ASK_LATENCY_BUDGET = float(os.getenv("ASK_LATENCY_BUDGET", "8"))       # seconds per request
+DEGRADED_RESERVE = 0.3                                                   # seconds kept for the fallback
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", "60"))               # seconds of history
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))            # seconds open before a probe
+MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", "4"))    # per worker
+MODEL_QUEUE_MAX = int(os.getenv("MODEL_QUEUE_MAX", "8"))                # waiting, per worker
+SHED_RETRY_AFTER = 3                                                     # seconds (Retry-After)
+# ==================
+
+
+class Shed(Exception):
+    """The model queue is full: answer "try again"."""
+
+
+class QueueTimeout(Exception):
+    """No model slot within the latency budget: answer locally."""
+
+
+class Budget:
+    def __init__(self, seconds: float = ASK_LATENCY_BUDGET):
+        self.deadline = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """Seconds left for the model call (the fallback reserve excluded)."""
+        return self.deadline - time.monotonic() - DEGRADED_RESERVE
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: deque = deque()  # (monotonic end, seconds, ok)
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_started = None  # monotonic start of the half-open probe in flight
+
+    def _prune(self, now: float):
+        while self._calls and self._calls[0][0] < now - BREAKER_WINDOW:
+            self._calls.popleft()
+
+    def _p95(self) -> Optional[float]:
+        if len(self._calls) < BREAKER_MIN_CALLS:
+            return None
+        latencies = sorted(s for _t, s, _ok in self._calls)
+        return latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            self._prune(time.monotonic())
+            return self._p95()
+
+    def _open(self, now: float, why: str):
+        self.state = self.OPEN
+        self._opened_at = now
+        self._probe_started = None
+        metrics.inc("assistant_breaker_transitions_total", state=self.OPEN, reason=why)
+
+    def degrade_reason(self, budget: Budget) -> Optional[str]:
+        """None: call the model; otherwise why not ("open", "probing", "budget")."""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == self.OPEN:
+                if now - self._opened_at < BREAKER_COOLDOWN:
+                    return "open"
+                self.state = self.HALF_OPEN
+                metrics.inc("assistant_breaker_transitions_total", state=self.HALF_OPEN, reason="cooldown")
+            if self.state == self.HALF_OPEN:
+                # one probe at a time; a probe that never reported back (shed, crashed) expires
+                if self._probe_started is not None and now - self._probe_started < BREAKER_COOLDOWN:
+                    return "probing"
+                self._probe_started = now
+                return None
+            self._prune(now)
+            expected = self._p95()
+        if budget.remaining() <= 0 or (expected is not None and expected > budget.remaining()):
+            return "budget"
+        return None
+
+    def record(self, seconds: float, ok: bool):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._calls.clear()
+                if ok:
+                    self.state = self.CLOSED
+                    self._probe_started = None
+                    metrics.inc("assistant_breaker_transitions_total", state=self.CLOSED, reason="probe_ok")
+                else:
+                    self._open(now, "probe_failed")
+                    return
+            self._calls.append((now, seconds, ok))
+            self._prune(now)
+            if self.state != self.CLOSED or len(self._calls) < BREAKER_MIN_CALLS:
+                return
+            errors = sum(1 for _t, _s, good in self._calls if not good)
+            if errors / len(self._calls) >= BREAKER_ERROR_RATE:
+                self._open(now, "errors")
+            elif self._p95() > ASK_LATENCY_BUDGET:
+                self._open(now, "latency")
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._prune(time.monotonic())
+            p95 = self._p95()
+            n = len(self._calls)
+            return {
+                "state": self.state,
+                "calls": n,
+                "errors": sum(1 for _t, _s, ok in self._calls if not ok),
+                "p95_s": round(p95, 3) if p95 is not None else None,
+            }
+
+
+class ModelGate:
+    def __init__(self, slots: int = MODEL_MAX_CONCURRENCY, queue: int = MODEL_QUEUE_MAX):
+        self.slots = slots
+        self.queue = queue
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout: float):
+        """Take a slot, waiting at most `timeout` seconds. Raises Shed / QueueTimeout."""
+        with self._cond:
+            if self.active < self.slots:
+                self.active += 1
+                return
+            if self.waiting >= self.queue:
+                metrics.inc("assistant_admission_total", result="shed")
+                raise Shed()
+            self.waiting += 1
+            try:
+                end = time.monotonic() + timeout
+                while self.active >= self.slots:
+                    left = end - time.monotonic()
+                    if left <= 0:
+                        metrics.inc("assistant_admission_total", result="queue_timeout")
+                        raise QueueTimeout()
+                    self._cond.wait(left)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+
+    def acquire_nowait(self):
+        """Async callers (the upstream semaphore does the waiting): admit up to slots + queue."""
+        with self._cond:
+            if self.active >= self.slots + self.queue:
+                metrics.inc("assistant_admission_total", result="shed")
+                raise Shed()
+            self.active += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        return {"active": self.active, "waiting": self.waiting, "slots": self.slots, "queue": self.queue}
+
+
+BREAKER = CircuitBreaker()
+MODEL_GATE = ModelGate()
@@ -0,0 +1,25 @@
+﻿# assistant/apps.py
+import os
+
+from django.apps import AppConfig
+
+"""
+App start-up (ready()):
+- proxy env vars are cleared once, before any OpenAI/httpx client exists (views._client and
+  upstream._build_client are built lazily, on first use, inside the worker)
+- with ASSISTANT_WARMUP=1 (set by gunicorn.conf.py, preload_app=True) the knowledge state is
+  loaded right here, in the gunicorn master, and forked workers share it (warmup.py)
+"""
+
+PROXY_ENV = ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "http_proxy", "https_proxy", "all_proxy", "OPENAI_PROXY")
+
+
+class AssistantConfig(AppConfig):
+    name = "assistant"
+
+    def ready(self):
+        for k in PROXY_ENV:
+            os.environ.pop(k, None)
+        if os.getenv("ASSISTANT_WARMUP", "0") == "1":
+            from .warmup import warm_up
+            warm_up()
@@ -0,0 +1,127 @@
+﻿# assistant/async_views.py
+import time
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
+
+from . import metrics, views
+from .admission import BREAKER, MODEL_GATE, Budget, Shed
+from .cache import ANSWER_CACHE
+from .singleflight import MODEL_FLIGHT, FlightTimeout
+from .upstream import chat_completion, retryable
+
+"""
+Async variants of ask/ and ping/ (ask/async/, ping/async/).
+Under ASGI (kiosk_site/asgi.py) a waiting customer costs a coroutine, not a worker:
+the model call goes through upstream.chat_completion (AsyncOpenAI, shared pool,
+concurrency cap, retries); the local steps are the same as in views.py. Under WSGI these
+views still work (sync client, see upstream.py) but gain nothing over ask/.
+Identical concurrent questions share one model call (singleflight.py, same key as views.py).
+Admission as in views.py (admission.py): latency budget around the whole call (retries
+included, waiting for a coalesced call too), circuit breaker, shed when more than
+slots + queue calls are admitted.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+async def _complete(user_text: str, context: str, budget: Budget) -> str:
+    async def call():
+        MODEL_GATE.acquire_nowait()
+        t0 = time.perf_counter()
+        try:
+            # the slot is released when the upstream call has really finished (done=), which
+            # under WSGI (thread pool) can be after wait_for gave up on it
+            pending = chat_completion(
+                done=MODEL_GATE.release,
+                model=views.OPENAI_MODEL,
+                temperature=views.MODEL_TEMPERATURE,
+                messages=views._model_messages(user_text, context),
+                timeout=max(0.1, budget.remaining()),
+            )
+        except BaseException:
+            MODEL_GATE.release()
+            raise
+        try:
+            with metrics.stage("upstream"):
+                resp = await asyncio.wait_for(pending, timeout=max(0.1, budget.remaining()))
+        except Exception as e:
+            BREAKER.record(time.perf_counter() - t0, ok=not (retryable(e) or isinstance(e, asyncio.TimeoutError)))
+            metrics.inc("assistant_upstream_calls_total", outcome=type(e).__name__)
+            raise
+        BREAKER.record(time.perf_counter() - t0, ok=True)
+        metrics.inc("assistant_upstream_calls_total", outcome="ok")
+        metrics.record_usage(resp.usage)
+        return (resp.choices[0].message.content or "").strip()
+
+    return await MODEL_FLIGHT.do_async(views._flight_key(user_text, context), call, timeout=budget.remaining())
+
+
+@csrf_exempt
+async def ask_async(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "POST only"}, status=405)
+
+    budget = Budget()
+    user_text, source = views._read_message(request)
+    if not user_text:
+        return JsonResponse({"error": "empty message"}, status=400)
+
+    # tudásbázis (index) – az első betöltés blokkoló, szálon fut
+    kb = await sync_to_async(views._get_index, thread_sensitive=False)()
+    if not len(kb):
+        return JsonResponse({"answer_html": views.NO_KNOWLEDGE_HTML}, status=400)
+    sources, error = await sync_to_async(views._source_filter, thread_sensitive=False)(kb, source)
+    if error:
+        return error
+
+    answer_key = views._answer_key(kb, user_text, sources)
+    cached = await sync_to_async(ANSWER_CACHE.get, thread_sensitive=False)(answer_key)
+    if cached is not None:
+        return JsonResponse({"answer_html": cached})
+
+    answer_html, pre_context = await sync_to_async(views._local_answer, thread_sensitive=False)(kb, user_text, sources)
+    if answer_html:
+        await sync_to_async(ANSWER_CACHE.set, thread_sensitive=False)(answer_key, answer_html)
+        return JsonResponse({"answer_html": answer_html})
+
+    # ha nincs strukturált találat, mehet a modell (csak a kontextussal) – vagy a tartalék
+    reason = BREAKER.degrade_reason(budget)
+    if reason:
+        answer_html = await sync_to_async(views._degraded_answer, thread_sensitive=False)(pre_context, reason)
+        return JsonResponse({"answer_html": answer_html, "degraded": reason})
+    try:
+        answer_text = await _complete(user_text, pre_context, budget)
+    except Shed:
+        return views._shed_response()
+    except FlightTimeout:
+        answer_html = await sync_to_async(views._degraded_answer, thread_sensitive=False)(pre_context, "wait")
+        return JsonResponse({"answer_html": answer_html, "degraded": "wait"})
+    except Exception as e:
+        logger.exception("OpenAI error: %s", e)
+        answer_html = await sync_to_async(views._degraded_answer, thread_sensitive=False)(pre_context, "error")
+        return JsonResponse({"answer_html": answer_html, "degraded": "error"})
+
+    if not answer_text:
+        answer_text = views.EMPTY_ANSWER_TEXT
+    else:
+        await sync_to_async(ANSWER_CACHE.set, thread_sensitive=False)(answer_key, answer_text)
+
+    return JsonResponse({"answer_html": answer_text})
+
+
+@require_GET
+async def ping_async(request):
+    try:
+        r = await chat_completion(
+            model=views.OPENAI_MODEL,
+            messages=[{"role": "user", "content": "ping"}],
+        )
+        return JsonResponse({"ok": True, "model": views.OPENAI_MODEL, "reply": r.choices[0].message.content})
+    except Exception as e:
+        logger.exception("Ping failed: %s", e)
+        return JsonResponse({"ok": False, "model": views.OPENAI_MODEL, "error": str(e)}, status=500)
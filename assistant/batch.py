@@ -0,0 +1,105 @@
+﻿# assistant/batch.py
+import io
+import os
+import csv
+import time
+from typing import Dict, List
+
+from .ranking import Ranker, rank_batch
+from .search_index import KnowledgeIndex, catalog_fields, query_code_keys, tokenize
+
+"""
+Order-list lookup (ask/batch/, python manage.py batch_lookup): N lines in, one table out.
+
+- codes: the code keys of every line are collected first and each distinct key is looked
+  up once in the code table
+- the remaining lines are ranked together (ranking.rank_batch: one term-at-a-time pass
+  over the merged posting lists), not one ask() per line
+- no model call; a row holds only what the catalog states (name/price/code fields are
+  taken when explicitly labelled, otherwise empty; the raw row/paragraph is in "text")
+"""
+
+# ===== Config =====
+BATCH_MAX_LINES = int(os.getenv("BATCH_MAX_LINES", "1000"))
+BATCH_TOP_N = int(os.getenv("BATCH_TOP_N", "3"))     # matches per line
+BATCH_TEXT_CHARS = 200                                # snippet length in the table
+# ==================
+
+COLUMNS = ("line", "query", "match", "name", "code", "price", "source", "page", "score", "text")
+
+
+def parse_lines(text: str) -> List[str]:
+    """One query per non-empty line (pasted order list)."""
+    return [ln.strip() for ln in (text or "").splitlines() if ln.strip()]
+
+
+def _snippet(text: str) -> str:
+    return " ".join(text.split())[:BATCH_TEXT_CHARS]
+
+
+def _row(line_no: int, query: str, match: str = "none", **values) -> dict:
+    row = dict.fromkeys(COLUMNS)
+    row.update(line=line_no, query=query, match=match, **values)
+    return row
+
+
+def run(kb: KnowledgeIndex, lines: List[str], ranker: Ranker, min_overlap: int,
+        top_n: int = BATCH_TOP_N) -> List[dict]:
+    """
+    lines -> table rows (dicts with COLUMNS), in input order; up to top_n rows per line,
+    a single match="none" row when nothing qualifies.
+    """
+    keys = [query_code_keys(q) for q in lines]
+    code_hits: Dict[str, list] = {key: kb.lookup_code(key) for key in {k for ks in keys for k in ks}}
+
+    text_lines = [i for i, q in enumerate(lines) if not any(code_hits[k] for k in keys[i])]
+    ranked = rank_batch(kb, [set(tokenize(lines[i])) for i in text_lines], ranker, min_overlap, top_k=top_n)
+    by_line = dict(zip(text_lines, ranked))
+
+    rows = []
+    for i, query in enumerate(lines):
+        line_no = i + 1
+        if i not in by_line:
+            hits = [h for k in keys[i] for h in code_hits[k]][:top_n]
+            for h in hits:
+                fields = catalog_fields(h["row"])
+                rows.append(_row(line_no, query, "code", name=fields["name"], code=h["code"],
+                                 price=fields["price"], source=h["source"], page=h["page"],
+                                 text=_snippet(h["row"])))
+            continue
+        if not by_line[i]:
+            rows.append(_row(line_no, query))
+            continue
+        for score, para_id in by_line[i]:
+            text = kb.text(para_id)
+            fields = catalog_fields(text)
+            if fields["code"] and not any(ch.isdigit() for ch in fields["code"]):
+                fields["code"] = None  # "Cod" inside running text ("codul de ..."), not an article number
+            source, _, page = kb.files[kb.paragraphs.file_idx(para_id)].rsplit(".", 1)[0].rpartition("_p")
+            rows.append(_row(line_no, query, "text", name=fields["name"], code=fields["code"],
+                             price=fields["price"], source=source, page=int(page) if page.isdigit() else None,
+                             score=round(score, 3), text=_snippet(text)))
+    return rows
+
+
+def lookup(kb: KnowledgeIndex, lines: List[str], ranker: Ranker, min_overlap: int,
+           top_n: int = BATCH_TOP_N) -> dict:
+    """run() + summary, the JSON shape of ask/batch/."""
+    t0 = time.perf_counter()
+    rows = run(kb, lines, ranker, min_overlap, top_n)
+    matched = {r["line"] for r in rows if r["match"] != "none"}
+    return {
+        "lines": len(lines),
+        "matched_lines": len(matched),
+        "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1),
+        "columns": list(COLUMNS),
+        "rows": rows,
+    }
+
+
+def to_csv(rows: List[dict]) -> str:
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=COLUMNS, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+    return buf.getvalue()
@@ -0,0 +1,226 @@
+﻿# assistant/bench.py
+import sys
+import json
+import math
+import time
+import pathlib
+import resource
+import statistics
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from typing import Callable, List, Optional
+
+import httpx
+from openai import OpenAI
+from django.test import RequestFactory
+
+from . import views
+from .cache import ANSWER_CACHE, PREFILTER_CACHE
+from .singleflight import MODEL_FLIGHT
+from .fake_openai import FAKE_LATENCY, start as start_fake_openai
+
+"""
+Retrieval / end-to-end benchmark over media/knowledge_txt (python manage.py bench).
+
+Stages, each replaying the query set (bench_queries.json):
+- prefilter : views._prefilter_local_snippets (ranking + context assembly)
+- extract   : views._extract_catalog_entries on the pre_context of each query
+- ask       : views.ask() through a RequestFactory POST; the model leg goes to a local
+              fake OpenAI server (fake_openai.py) with configurable latency, so it runs offline
+
+Reported: p50/p95/p99/mean/max latency (ms), throughput (queries/s), peak RSS (MB) and
+recall@k against the labeled queries ("relevant": expected TXT pages).
+Caches are bypassed unless cached=True, so repeated iterations measure the cold path.
+"""
+
+QUERIES_PATH = pathlib.Path(__file__).with_name("bench_queries.json")
+STAGES = ("prefilter", "extract", "ask")
+
+
+def load_queries(path: pathlib.Path = QUERIES_PATH) -> List[dict]:
+    return json.loads(pathlib.Path(path).read_text(encoding="utf-8"))
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux: KiB, macOS: bytes
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def latency_stats(samples: List[float], wall: float) -> dict:
+    """samples in seconds -> ms percentiles (nearest rank) + throughput."""
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        return ordered[max(0, math.ceil(p / 100.0 * len(ordered)) - 1)]
+
+    return {
+        "n": len(samples),
+        "p50_ms": round(pct(50) * 1000, 3),
+        "p95_ms": round(pct(95) * 1000, 3),
+        "p99_ms": round(pct(99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "qps": round(len(samples) / wall, 2) if wall > 0 else 0.0,
+    }
+
+
+@contextmanager
+def caches_bypassed(bypass: bool = True):
+    saved = (PREFILTER_CACHE.enabled, ANSWER_CACHE.enabled)
+    if bypass:
+        PREFILTER_CACHE.enabled = ANSWER_CACHE.enabled = False
+    try:
+        yield
+    finally:
+        PREFILTER_CACHE.enabled, ANSWER_CACHE.enabled = saved
+
+
+def _replay(fn: Callable, items: list, iterations: int, warmup: int, concurrency: int = 1) -> dict:
+    for _ in range(warmup):
+        for item in items:
+            fn(item)
+
+    samples: List[float] = []
+
+    def timed(item):
+        t0 = time.perf_counter()
+        fn(item)
+        return time.perf_counter() - t0
+
+    t_start = time.perf_counter()
+    for _ in range(iterations):
+        if concurrency > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                samples.extend(pool.map(timed, items))
+        else:
+            samples.extend(timed(item) for item in items)
+    return latency_stats(samples, time.perf_counter() - t_start)
+
+
+# --- recall@k ----------------------------------------------------------------
+def retrieved_files(kb, query: str, k: int) -> List[str]:
+    """First k distinct TXT pages the pipeline would answer from (code index first, then ranking)."""
+    hits = views._lookup_codes(kb, query)
+    if hits:
+        names = [pathlib.Path(h["file"]).name for h in hits]
+    else:
+        names = [kb.files[kb.paragraphs.file_idx(pid)]
+                 for _score, pid in views._rank_local_snippets(kb, query, top_k=40)]
+    return list(dict.fromkeys(names))[:k]
+
+
+def recall_at_k(kb, queries: List[dict], k: int) -> dict:
+    labeled = [q for q in queries if q.get("relevant")]
+    per_query = []
+    for q in labeled:
+        relevant = set(q["relevant"])
+        found = relevant.intersection(retrieved_files(kb, q["query"], k))
+        per_query.append({"query": q["query"], "kind": q.get("kind", ""),
+                          "recall": round(len(found) / len(relevant), 3)})
+    mean = statistics.fmean(r["recall"] for r in per_query) if per_query else 0.0
+    return {"k": k, "labeled": len(labeled), "recall": round(mean, 3), "queries": per_query}
+
+
+# --- stages ------------------------------------------------------------------
+def bench_prefilter(kb, queries: List[str], iterations: int, warmup: int) -> dict:
+    return _replay(lambda q: views._prefilter_local_snippets(kb, q, top_k=40), queries, iterations, warmup)
+
+
+def bench_extract(kb, queries: List[str], iterations: int, warmup: int) -> dict:
+    contexts = [views._prefilter_local_snippets(kb, q, top_k=40) for q in queries]
+    return _replay(views._extract_catalog_entries, contexts, iterations, warmup)
+
+
+@contextmanager
+def fake_model(latency: float):
+    """Point views.client at a local fake OpenAI server for the duration of the block."""
+    server = start_fake_openai(latency=latency)
+    saved = views.client
+    views.client = OpenAI(api_key="bench", base_url=server.base_url, http_client=httpx.Client(timeout=60))
+    try:
+        yield server
+    finally:
+        views.client = saved
+        server.shutdown()
+        server.server_close()
+
+
+def bench_ask(queries: List[str], iterations: int, warmup: int, concurrency: int = 1,
+              latency: float = FAKE_LATENCY) -> dict:
+    factory = RequestFactory()
+    statuses: List[int] = []
+
+    def call(q):
+        request = factory.post("/ask/", data=json.dumps({"message": q}), content_type="application/json")
+        statuses.append(views.ask(request).status_code)
+
+    coalesced = MODEL_FLIGHT.followers + MODEL_FLIGHT.shared_followers
+    with fake_model(latency) as server:
+        out = _replay(call, queries, iterations, warmup, concurrency)
+        out["model_calls"] = server.calls
+    out["coalesced"] = MODEL_FLIGHT.followers + MODEL_FLIGHT.shared_followers - coalesced
+    out["status"] = {str(k): v for k, v in sorted(Counter(statuses).items())}
+    out["model_latency_s"] = latency
+    out["concurrency"] = concurrency
+    return out
+
+
+def run(stages=STAGES, iterations: int = 3, warmup: int = 1, k: int = 5, cached: bool = False,
+        concurrency: int = 1, latency: float = FAKE_LATENCY,
+        queries_path: Optional[pathlib.Path] = None) -> dict:
+    queries = load_queries(queries_path or QUERIES_PATH)
+    texts = [q["query"] for q in queries]
+
+    t0 = time.perf_counter()
+    kb = views._get_index()
+    report = {
+        "corpus": {"files": len(kb.files), "paragraphs": len(kb), "tokens": len(kb.postings),
+                   "codes": len(kb.codes), "version": kb.corpus_version},
+        "index_load_s": round(time.perf_counter() - t0, 3),
+        "queries": len(texts),
+        "iterations": iterations,
+        "cached": cached,
+        "stages": {},
+    }
+    with caches_bypassed(not cached):
+        if "prefilter" in stages:
+            report["stages"]["prefilter"] = bench_prefilter(kb, texts, iterations, warmup)
+        if "extract" in stages:
+            report["stages"]["extract"] = bench_extract(kb, texts, iterations, warmup)
+        if "ask" in stages:
+            report["stages"]["ask"] = bench_ask(texts, iterations, warmup, concurrency, latency)
+        report["recall"] = recall_at_k(kb, queries, k)
+    report["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    return report
+
+
+def format_report(report: dict) -> str:
+    c = report["corpus"]
+    lines = [
+        f"Corpus: {c['files']} files, {c['paragraphs']} paragraphs, {c['tokens']} tokens, "
+        f"{c['codes']} codes (version {c['version']})",
+        f"Index load: {report['index_load_s']}s | queries: {report['queries']} x {report['iterations']} "
+        f"| caches: {'on' if report['cached'] else 'bypassed'}",
+        "",
+        f"{'stage':<10} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'mean ms':>9} {'max ms':>9} {'q/s':>9}",
+    ]
+    for name, s in report["stages"].items():
+        if not s.get("n"):
+            continue
+        lines.append(f"{name:<10} {s['n']:>5} {s['p50_ms']:>9} {s['p95_ms']:>9} {s['p99_ms']:>9} "
+                     f"{s['mean_ms']:>9} {s['max_ms']:>9} {s['qps']:>9}")
+    ask = report["stages"].get("ask")
+    if ask:
+        lines.append(f"ask: model calls {ask['model_calls']} (fake latency {ask['model_latency_s']}s, "
+                     f"concurrency {ask['concurrency']}, {ask['coalesced']} coalesced), status {ask['status']}")
+
+    r = report["recall"]
+    lines += ["", f"recall@{r['k']}: {r['recall']} over {r['labeled']} labeled queries"]
+    for q in r["queries"]:
+        lines.append(f"  {q['recall']:>5}  [{q['kind']}] {q['query']}")
+    lines += ["", f"Peak RSS: {report['peak_rss_mb']} MB"]
+    return "\n".join(lines)
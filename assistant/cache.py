@@ -0,0 +1,190 @@
+﻿# assistant/cache.py
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+from . import metrics
+from .textnorm import fold
+
+"""
+Query/answer cache for the ask pipeline.
+
+Two levels, same key scheme:
+- PREFILTER_CACHE: ranked context (pre_context) for a query
+- ANSWER_CACHE:    final answer_html (local extraction or model answer)
+
+Every level is an in-process LRU with TTL, backed by an optional shared tier
+(Django cache alias "assistant": file or database/sqlite backend, see settings.CACHES)
+so all gunicorn workers benefit from each other's misses.
+
+Keys: normalized query (textnorm.fold, sorted unique tokens) +
+corpus version of the loaded index (+ whatever else the caller passes, e.g. model).
+A re-ingest changes the corpus version, so old entries are never served;
+ingest.py additionally clears the shared tier (invalidate_shared).
+"""
+
+# ===== Config =====
+PREFILTER_CACHE_SIZE = int(os.getenv("PREFILTER_CACHE_SIZE", "512"))
+PREFILTER_CACHE_TTL = int(os.getenv("PREFILTER_CACHE_TTL", "3600"))   # seconds
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))         # seconds
+SHARED_CACHE_ALIAS = "assistant"
+# ==================
+
+_FOLD_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(sorted(set(_FOLD_TOKEN_RE.findall(fold(query)))))
+
+
+def cache_key(*parts: Any) -> str:
+    raw = "\x1f".join(str(p) for p in parts)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe bounded LRU with per-entry TTL."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _shared_backend():
+    """Django cache alias "assistant" if configured, else None (no shared tier)."""
+    try:
+        from django.conf import settings
+        from django.core.cache import caches
+        if SHARED_CACHE_ALIAS not in getattr(settings, "CACHES", {}):
+            return None
+        return caches[SHARED_CACHE_ALIAS]
+    except Exception:
+        return None
+
+
+class TwoTierCache:
+    def __init__(self, name: str, maxsize: int, ttl: int):
+        self.name = name
+        self.ttl = ttl
+        self.local = LRUCache(maxsize, ttl)
+        self.enabled = True  # False: every get() misses, set() is a no-op (benchmarks)
+        self.hits_local = 0
+        self.hits_shared = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, attr: str):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+        metrics.inc("assistant_cache_lookups_total", cache=self.name, result=attr)
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        value = self.local.get(key)
+        if value is not None:
+            self._count("hits_local")
+            return value
+
+        shared = _shared_backend()
+        if shared is not None:
+            try:
+                value = shared.get(f"{self.name}:{key}")
+            except Exception:
+                value = None
+            if value is not None:
+                self.local.set(key, value)
+                self._count("hits_shared")
+                return value
+
+        self._count("misses")
+        return None
+
+    def set(self, key: str, value: Any):
+        if not self.enabled:
+            return
+        self.local.set(key, value)
+        shared = _shared_backend()
+        if shared is not None:
+            try:
+                shared.set(f"{self.name}:{key}", value, timeout=self.ttl)
+            except Exception:
+                pass
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits_local + self.hits_shared + self.misses
+        return {
+            "size": len(self.local),
+            "hits_local": self.hits_local,
+            "hits_shared": self.hits_shared,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits_local + self.hits_shared) / lookups, 3) if lookups else 0.0,
+            "shared_tier": _shared_backend() is not None,
+        }
+
+
+PREFILTER_CACHE = TwoTierCache("prefilter", PREFILTER_CACHE_SIZE, PREFILTER_CACHE_TTL)
+ANSWER_CACHE = TwoTierCache("answer", ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+
+
+def cache_stats() -> dict:
+    return {"prefilter": PREFILTER_CACHE.stats(), "answer": ANSWER_CACHE.stats()}
+
+
+def invalidate_shared() -> bool:
+    """
+    Drop everything in the shared tier (called by ingest.py after the corpus changed).
+    Works from a plain script too: Django is set up on demand.
+    """
+    try:
+        from django.conf import settings
+        if not settings.configured:
+            os.environ.setdefault("DJANGO_SETTINGS_MODULE", "kiosk_site.settings")
+            import django
+            django.setup()
+        shared = _shared_backend()
+        if shared is None:
+            return False
+        shared.clear()
+        return True
+    except Exception as e:
+        print("Shared cache not cleared:", e)
+        return False
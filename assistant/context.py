@@ -0,0 +1,146 @@
+﻿# assistant/context.py
+import os
+import logging
+import threading
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from . import minhash
+from .search_index import CATALOG_KEYWORDS, KnowledgeIndex, tokenize
+
+"""
+Model context builder: ranked fragments -> the context actually sent to the model.
+
+Between the prefilter (views._prefilter_ranked) and the completion call:
+- near-duplicates: a fragment whose MinHash sketch (minhash.py, precomputed at index
+  build) is >= CONTEXT_DUP_THRESHOLD similar to an already kept one is dropped
+  (the same table reprinted in two catalog editions / on two pages)
+- trimming: only the lines around the matched query terms (+- CONTEXT_LINES_AROUND)
+  are kept, plus the [SOURCE]/[PAGE] header and the column header lines (Cod/Preț)
+- budget: fragments are added in rank order while they fit CONTEXT_TOKEN_BUDGET tokens,
+  counted with the model's tokenizer (tiktoken); without tiktoken or its encoding files
+  an estimate (~4 characters per token) is used
+The [FILE:...] block format of the prefilter is kept. Stats (tokens before/after,
+duplicates, fragments over the budget) go to metrics and the log.
+"""
+
+logger = logging.getLogger(__name__)
+
+# ===== Config =====
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2500"))      # 0: no budget
+CONTEXT_LINES_AROUND = int(os.getenv("CONTEXT_LINES_AROUND", "1"))
+CONTEXT_DUP_THRESHOLD = float(os.getenv("CONTEXT_DUP_THRESHOLD", "0.8"))   # MinHash Jaccard estimate
+CONTEXT_ENCODING = os.getenv("CONTEXT_ENCODING", "").strip()               # empty: tiktoken's choice for the model
+FALLBACK_ENCODING = "o200k_base"
+CHARS_PER_TOKEN = 4                                                        # estimate without tiktoken
+# ==================
+
+SEPARATOR = "\n\n---\n\n"
+GAP = "…"
+
+_ENCODERS: Dict[str, object] = {}
+_ENCODERS_LOCK = threading.Lock()
+
+
+class ContextStats(NamedTuple):
+    fragments: int        # ranked fragments in
+    kept: int             # fragments sent
+    duplicates: int       # dropped as near-duplicates
+    over_budget: int      # dropped because they did not fit
+    raw_tokens: int       # tokens of the untrimmed prefilter context
+    tokens: int           # tokens sent
+    exact: bool           # counted with the model tokenizer (False: estimate)
+
+    @property
+    def saved(self) -> int:
+        return max(0, self.raw_tokens - self.tokens)
+
+
+def _encoder(model: str):
+    """tiktoken encoding for `model`, or None (no tiktoken / encoding files unavailable)."""
+    if model in _ENCODERS:
+        return _ENCODERS[model]
+    with _ENCODERS_LOCK:
+        if model not in _ENCODERS:
+            enc = None
+            try:
+                import tiktoken
+                if CONTEXT_ENCODING:
+                    enc = tiktoken.get_encoding(CONTEXT_ENCODING)
+                else:
+                    try:
+                        enc = tiktoken.encoding_for_model(model)
+                    except KeyError:  # model name tiktoken does not know yet
+                        enc = tiktoken.get_encoding(FALLBACK_ENCODING)
+            except Exception as e:
+                # ImportError, or the BPE file could not be downloaded (offline host)
+                logger.warning("tiktoken unavailable (%s: %s); context tokens are estimated", type(e).__name__, e)
+            _ENCODERS[model] = enc
+    return _ENCODERS[model]
+
+
+def count_tokens(text: str, model: str) -> int:
+    enc = _encoder(model)
+    if enc is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def trim(text: str, terms: set, around: int = CONTEXT_LINES_AROUND) -> str:
+    """
+    Lines of `text` containing a query term, +- `around` lines, plus the header line and
+    the column header lines; skipped runs become a single GAP line. No match -> text as is.
+    """
+    lines = text.splitlines()
+    hits = [i for i, ln in enumerate(lines) if terms.intersection(tokenize(ln))]
+    if not hits:
+        return text
+    keep = {0}
+    for i in hits:
+        keep.update(range(max(0, i - around), min(len(lines), i + around + 1)))
+    keep.update(i for i, ln in enumerate(lines) if len(ln) <= 40 and CATALOG_KEYWORDS.search(ln))
+
+    out, last = [], -1
+    for i in sorted(keep):
+        if i > last + 1:
+            out.append(GAP)
+        out.append(lines[i])
+        last = i
+    if last < len(lines) - 1:
+        out.append(GAP)
+    return "\n".join(out)
+
+
+def build_context(kb: KnowledgeIndex, q_tokens: Sequence[str], para_ids: Sequence[int], model: str,
+                  budget: int = CONTEXT_TOKEN_BUDGET, raw_context: Optional[str] = None):
+    """
+    para_ids: ranked fragments, best first. Returns (context, ContextStats).
+    raw_context: the untrimmed prefilter context, only for the saved-tokens figure.
+    """
+    terms = {term for group in kb.expand(q_tokens).values() for term, _w in group}
+    kept_sketches: List[Sequence[int]] = []
+    blocks: List[str] = []
+    used = duplicates = over_budget = 0
+    sep_tokens = count_tokens(SEPARATOR, model)
+
+    for pid in para_ids:
+        sk = kb.sketch(pid)
+        if any(minhash.similarity(sk, other) >= CONTEXT_DUP_THRESHOLD for other in kept_sketches):
+            duplicates += 1
+            continue
+        block = f"[FILE:{kb.file_path(pid)}]\n{trim(kb.text(pid), terms)}"
+        cost = count_tokens(block, model) + (sep_tokens if blocks else 0)
+        if budget and used + cost > budget:
+            over_budget += 1  # a shorter fragment further down may still fit
+            continue
+        blocks.append(block)
+        kept_sketches.append(sk)
+        used += cost
+
+    context = SEPARATOR.join(blocks)
+    raw = raw_context if raw_context is not None else SEPARATOR.join(
+        f"[FILE:{kb.file_path(pid)}]\n{kb.text(pid)}" for pid in para_ids)
+    stats = ContextStats(
+        fragments=len(para_ids), kept=len(blocks), duplicates=duplicates, over_budget=over_budget,
+        raw_tokens=count_tokens(raw, model), tokens=used, exact=_encoder(model) is not None,
+    )
+    return context, stats
@@ -0,0 +1,172 @@
+﻿# assistant/corpus.py
+import os
+import json
+import mmap
+import struct
+import pathlib
+from array import array
+from typing import List
+
+"""
+Packed paragraph store for the knowledge index.
+
+corpus.bin : every paragraph's UTF-8 text, back to back (one contiguous blob)
+corpus.idx : header + compact tables, read in place through memoryview casts
+    header      <4sIIII16s  magic, n_paragraphs, n_files, files_json_len, reserved, corpus_version
+    files json  [[file name, source, page], ...]      (padded to 8 bytes)
+    offsets     uint64[n_paragraphs + 1]               byte offsets into corpus.bin
+    file_first  uint64[n_files + 1]                    first paragraph id of each file
+    file_idx    uint32[n_paragraphs]
+    flags       uint8[n_paragraphs]
+
+views.py mmaps both files: gunicorn workers share the same physical pages and a paragraph
+is a zero-copy slice (raw) until it is decoded (text).
+"""
+
+MAGIC = b"KBC1"
+HEADER = struct.Struct("<4sIIII16s")
+CORPUS_BIN = "corpus.bin"
+CORPUS_IDX = "corpus.idx"
+
+
+def _pad8(n: int) -> int:
+    return (8 - n % 8) % 8
+
+
+def _source_page(name: str):
+    """'<source>_pNNN.txt' -> ('<source>', NNN)."""
+    stem = name[:-4] if name.endswith(".txt") else name
+    source, _, tag = stem.rpartition("_p")
+    return (source, int(tag)) if source and tag.isdigit() else (stem, 0)
+
+
+class ParagraphStore:
+    """In-memory paragraph table, used while (re)building the index."""
+
+    def __init__(self):
+        self.files: List[str] = []
+        self._file_first: List[int] = []  # paragraphs are added file by file
+        self._file_idx: List[int] = []
+        self._flags: List[int] = []
+        self._texts: List[str] = []
+
+    def add_file(self, name: str) -> int:
+        self.files.append(name)
+        self._file_first.append(len(self._texts))
+        return len(self.files) - 1
+
+    def add(self, file_idx: int, flags: int, text: str) -> int:
+        self._file_idx.append(file_idx)
+        self._flags.append(flags)
+        self._texts.append(text)
+        return len(self._texts) - 1
+
+    def __len__(self):
+        return len(self._texts)
+
+    def file_idx(self, para_id: int) -> int:
+        return self._file_idx[para_id]
+
+    def flags(self, para_id: int) -> int:
+        return self._flags[para_id]
+
+    def text(self, para_id: int) -> str:
+        return self._texts[para_id]
+
+    def file_paragraphs(self, file_idx: int) -> range:
+        end = self._file_first[file_idx + 1] if file_idx + 1 < len(self.files) else len(self._texts)
+        return range(self._file_first[file_idx], end)
+
+    def write(self, directory: pathlib.Path, corpus_version: str):
+        """Write corpus.bin + corpus.idx (tmp + rename each)."""
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        offsets = array("Q", [0])
+        bin_tmp = directory / (CORPUS_BIN + ".tmp")
+        with open(bin_tmp, "wb") as f:
+            for text in self._texts:
+                data = text.encode("utf-8")
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+
+        file_first = array("Q", [0] * (len(self.files) + 1))
+        counts = [0] * len(self.files)
+        for fi in self._file_idx:
+            counts[fi] += 1
+        for i, c in enumerate(counts):
+            file_first[i + 1] = file_first[i] + c
+
+        files_json = json.dumps([[n, *_source_page(n)] for n in self.files], ensure_ascii=False).encode("utf-8")
+        idx_tmp = directory / (CORPUS_IDX + ".tmp")
+        with open(idx_tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(self._texts), len(self.files), len(files_json), 0,
+                                corpus_version.encode("ascii")[:16].ljust(16, b"\0")))
+            f.write(files_json)
+            f.write(b"\0" * _pad8(HEADER.size + len(files_json)))
+            f.write(offsets.tobytes())
+            f.write(file_first.tobytes())
+            f.write(array("I", self._file_idx).tobytes())
+            f.write(array("B", self._flags).tobytes())
+
+        os.replace(bin_tmp, directory / CORPUS_BIN)
+        os.replace(idx_tmp, directory / CORPUS_IDX)
+
+
+class PackedCorpus:
+    """Read-only, mmap-backed paragraph table (same read API as ParagraphStore)."""
+
+    def __init__(self, directory: pathlib.Path):
+        directory = pathlib.Path(directory)
+        self._fh_bin = open(directory / CORPUS_BIN, "rb")
+        self._fh_idx = open(directory / CORPUS_IDX, "rb")
+        self._mm_bin = _mmap(self._fh_bin)
+        self._mm_idx = _mmap(self._fh_idx)
+
+        magic, n_paras, n_files, files_len, _reserved, version = HEADER.unpack_from(self._mm_idx, 0)
+        if magic != MAGIC:
+            raise ValueError(f"not a packed corpus: {directory / CORPUS_IDX}")
+        self.corpus_version = version.rstrip(b"\0").decode("ascii")
+
+        pos = HEADER.size
+        table = json.loads(bytes(self._mm_idx[pos:pos + files_len]).decode("utf-8"))
+        self.files = [row[0] for row in table]
+        self.sources = [(row[1], row[2]) for row in table]
+        pos += files_len + _pad8(HEADER.size + files_len)
+
+        view = memoryview(self._mm_idx)
+        self._offsets = view[pos:pos + 8 * (n_paras + 1)].cast("Q")
+        pos += 8 * (n_paras + 1)
+        self._file_first = view[pos:pos + 8 * (n_files + 1)].cast("Q")
+        pos += 8 * (n_files + 1)
+        self._file_idx = view[pos:pos + 4 * n_paras].cast("I")
+        pos += 4 * n_paras
+        self._flags = view[pos:pos + n_paras]
+        self._blob = memoryview(self._mm_bin)
+        self._n = n_paras
+
+    def __len__(self):
+        return self._n
+
+    def file_idx(self, para_id: int) -> int:
+        return self._file_idx[para_id]
+
+    def flags(self, para_id: int) -> int:
+        return self._flags[para_id]
+
+    def raw(self, para_id: int) -> memoryview:
+        """Zero-copy UTF-8 bytes of one paragraph."""
+        return self._blob[self._offsets[para_id]:self._offsets[para_id + 1]]
+
+    def text(self, para_id: int) -> str:
+        return str(self.raw(para_id), "utf-8")
+
+    def file_paragraphs(self, file_idx: int) -> range:
+        return range(self._file_first[file_idx], self._file_first[file_idx + 1])
+
+
+def _mmap(fh):
+    # üres fájlt nem lehet mmap-elni
+    if os.fstat(fh.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,210 @@
+﻿# assistant/fake_openai.py
+import os
+import json
+import time
+import random
+import argparse
+import threading
+import itertools
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Local OpenAI-compatible stand-in for offline benchmarks / development.
+
+- POST /v1/chat/completions, plain JSON or stream=true (SSE chunks + [DONE])
+- configurable latency before the first byte (+ jitter) and between stream chunks
+- counts the calls it served (bench reports how many queries reached the model)
+- Files API in memory: POST/GET /v1/files, GET/DELETE /v1/files/{id}, and
+  POST/DELETE /v1/vector_stores/{vs}/files[/{id}]; FAKE_OPENAI_FILES_FAIL_RATE answers that
+  share of uploads with 500/429 (retry tests of file_sync.py)
+
+Run:  python -m assistant.fake_openai --port 8765 --latency 0.4
+Use:  OPENAI_BASE_URL=http://127.0.0.1:8765/v1  (views.client, upstream.py)
+"""
+
+# ===== Config =====
+FAKE_LATENCY = float(os.getenv("FAKE_OPENAI_LATENCY", "0.3"))        # seconds before the answer
+FAKE_JITTER = float(os.getenv("FAKE_OPENAI_JITTER", "0.0"))          # +uniform(0, jitter)
+FAKE_CHUNK_DELAY = float(os.getenv("FAKE_OPENAI_CHUNK_DELAY", "0.02"))  # between stream chunks
+FAKE_FILES_FAIL_RATE = float(os.getenv("FAKE_OPENAI_FILES_FAIL_RATE", "0"))  # failed uploads share
+FAKE_REPLY = "Răspuns de test de la serverul local (fake OpenAI)."
+# ==================
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self):
+        return self._json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def _route(self):
+        """'/v1/files/file-1' -> ['files', 'file-1'] (query string and /v1 prefix dropped)."""
+        parts = [p for p in self.path.split("?", 1)[0].split("/") if p]
+        return parts[1:] if parts and parts[0] == "v1" else parts
+
+    def do_GET(self):
+        route, files = self._route(), self.server.files
+        if route == ["files"]:
+            return self._json(200, {"object": "list", "data": list(files.values()), "has_more": False})
+        if len(route) == 2 and route[0] == "files" and route[1] in files:
+            return self._json(200, files[route[1]])
+        return self._not_found()
+
+    def do_DELETE(self):
+        route, server = self._route(), self.server
+        if len(route) == 2 and route[0] == "files":
+            if server.files.pop(route[1], None) is None:
+                return self._not_found()
+            server.count_call("deletes")
+            return self._json(200, {"id": route[1], "object": "file", "deleted": True})
+        if len(route) == 4 and route[0] == "vector_stores" and route[2] == "files":
+            attached = server.vector_stores.setdefault(route[1], set())
+            if route[3] not in attached:
+                return self._not_found()
+            attached.discard(route[3])
+            return self._json(200, {"id": route[3], "object": "vector_store.file.deleted", "deleted": True})
+        return self._not_found()
+
+    def _upload(self, body: bytes):
+        server = self.server
+        if random.random() < server.files_fail_rate:
+            status = random.choice((429, 500))
+            return self._json(status, {"error": {"message": "injected failure", "type": "server_error"}})
+        head = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+        msg = BytesParser(policy=policy.HTTP).parsebytes(head + body)
+        fields = {part.get_param("name", header="content-disposition"): part for part in msg.iter_parts()}
+        if "file" not in fields:
+            return self._json(400, {"error": {"message": "missing file", "type": "invalid_request_error"}})
+        content = fields["file"].get_payload(decode=True) or b""
+        purpose = fields["purpose"].get_payload(decode=True).decode() if "purpose" in fields else ""
+        file_id = f"file-fake{next(server.ids)}"
+        server.files[file_id] = {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                                 "filename": fields["file"].get_filename(), "purpose": purpose, "status": "processed"}
+        server.count_call("uploads")
+        return self._json(200, server.files[file_id])
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        route = self._route()
+        if route == ["files"]:
+            return self._upload(body)
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            payload = {}
+        if len(route) == 3 and route[0] == "vector_stores" and route[2] == "files":
+            if payload.get("file_id") not in self.server.files:
+                return self._not_found()
+            self.server.vector_stores.setdefault(route[1], set()).add(payload["file_id"])
+            return self._json(200, {"id": payload["file_id"], "object": "vector_store.file", "vector_store_id": route[1],
+                                    "status": "completed", "usage_bytes": 0, "created_at": int(time.time()),
+                                    "last_error": None})
+        if route != ["chat", "completions"]:
+            return self._not_found()
+
+        server = self.server
+        server.count_call()
+        time.sleep(server.latency + random.uniform(0, server.jitter))
+        model = payload.get("model") or "fake"
+
+        if not payload.get("stream"):
+            return self._json(200, {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": server.reply},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        words = server.reply.split(" ")
+        for i, word in enumerate(words):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word + (" " if i < len(words) - 1 else "")},
+                             "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(server.chunk_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency: float = FAKE_LATENCY, jitter: float = FAKE_JITTER,
+                 chunk_delay: float = FAKE_CHUNK_DELAY, reply: str = FAKE_REPLY,
+                 files_fail_rate: float = FAKE_FILES_FAIL_RATE):
+        super().__init__(address, FakeOpenAIHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.reply = reply
+        self.files_fail_rate = files_fail_rate
+        self.calls = 0
+        self.uploads = 0
+        self.deletes = 0
+        self.files = {}          # file id -> file object
+        self.vector_stores = {}  # vector store id -> {file id, ...}
+        self.ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def count_call(self, counter: str = "calls"):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def start(host: str = "127.0.0.1", port: int = 0, **kwargs) -> FakeOpenAIServer:
+    """Serve in a daemon thread (port=0: any free port). Stop with server.shutdown()."""
+    server = FakeOpenAIServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Local OpenAI-compatible stand-in.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency", type=float, default=FAKE_LATENCY)
+    ap.add_argument("--jitter", type=float, default=FAKE_JITTER)
+    ap.add_argument("--chunk-delay", type=float, default=FAKE_CHUNK_DELAY)
+    ap.add_argument("--files-fail-rate", type=float, default=FAKE_FILES_FAIL_RATE)
+    args = ap.parse_args()
+    srv = FakeOpenAIServer((args.host, args.port), latency=args.latency, jitter=args.jitter,
+                           chunk_delay=args.chunk_delay, files_fail_rate=args.files_fail_rate)
+    print(f"Fake OpenAI on {srv.base_url} (latency {args.latency}s)")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,277 @@
+﻿# assistant/file_sync.py
+import os
+import json
+import time
+import hashlib
+import logging
+import pathlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+import httpx
+from openai import NotFoundError, OpenAI
+
+from .search_index import TXT_DIR
+from .upstream import backoff, retryable
+
+"""
+Delta sync of the page TXTs (ingest output) to the OpenAI Files API and, optionally, a
+vector store (python manage.py sync_openai_files).
+
+- .openai_file_cache.json: page file name -> {file_id, sha256, size, mtime}; a page is
+  re-hashed only when its size/mtime changed and uploaded only when its sha256 changed,
+  so a run costs time proportional to what the last ingest changed
+- a new page whose content equals a file that is going away (renamed catalog) keeps
+  that file id instead of being uploaded again
+- uploads / attaches / deletes run on a bounded thread pool (SYNC_WORKERS), each call
+  retried with jittered backoff on 429 / 5xx / connection errors (upstream.py rules)
+- file ids no longer referenced are detached and deleted only after the uploads; ids that
+  could not be deleted stay in the cache ("pending_delete") for the next run
+- the cache is written atomically (tmp + os.replace), every SYNC_CHECKPOINT uploads and
+  at the end of the run even when it fails, so a paid upload is never forgotten
+- legacy cache (name -> file id, no hashes): the entries are checked once against the
+  remote file list; same size -> adopted with the local hash, otherwise uploaded again
+
+Test locally: python -m assistant.fake_openai --port 8765 (+ --files-fail-rate 0.2),
+OPENAI_BASE_URL=http://127.0.0.1:8765/v1
+"""
+
+logger = logging.getLogger(__name__)
+
+# ===== Config =====
+SYNC_CACHE_PATH = pathlib.Path(__file__).resolve().parents[1] / ".openai_file_cache.json"
+SYNC_WORKERS = int(os.getenv("OPENAI_SYNC_WORKERS", "4"))      # concurrent API calls
+SYNC_RETRIES = int(os.getenv("OPENAI_SYNC_RETRIES", "4"))      # per call, on retryable errors
+SYNC_TIMEOUT = float(os.getenv("OPENAI_SYNC_TIMEOUT", "60"))   # seconds per call
+SYNC_PURPOSE = "assistants"
+SYNC_CHECKPOINT = 50                                            # uploads between cache writes
+VECTOR_STORE_ID = os.getenv("OPENAI_VECTOR_STORE_ID", "")
+# ==================
+
+
+class SyncPlan(NamedTuple):
+    upload: List[str]                # page names: new or changed content
+    reuse: Dict[str, str]            # page name -> file id with the same content (renamed page)
+    adopt: List[str]                 # legacy entries verified against the remote file list
+    attach: List[str]                # kept file ids not yet in the vector store
+    delete: List[str]                # file ids nothing refers to any more
+    unchanged: int
+
+
+# ----------------------- cache -----------------------
+def load_cache(path: pathlib.Path = SYNC_CACHE_PATH) -> dict:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        data = {}
+    if "files" not in data:
+        # legacy layout: {page name: file id}
+        data = {"files": {name: {"file_id": fid} for name, fid in data.items() if isinstance(fid, str)}}
+    data.setdefault("vector_store_id", "")
+    data.setdefault("pending_delete", [])
+    return data
+
+
+def save_cache(cache: dict, path: pathlib.Path = SYNC_CACHE_PATH):
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(cache, ensure_ascii=False, indent=1, sort_keys=True), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+# ----------------------- local pages -----------------------
+def _sha256_file(path: pathlib.Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def local_pages(txt_dir: pathlib.Path, cached: Dict[str, dict]) -> Dict[str, dict]:
+    """page name -> {sha256, size, mtime}; the cached hash is reused while size/mtime match."""
+    out = {}
+    for path in sorted(txt_dir.glob("*.txt")):
+        st = path.stat()
+        entry = cached.get(path.name) or {}
+        if entry.get("sha256") and entry.get("size") == st.st_size and entry.get("mtime") == st.st_mtime_ns:
+            digest = entry["sha256"]
+        else:
+            digest = _sha256_file(path)
+        out[path.name] = {"sha256": digest, "size": st.st_size, "mtime": st.st_mtime_ns}
+    return out
+
+
+# ----------------------- plan -----------------------
+def plan(cache: dict, local: Dict[str, dict], remote: Optional[Dict[str, int]] = None,
+         vector_store: str = "") -> SyncPlan:
+    """
+    remote: file id -> bytes from the Files API (needed for legacy entries / --verify);
+    an id missing there counts as not uploaded.
+    """
+    cached = cache["files"]
+    upload, adopt, kept, delete = [], [], [], []
+    unchanged = 0
+    gone = {}  # sha256 -> file id of removed pages (a renamed page can take it over)
+    for name, entry in cached.items():
+        page, fid = local.get(name), entry.get("file_id")
+        if page is None:
+            if entry.get("sha256"):
+                gone.setdefault(entry["sha256"], fid)
+            delete.append(fid)
+        elif remote is not None and fid not in remote:
+            upload.append(name)
+        elif not entry.get("sha256"):
+            if remote is not None and remote[fid] == page["size"]:
+                adopt.append(name)
+                kept.append(fid)
+            else:
+                upload.append(name)
+        elif entry["sha256"] != page["sha256"]:
+            upload.append(name)  # the old id is deleted once the new upload succeeded
+        else:
+            unchanged += 1
+            kept.append(fid)
+
+    reuse = {}
+    for name in sorted(set(local) - set(cached)):
+        fid = gone.pop(local[name]["sha256"], None)
+        if fid is not None and (remote is None or fid in remote):
+            reuse[name] = fid
+            kept.append(fid)
+        else:
+            upload.append(name)
+
+    attach = kept if vector_store and vector_store != cache.get("vector_store_id") else []
+    delete = [fid for fid in dict.fromkeys(delete + cache["pending_delete"]) if fid and fid not in set(kept)]
+    return SyncPlan(sorted(upload), reuse, adopt, attach, delete, unchanged)
+
+
+# ----------------------- API calls -----------------------
+def make_client() -> OpenAI:
+    # own retry loop (_call), the SDK's is off; OPENAI_BASE_URL points it at a fake server
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=httpx.Client(timeout=SYNC_TIMEOUT),
+                  max_retries=0)
+
+
+def _call(fn: Callable, what: str):
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= SYNC_RETRIES or not retryable(e):
+                raise
+            delay = backoff(attempt, e)
+            logger.warning("%s: %s, retry %d/%d in %.2fs", what, type(e).__name__, attempt + 1, SYNC_RETRIES, delay)
+            attempt += 1
+            time.sleep(delay)
+
+
+def remote_files(client: OpenAI) -> Dict[str, int]:
+    return {f.id: f.bytes for f in _call(client.files.list, "list files")}
+
+
+def _pool(items: Iterable, fn: Callable, workers: int):
+    """(item, result, exception) as each call finishes; at most `workers` calls in flight."""
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="openai-sync") as pool:
+        futures = {pool.submit(fn, item): item for item in items}
+        for fut in as_completed(futures):
+            exc = fut.exception()
+            yield futures[fut], (None if exc else fut.result()), exc
+
+
+# ----------------------- sync -----------------------
+def sync(txt_dir: pathlib.Path = TXT_DIR, cache_path: pathlib.Path = SYNC_CACHE_PATH,
+         client: Optional[OpenAI] = None, vector_store: str = VECTOR_STORE_ID, workers: int = SYNC_WORKERS,
+         verify: bool = False, dry_run: bool = False, log: Callable[[str], None] = logger.info) -> dict:
+    """
+    Bring the Files API (and vector_store, when set) in line with the TXT pages of txt_dir.
+    verify: check every cached id against the remote file list (always done for legacy
+    entries). Returns the report: counts per action, failures, seconds.
+    """
+    t0 = time.perf_counter()
+    cache = load_cache(cache_path)
+    local = local_pages(txt_dir, cache["files"])
+    client = client or make_client()
+    need_remote = verify or any(not e.get("sha256") for e in cache["files"].values())
+    remote = remote_files(client) if need_remote else None
+    p = plan(cache, local, remote, vector_store)
+    report = {"pages": len(local), "unchanged": p.unchanged, "uploaded": 0, "reused": len(p.reuse),
+              "adopted": len(p.adopt), "attached": 0, "deleted": 0, "failed": [], "dry_run": dry_run}
+    log(f"{len(local)} pages: {len(p.upload)} to upload, {len(p.reuse)} renamed, {len(p.adopt)} legacy adopted, "
+        f"{len(p.attach)} to attach, {len(p.delete)} to delete, {p.unchanged} unchanged")
+    if dry_run:
+        report.update(to_upload=p.upload, to_delete=p.delete, seconds=round(time.perf_counter() - t0, 2))
+        return report
+
+    files = cache["files"]
+    for name in list(files):
+        if name not in local:
+            del files[name]
+    for name in p.adopt:
+        files[name] = dict(local[name], file_id=files[name]["file_id"])
+    for name, fid in p.reuse.items():
+        files[name] = dict(local[name], file_id=fid)
+    # from here on these ids are garbage, whatever happens to the uploads
+    cache["pending_delete"] = [fid for fid in p.delete if fid not in {e["file_id"] for e in files.values()}]
+
+    def upload(name: str) -> str:
+        content = (txt_dir / name).read_bytes()
+        f = _call(lambda: client.files.create(file=(name, content, "text/plain"), purpose=SYNC_PURPOSE),
+                  f"upload {name}")
+        if vector_store:
+            _call(lambda: client.beta.vector_stores.files.create(vector_store_id=vector_store, file_id=f.id),
+                  f"attach {name}")
+        return f.id
+
+    def attach(fid: str):
+        _call(lambda: client.beta.vector_stores.files.create(vector_store_id=vector_store, file_id=fid),
+              f"attach {fid}")
+
+    def delete(fid: str):
+        if vector_store:
+            try:
+                _call(lambda: client.beta.vector_stores.files.delete(fid, vector_store_id=vector_store),
+                      f"detach {fid}")
+            except NotFoundError:
+                pass
+        try:
+            _call(lambda: client.files.delete(fid), f"delete {fid}")
+        except NotFoundError:
+            pass  # already gone
+
+    try:
+        for name, fid, exc in _pool(p.upload, upload, workers):
+            if exc is not None:
+                logger.error("Upload of %s failed: %s", name, exc)
+                report["failed"].append(name)
+                continue
+            old = (files.get(name) or {}).get("file_id")
+            if old and old != fid:
+                cache["pending_delete"].append(old)
+            files[name] = dict(local[name], file_id=fid)
+            report["uploaded"] += 1
+            if report["uploaded"] % SYNC_CHECKPOINT == 0:
+                save_cache(cache, cache_path)
+                log(f"  {report['uploaded']}/{len(p.upload)} uploaded")
+
+        if vector_store:
+            attach_failed = 0
+            for fid, _res, exc in _pool(p.attach, attach, workers):
+                if exc is not None:
+                    logger.error("Attach of %s failed: %s", fid, exc)
+                    attach_failed += 1
+                else:
+                    report["attached"] += 1
+            if not attach_failed and not report["failed"]:
+                cache["vector_store_id"] = vector_store
+
+        done = set()
+        for fid, _res, exc in _pool(cache["pending_delete"], delete, workers):
+            if exc is not None:
+                logger.error("Delete of %s failed (retried next run): %s", fid, exc)
+            else:
+                done.add(fid)
+        cache["pending_delete"] = [fid for fid in cache["pending_delete"] if fid not in done]
+        report["deleted"] = len(done)
+    finally:
+        save_cache(cache, cache_path)
+
+    report["seconds"] = round(time.perf_counter() - t0, 2)
+    return report
@@ -0,0 +1,89 @@
+﻿# assistant/fuzzy.py
+import os
+import math
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+"""
+Character-trigram index over the index vocabulary (typo tolerance for query tokens).
+
+- built by search_index.py together with the postings and stored in index.json
+  (CSR layout: sorted trigram keys, offsets, term ids), never computed per request
+- only alphabetic vocabulary terms of >= 3 letters take part; codes and numbers are
+  matched exactly or not at all
+- nearest(): Dice similarity on padded trigrams; shared trigrams are counted over the
+  query trigrams' term lists, terms below the minimum shared count are skipped unseen
+  -> well under a millisecond per token
+- input is already folded (textnorm.fold): diacritic variants never need the fuzzy step
+"""
+
+# ===== Config =====
+FUZZY_MIN_LEN = int(os.getenv("FUZZY_MIN_LEN", "4"))            # shorter unknown tokens are not expanded
+FUZZY_MIN_SIM = float(os.getenv("FUZZY_MIN_SIM", "0.55"))       # Dice similarity on trigrams
+FUZZY_MAX_TERMS = int(os.getenv("FUZZY_MAX_TERMS", "3"))        # vocabulary terms per unknown token (0: off)
+# ==================
+
+
+def trigrams(term: str) -> set:
+    padded = f"^{term}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def fuzzy_term(term: str) -> bool:
+    return len(term) >= 3 and term.isalpha()
+
+
+class TrigramIndex:
+    def __init__(self, vocab: List[str], grams: Dict[str, List[int]]):
+        self.vocab = vocab    # term id -> term
+        self.grams = grams    # trigram -> [term id, ...] ascending
+
+    def __len__(self):
+        return len(self.vocab)
+
+    @classmethod
+    def build(cls, terms: Iterable[str]) -> "TrigramIndex":
+        vocab = sorted(t for t in terms if fuzzy_term(t))
+        grams: Dict[str, List[int]] = {}
+        for term_id, term in enumerate(vocab):
+            for g in trigrams(term):
+                grams.setdefault(g, []).append(term_id)
+        return cls(vocab, grams)
+
+    def to_json(self) -> dict:
+        keys = sorted(self.grams)
+        offsets, ids = [0], []
+        for g in keys:
+            ids.extend(self.grams[g])
+            offsets.append(len(ids))
+        return {"vocab": self.vocab, "keys": keys, "offsets": offsets, "ids": ids}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "TrigramIndex":
+        offsets, ids = data["offsets"], data["ids"]
+        grams = {g: ids[offsets[i]:offsets[i + 1]] for i, g in enumerate(data["keys"])}
+        return cls(data["vocab"], grams)
+
+    def nearest(self, term: str, max_terms: int = FUZZY_MAX_TERMS,
+                min_sim: float = FUZZY_MIN_SIM) -> List[Tuple[str, float]]:
+        """Up to max_terms vocabulary terms with Dice >= min_sim, most similar first."""
+        if max_terms <= 0 or not fuzzy_term(term):
+            return []
+        q = trigrams(term)
+        n = len(q)
+        shared: Counter = Counter()
+        for g in q:
+            shared.update(self.grams.get(g, ()))  # C-level counting; a term is listed once per trigram
+
+        # Dice >= s needs shared >= s*n/(2-s): everything below is dropped without a look
+        need = max(1, math.ceil(min_sim * n / (2.0 - min_sim)))
+        found = []
+        for term_id, common in shared.items():
+            if common < need:
+                continue
+            other = self.vocab[term_id]
+            sim = 2.0 * common / (n + len(trigrams(other)))
+            if sim >= min_sim:
+                found.append((sim, other))
+        found.sort(key=lambda t: (-t[0], t[1]))
+        return [(other, round(sim, 3)) for sim, other in found[:max_terms]]
@@ -0,0 +1,267 @@
+﻿# assistant/generations.py
+import os
+import time
+import atexit
+import shutil
+import pathlib
+import logging
+import tempfile
+import threading
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from . import metrics
+
+"""
+Versioned index generations: a re-ingest goes live in every gunicorn worker without a restart.
+
+INDEX_DIR/
+  CURRENT                   name of the live generation (one line; written tmp + rename)
+  gen-<stamp>-<version>/    index.json, corpus.bin/.idx, minhash.bin of one build, never modified
+  leases/<pid>              generation(s) a worker process is serving, one per line
+  .tmp-*/                   a generation being written (renamed to gen-* once complete)
+
+Writer (search_index.build_index, called by ingest.py): save into new_tmp_dir(), publish()
+(rename to gen-*, then replace CURRENT), collect().
+Reader (LiveIndex, views._get_index): one os.stat of CURRENT per request; on a change a
+background thread loads the new generation while requests keep being served from the old
+one, then the reference is swapped (two indexes in memory only during the swap; the
+corpus is mmapped, so most of it is shared page cache anyway).
+collect() (after a publish, and by each worker after its swap): removes generations that
+are neither current nor named in the lease of a live process, leases of dead processes, abandoned temp dirs and the pre-generation flat layout.
+A reader racing a collect (CURRENT read, lease not yet written) just re-reads CURRENT.
+"""
+
+logger = logging.getLogger(__name__)
+
+# ===== Config =====
+TMP_MAX_AGE = 3600            # seconds; older .tmp-* dirs are left over from a crashed build
+RELOAD_RETRY = 5.0            # seconds before a generation that failed to load is tried again
+# ==================
+
+CURRENT_FILE = "CURRENT"
+GEN_PREFIX = "gen-"
+TMP_PREFIX = ".tmp-"
+LEASE_DIR = "leases"
+LEGACY = "."                  # flat layout (index.json directly in INDEX_DIR)
+LEGACY_FILES = ("index.json", "corpus.bin", "corpus.idx", "minhash.bin")
+
+
+# ----------------------- writer -----------------------
+def current(index_dir: pathlib.Path) -> Optional[str]:
+    try:
+        name = (pathlib.Path(index_dir) / CURRENT_FILE).read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+    return name or None
+
+
+def current_stat(index_dir: pathlib.Path) -> Optional[Tuple[int, int, int]]:
+    """Cheap change marker of CURRENT (inode changes on every replace)."""
+    try:
+        st = os.stat(pathlib.Path(index_dir) / CURRENT_FILE)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def generation_dir(index_dir: pathlib.Path, name: Optional[str] = None) -> pathlib.Path:
+    """Directory of generation `name` (default: the current one; flat layout if there is none)."""
+    return pathlib.Path(index_dir) / (name or current(index_dir) or LEGACY)
+
+
+def new_tmp_dir(index_dir: pathlib.Path) -> pathlib.Path:
+    index_dir = pathlib.Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    return pathlib.Path(tempfile.mkdtemp(prefix=TMP_PREFIX, dir=index_dir))
+
+
+def publish(index_dir: pathlib.Path, tmp_dir: pathlib.Path, version: str) -> str:
+    """Make the fully written `tmp_dir` the current generation. Returns its name."""
+    index_dir = pathlib.Path(index_dir)
+    name = f"{GEN_PREFIX}{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10 ** 9:09d}-{version[:8]}"
+    os.rename(tmp_dir, index_dir / name)
+    pointer = index_dir / f"{CURRENT_FILE}.{os.getpid()}.tmp"
+    with open(pointer, "w", encoding="utf-8") as f:
+        f.write(name + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer, index_dir / CURRENT_FILE)  # atomic switch for every worker
+    return name
+
+
+# ----------------------- leases / gc -----------------------
+def lease(index_dir: pathlib.Path, names: Iterable[str]):
+    """Record the generations this process serves (replaces its previous lease)."""
+    lease_dir = pathlib.Path(index_dir) / LEASE_DIR
+    lease_dir.mkdir(parents=True, exist_ok=True)
+    tmp = lease_dir / f"{os.getpid()}.tmp"
+    tmp.write_text("".join(f"{n}\n" for n in names), encoding="utf-8")
+    os.replace(tmp, lease_dir / str(os.getpid()))
+
+
+def release(index_dir: pathlib.Path):
+    try:
+        os.unlink(pathlib.Path(index_dir) / LEASE_DIR / str(os.getpid()))
+    except OSError:
+        pass
+
+
+def _alive(pid: int) -> bool:
+    if os.name != "posix":
+        return True  # no cheap liveness probe: keep what the lease names
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def leased(index_dir: pathlib.Path) -> set:
+    """Generations named by the leases of live processes; leases of dead ones are removed."""
+    lease_dir = pathlib.Path(index_dir) / LEASE_DIR
+    names = set()
+    for path in lease_dir.glob("*") if lease_dir.is_dir() else ():
+        if not path.name.isdigit():
+            continue
+        if not _alive(int(path.name)):
+            path.unlink(missing_ok=True)
+            continue
+        try:
+            names.update(ln.strip() for ln in path.read_text(encoding="utf-8").splitlines() if ln.strip())
+        except OSError:
+            pass
+    return names
+
+
+def collect(index_dir: pathlib.Path) -> List[str]:
+    """Delete unreferenced generations (see module docstring). Returns what was removed."""
+    index_dir = pathlib.Path(index_dir)
+    cur = current(index_dir)
+    if cur is None:
+        return []  # flat layout only: nothing is versioned yet
+    keep = leased(index_dir) | {cur}
+    removed = []
+    for path in index_dir.iterdir():
+        if path.is_dir() and path.name.startswith(GEN_PREFIX) and path.name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path.name)
+        elif path.is_dir() and path.name.startswith(TMP_PREFIX) and time.time() - path.stat().st_mtime > TMP_MAX_AGE:
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path.name)
+    if LEGACY not in keep:
+        for name in LEGACY_FILES:
+            if (index_dir / name).exists():
+                (index_dir / name).unlink(missing_ok=True)
+                removed.append(name)
+    return removed
+
+
+# ----------------------- reader -----------------------
+class LiveIndex:
+    """
+    The index a worker serves. get() is the per-request entry point: first call loads
+    synchronously, later calls stat CURRENT and, on a change, trigger a background reload.
+    loader(generation dir) -> index or None (missing/outdated); fallback() is used when the
+    first load finds no usable generation (e.g. build in memory from the TXT pages);
+    warm(index) runs in the loading thread before the index is served (ranking statistics),
+    so the first request on a new generation pays nothing. A failed reload keeps the old
+    index and is retried after RELOAD_RETRY seconds.
+    """
+
+    def __init__(self, index_dir: pathlib.Path, loader: Callable[[pathlib.Path], object],
+                 fallback: Optional[Callable[[], object]] = None, warm: Optional[Callable[[object], None]] = None):
+        self.index_dir = pathlib.Path(index_dir)
+        self._loader = loader
+        self._fallback = fallback
+        self._warm = warm
+        self._value = None
+        self.generation: Optional[str] = None
+        self._stat = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._reloading = False
+        atexit.register(release, self.index_dir)
+
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._stat = current_stat(self.index_dir)
+                    self.generation, value = self._load()
+                    if value is None and self._fallback is not None:
+                        value = self._fallback()
+                    if value is not None and self._warm is not None:
+                        self._warm(value)
+                    self._value = value
+            return self._value
+
+        stat = current_stat(self.index_dir)
+        if stat != self._stat and not self._reloading and time.monotonic() >= self._retry_at:
+            with self._lock:
+                if stat != self._stat and not self._reloading:
+                    self._reloading = True
+                    threading.Thread(target=self._reload, args=(stat,), name="index-reload", daemon=True).start()
+        return self._value
+
+    def peek(self):
+        """The index being served, or None before the first get(); never loads or rescans."""
+        return self._value
+
+    def after_fork(self):
+        """In a freshly forked worker (gunicorn post_fork): own lock, own lease."""
+        self._lock = threading.Lock()
+        self._reloading = False
+        if self.generation is not None:
+            lease(self.index_dir, [self.generation])
+
+    def release(self):
+        """The process no longer serves requests (gunicorn master after preloading)."""
+        release(self.index_dir)
+
+    def _load(self):
+        """(generation, index or None); retried when a publish/collect raced the read of CURRENT."""
+        for _attempt in range(3):
+            name = current(self.index_dir) or LEGACY
+            if name == self.generation:
+                return name, None
+            lease(self.index_dir, [n for n in (self.generation, name) if n])
+            value = self._loader(generation_dir(self.index_dir, name))
+            if value is not None or current(self.index_dir) in (name, None):
+                return name, value
+        return name, None
+
+    def _reload(self, stat):
+        t0 = time.perf_counter()
+        done = False
+        try:
+            name, value = self._load()
+            if value is None:
+                if name != self.generation:
+                    logger.warning("Index generation %s not loadable; still serving %s", name, self.generation)
+                    metrics.inc("assistant_index_reloads_total", outcome="failed")
+                    lease(self.index_dir, [self.generation])
+                else:
+                    done = True  # CURRENT rewritten, same generation
+                return
+            if self._warm is not None:
+                self._warm(value)
+            old = self.generation
+            self._value, self.generation = value, name  # single reference swap
+            lease(self.index_dir, [name])
+            collect(self.index_dir)  # the last worker to move on frees the old generation
+            metrics.inc("assistant_index_reloads_total", outcome="ok")
+            logger.info("Index generation %s -> %s (loaded in %.0f ms)", old, name, (time.perf_counter() - t0) * 1000)
+            done = True
+        except Exception as e:
+            metrics.inc("assistant_index_reloads_total", outcome=type(e).__name__)
+            logger.exception("Index reload failed: %s", e)
+        finally:
+            # only a finished reload settles this CURRENT; a failed one (partial copy, full
+            # disk) is tried again on a later request
+            if done:
+                self._stat = stat
+            else:
+                self._retry_at = time.monotonic() + RELOAD_RETRY
+            self._reloading = False
@@ -1,32 +1,81 @@
 ﻿# assistant/ingest.py
 import os
 import re
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
 import unicodedata
 import pathlib
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
 from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer, LTTextLineHorizontal
+from pdfminer.layout import LTChar, LTTextContainer, LTTextLine, LTTextLineHorizontal
+from pdfminer.pdfpage import PDFPage
+
+if __package__ in (None, ""):
+    # run as a script (python assistant/ingest.py): make the `assistant` package importable
+    sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from assistant.search_index import build_index, current_index_path
+from assistant.cache import invalidate_shared
+from assistant.page_render import remove_previews, render_pdf, signature as preview_signature
+from assistant.ocr import ocr_pages
+from assistant.products import rebuild as rebuild_products
 
 """
 Ingest per page:
+- Incremental: media/knowledge_txt/manifest.json keeps PDF sha256/mtime and per-page output
+  hashes; unchanged PDFs are skipped and only pages whose output changed are rewritten
+- Parallel: PDFs are split into page ranges (pdfminer page_numbers) on a process pool;
+  a PDF with a range pdfminer could not read keeps its previous pages and manifest entry
+  (retried on the next run)
 - Extract text per PDF page with pdfminer (no poppler needed)
-- Optional: render PNGs (requires Poppler) and OCR empty pages (requires Tesseract)
+- Optional: page previews (requires Poppler) and OCR empty pages (requires Tesseract;
+  ocr.py: process pool, only uncovered image regions, content-addressed cache in cache/ocr)
+- Table mode: cluster text lines by y/x into rows/columns, merge rotated headers
 - Normalize/clean text
-- Write one TXT per page => media/knowledge_txt/<source>_pNNN.txt
-- Optionally write PNG per page => static/page_images/<source>_pNNN.png
+- Write one TXT per page => media/knowledge_txt/<source>_pNNN.txt (WRITE_PAGE_TXT; optional,
+  the index can take the page texts directly)
+- Table mode: one TSV record per table row => media/knowledge_txt/<source>_pNNN.tsv
+- Optionally write page thumbnails => static/page_images/<source>_pNNN_w<width>.webp
+  (page_render.py: windowed pdftoppm, bounded memory; only PDFs whose sha256 changed)
+- Update the inverted index + article-code table + packed corpus from the change report
+  => a new generation media/knowledge_index/gen-*/ (index.json, corpus.bin, corpus.idx),
+  switched live via media/knowledge_index/CURRENT; running workers reload it in the
+  background, no restart needed (generations.py)
+- Rebuild the product table (code, name, price, currency, dimensions, PDF, page) in the
+  Django database from the code table (products.py; needs python manage.py migrate)
+- Then python manage.py sync_openai_files uploads only the changed pages to the OpenAI Files
+  API / vector store and deletes the removed ones (file_sync.py, .openai_file_cache.json)
+
+Usage: python assistant/ingest.py [--force] [--workers N]
 """
 
 # ===== Config =====
 GENERATE_IMAGES = False       # True only if poppler (pdftoppm/pdfinfo) is installed
 OCR_EMPTY_PAGES = False       # True only if Tesseract is installed
-DPI = 200                     # PNG resolution for image/OCR path
+DPI = 200                     # page render resolution for OCR (previews: page_render.RENDER_DPI)
 TEXT_MIN_LEN_FOR_SKIP_OCR = 60  # if extracted text shorter than this, try OCR (when enabled)
+TABLE_MODE = True             # layout-aware rows/columns instead of pdfminer element order
+TABLE_CELL_MAX_CHARS = 32     # longer lines are prose, kept as blocks (not split into cells)
+TABLE_MIN_CELLS = 2           # a row needs this many cells to be written to the TSV
+ROW_TOL = 0.5                 # same row if vertical centers differ < ROW_TOL * line height
+COL_TOL = 6.0                 # x0 positions closer than this (pt) share one column
+INGEST_WORKERS = os.cpu_count() or 1  # process pool size (1 = everything in this process)
+PAGES_PER_TASK = 40           # page range handed to one pool task
+WRITE_PAGE_TXT = True         # per-page TXT/TSV export (debug output when the packed corpus is used)
+BUILD_PRODUCTS = True         # product table for attribute queries ("cheie 13 mm sub 50 lei")
 # ==================
 
+logger = logging.getLogger(__name__)
+
 BASE = pathlib.Path(__file__).resolve().parents[1]
 PDF_DIR = BASE / "media" / "knowledge"
 TXT_DIR = BASE / "media" / "knowledge_txt"
 IMG_DIR = BASE / "static" / "page_images"
+MANIFEST_PATH = TXT_DIR / "manifest.json"
 
 TXT_DIR.mkdir(parents=True, exist_ok=True)
 IMG_DIR.mkdir(parents=True, exist_ok=True)
@@ -69,10 +118,10 @@ def _remove_page_noise(s: str) -> str:
     return "\n".join(cleaned).strip()
 
 
-def extract_per_page_text(pdf_path: pathlib.Path) -> List[str]:
-    """Extract text per page using pdfminer (no Poppler)."""
+def extract_per_page_text(pdf_path: pathlib.Path, page_numbers: Optional[Iterable[int]] = None) -> List[str]:
+    """Extract text per page using pdfminer (no Poppler). page_numbers: 0-based subset."""
     pages = []
-    for page_layout in extract_pages(str(pdf_path)):
+    for page_layout in extract_pages(str(pdf_path), page_numbers=page_numbers):
         buf = []
         for element in page_layout:
             if isinstance(element, LTTextContainer):
@@ -83,98 +132,422 @@ def extract_per_page_text(pdf_path: pathlib.Path) -> List[str]:
     return pages
 
 
-def render_page_images(pdf_path: pathlib.Path):
+# ----------------------- table mode -----------------------
+def _text_lines(page_layout):
+    """All LTTextLine objects on a page (inside boxes or loose)."""
+    for element in page_layout:
+        if isinstance(element, LTTextLine):
+            yield element
+        elif isinstance(element, LTTextContainer):
+            for text_line in element:
+                if isinstance(text_line, LTTextLine):
+                    yield text_line
+
+
+def _merge_rotated(chars: List[LTChar]) -> List[Tuple[str, tuple]]:
     """
-    Render PNGs per page **only** if GENERATE_IMAGES=True and Poppler is available.
-    Returns list of PIL.Image (or []).
+    Rotated glyphs (pdfminer emits them one per line) -> whole strings.
+    Glyphs are grouped into columns by x center, ordered along the baseline
+    (matrix b > 0: bottom-to-top, b < 0: top-to-bottom) and split on large gaps.
+    Returns [(text, bbox), ...].
     """
-    if not GENERATE_IMAGES:
-        return []
+    columns: List[List[LTChar]] = []
+    for ch in sorted(chars, key=lambda c: (c.x0 + c.x1) / 2):
+        xc = (ch.x0 + ch.x1) / 2
+        if columns and abs(xc - (columns[-1][-1].x0 + columns[-1][-1].x1) / 2) <= max(ch.width, 1.0) * 0.5:
+            columns[-1].append(ch)
+        else:
+            columns.append([ch])
+
+    out = []
+    for col in columns:
+        upward = col[0].matrix[1] > 0
+        col.sort(key=lambda c: c.y0, reverse=not upward)
+        runs: List[List[LTChar]] = [[col[0]]]
+        for prev, ch in zip(col, col[1:]):
+            gap = (ch.y0 - prev.y1) if upward else (prev.y0 - ch.y1)
+            if gap > max(ch.size, prev.size) * 1.5:
+                runs.append([ch])
+            else:
+                runs[-1].append(ch)
+        for run in runs:
+            text = ""
+            for prev, ch in zip([None] + run, run):
+                if prev is not None:
+                    gap = (ch.y0 - prev.y1) if upward else (prev.y0 - ch.y1)
+                    if gap > ch.size * 0.25:
+                        text += " "
+                text += ch.get_text()
+            bbox = (min(c.x0 for c in run), min(c.y0 for c in run),
+                    max(c.x1 for c in run), max(c.y1 for c in run))
+            out.append((text.strip(), bbox))
+    return out
+
+
+def _cluster_rows(cells: List[Tuple[str, tuple]]) -> List[List[Tuple[str, tuple]]]:
+    """Group (text, bbox) cells into rows by vertical center, top of page first."""
+    rows: List[List[Tuple[str, tuple]]] = []
+    for cell in sorted(cells, key=lambda c: -(c[1][1] + c[1][3]) / 2):
+        _text, (x0, y0, x1, y1) = cell
+        yc, h = (y0 + y1) / 2, max(y1 - y0, 1.0)
+        if rows:
+            last = rows[-1]
+            ly = sum((c[1][1] + c[1][3]) / 2 for c in last) / len(last)
+            if abs(ly - yc) < ROW_TOL * h:
+                last.append(cell)
+                continue
+        rows.append([cell])
+    for row in rows:
+        row.sort(key=lambda c: c[1][0])
+    return rows
+
+
+def _column_anchors(rows: List[List[Tuple[str, tuple]]]) -> List[float]:
+    """x0 positions shared by the cells of multi-cell rows, clustered within COL_TOL."""
+    xs = sorted(c[1][0] for row in rows if len(row) >= TABLE_MIN_CELLS for c in row)
+    anchors: List[float] = []
+    for x in xs:
+        if anchors and x - anchors[-1] <= COL_TOL:
+            continue
+        anchors.append(x)
+    return anchors
 
-    try:
-        from pdf2image import convert_from_path  # type: ignore
-    except Exception as e:
-        print("Image generation skipped: cannot import pdf2image:", e)
-        return []
 
+def _align_row(row: List[Tuple[str, tuple]], anchors: List[float]) -> List[str]:
+    """Place the row's cells in column slots (empty string where a column has no value)."""
+    if not anchors:
+        return [c[0] for c in row]
+    slots = [""] * len(anchors)
+    for text, bbox in row:
+        col = min(range(len(anchors)), key=lambda i: abs(anchors[i] - bbox[0]))
+        slots[col] = f"{slots[col]} {text}".strip()
+    return slots
+
+
+def extract_per_page_rows(pdf_path: pathlib.Path,
+                          page_numbers: Optional[Iterable[int]] = None) -> List[Tuple[str, List[List[str]]]]:
+    """
+    Layout-aware extraction (TABLE_MODE).
+    Per page returns (text, table_rows):
+    - prose lines (> TABLE_CELL_MAX_CHARS) stay whole, in reading order
+    - short lines and merged rotated strings are clustered into rows, one row per line,
+      cells joined with " | "
+    - table_rows: the rows with >= TABLE_MIN_CELLS cells, aligned to page columns (for the TSV)
+    page_numbers: 0-based subset of pages (None = all).
+    """
+    pages = []
+    for page_layout in extract_pages(str(pdf_path), page_numbers=page_numbers):
+        cells: List[Tuple[str, tuple]] = []
+        blocks: List[Tuple[str, tuple]] = []
+        rotated: List[LTChar] = []
+
+        for text_line in _text_lines(page_layout):
+            chars = [c for c in text_line if isinstance(c, LTChar)]
+            if chars and not any(c.upright for c in chars):
+                rotated.extend(chars)
+                continue
+            text = text_line.get_text().strip()
+            if not text:
+                continue
+            if len(text) > TABLE_CELL_MAX_CHARS:
+                blocks.append((text, text_line.bbox))
+            else:
+                cells.append((text, text_line.bbox))
+        cells.extend(_merge_rotated(rotated))
+
+        rows = _cluster_rows(cells)
+        anchors = _column_anchors(rows)
+
+        # prose blocks and table rows interleaved by their top edge
+        items = [(b[1][3], b[0]) for b in blocks]
+        items += [(max(c[1][3] for c in row), " | ".join(c[0] for c in row)) for row in rows]
+        items.sort(key=lambda t: -t[0])
+        text = "\n".join(t for _y, t in items)
+
+        table = [_align_row(row, anchors) for row in rows if len(row) >= TABLE_MIN_CELLS]
+        pages.append((text, table))
+    return pages
+
+
+def _tsv_text(rows: List[List[str]]) -> str:
+    """One record per product row; tabs/newlines inside cells become spaces."""
+    lines = ["\t".join(re.sub(r"[\t\r\n]+", " ", c) for c in row) for row in rows]
+    return "\n".join(lines) + "\n"
+
+
+# ----------------------- manifest -----------------------
+def _sha256_file(path: pathlib.Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _sha256_text(s: str) -> str:
+    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+
+def _load_manifest() -> dict:
     try:
-        images = convert_from_path(str(pdf_path), fmt="png", dpi=DPI)
-        return images
-    except Exception as e:
-        print("Image generation skipped: pdf2image/Poppler error:", e)
-        return []
+        return json.loads(MANIFEST_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {"pdfs": {}}
+
+
+def _save_manifest(manifest: dict):
+    tmp = MANIFEST_PATH.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=1), encoding="utf-8")
+    os.replace(tmp, MANIFEST_PATH)
+
+
+def _write_if_changed(path: pathlib.Path, content: str, old_hash: Optional[str],
+                      write: bool = True) -> Tuple[str, bool]:
+    """
+    Write `content` unless the file already holds it. Returns (hash, changed).
+    write=False: only compare against the manifest hash (no TXT export).
+    """
+    new_hash = _sha256_text(content)
+    if old_hash is None and path.exists():
+        # first run over pages written before the manifest existed
+        old_hash = _sha256_text(path.read_text(encoding="utf-8", errors="ignore"))
+    if not write:
+        return new_hash, new_hash != old_hash
+    if new_hash == old_hash and path.exists():
+        return new_hash, False
+    path.write_text(content, encoding="utf-8")
+    return new_hash, True
+
 
+# ----------------------- parallel extraction -----------------------
+def _page_count(pdf_path: pathlib.Path) -> int:
+    with open(pdf_path, "rb") as f:
+        return sum(1 for _ in PDFPage.get_pages(f))
 
-def ocr_image_to_text(pil_img) -> str:
-    """OCR a PIL image if Tesseract is installed; else return ''."""
-    if not OCR_EMPTY_PAGES:
-        return ""
+
+def _extract_range(task: Tuple[str, int, int]) -> Optional[List[Tuple[int, str, List[List[str]]]]]:
+    """
+    Pool task: pages [first, last) (0-based) of one PDF.
+    Returns [(page no. 1-based, normalized text, table rows), ...]; None when pdfminer failed.
+    """
+    pdf_path, first, last = task
+    numbers = range(first, last)
     try:
-        import pytesseract  # type: ignore
-        txt = pytesseract.image_to_string(pil_img, lang="ron+eng")
-        return txt or ""
+        if TABLE_MODE:
+            extracted = extract_per_page_rows(pathlib.Path(pdf_path), page_numbers=numbers)
+        else:
+            extracted = [(t, []) for t in extract_per_page_text(pathlib.Path(pdf_path), page_numbers=numbers)]
     except Exception as e:
-        print("OCR skipped (tesseract not available?):", e)
-        return ""
+        logger.error("pdfminer error in %s pages %d-%d: %s", pathlib.Path(pdf_path).name, first + 1, last, e)
+        return None
+    return [
+        (first + i + 1, _remove_page_noise(_norm_text(txt)), rows)
+        for i, (txt, rows) in enumerate(extracted)
+    ]
+
+
+def _extract_pdfs(pdfs: List[pathlib.Path], workers: int) -> Dict[str, Dict[int, Tuple[str, List[List[str]]]]]:
+    """
+    Fan out every PDF by page range; returns {pdf name: {page no.: (text, rows)}}.
+    A PDF whose page count or any range failed is left out: its old pages stay.
+    """
+    tasks = []
+    failed = set()
+    for pdf in pdfs:
+        try:
+            n = _page_count(pdf)
+        except Exception as e:
+            logger.error("Cannot read page count of %s: %s", pdf.name, e)
+            failed.add(pdf.name)
+            continue
+        tasks += [(str(pdf), first, min(first + PAGES_PER_TASK, n)) for first in range(0, n, PAGES_PER_TASK)]
+
+    out: Dict[str, Dict[int, Tuple[str, List[List[str]]]]] = {pdf.name: {} for pdf in pdfs}
+    if workers <= 1 or len(tasks) <= 1:
+        results = map(_extract_range, tasks)
+        for task, pages in zip(tasks, results):
+            _collect(out, failed, task, pages)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for task, pages in zip(tasks, pool.map(_extract_range, tasks)):
+                _collect(out, failed, task, pages)
+    for name in failed:
+        out.pop(name, None)
+    return out
+
+
+def _collect(out, failed, task, pages):
+    name = pathlib.Path(task[0]).name
+    if pages is None:
+        failed.add(name)
+    else:
+        out[name].update({pno: (txt, rows) for pno, txt, rows in pages})
 
 
 # ----------------------- pipeline -----------------------
-def main():
+def main(force: bool = False, workers: int = INGEST_WORKERS) -> dict:
+    """
+    Returns the change report {"added": [...], "changed": [...], "removed": [...]}
+    (TXT file names), which also drives the incremental index update.
+    """
+    changes = {"added": [], "changed": [], "removed": []}
     pdfs = sorted(PDF_DIR.glob("*.pdf"))
     if not pdfs:
         print("Put PDF files into media/knowledge/ first.")
-        return
+        return changes
 
+    t0 = time.time()
+    if not WRITE_PAGE_TXT and not current_index_path().exists():
+        force = True  # no TXT pages and no index to carry unchanged PDFs over from
+    manifest = _load_manifest()
+    page_texts: Dict[str, str] = {}  # changed pages, for the index when the TXT export is off
+    entries = manifest.setdefault("pdfs", {})
+
+    # 0) which PDFs changed? (mtime/size first, sha256 only when those differ)
+    todo = []
     for pdf in pdfs:
+        st = pdf.stat()
+        entry = entries.get(pdf.name)
+        if not force and entry and entry.get("size") == st.st_size and entry.get("mtime") == st.st_mtime_ns:
+            print(f"Unchanged {pdf.name}")
+            continue
+        digest = _sha256_file(pdf)
+        if not force and entry and entry.get("sha256") == digest:
+            entry["size"], entry["mtime"] = st.st_size, st.st_mtime_ns
+            print(f"Unchanged {pdf.name} (touched)")
+            continue
+        todo.append((pdf, digest, st))
+
+    # PDFs that disappeared: drop the pages we wrote for them
+    present = {pdf.name for pdf in pdfs}
+    for name in [n for n in entries if n not in present]:
+        for out_name in entries.pop(name).get("pages", {}):
+            (TXT_DIR / out_name).unlink(missing_ok=True)
+            if out_name.endswith(".txt"):
+                changes["removed"].append(out_name)
+        remove_previews(slugify(pathlib.Path(name).stem), out_dir=IMG_DIR)
+
+    # 1) extract text per page (process pool, table mode: rows/columns + TSV records)
+    extracted = _extract_pdfs([pdf for pdf, _d, _st in todo], workers)
+
+    # 1b) OCR fallback for (nearly) empty pages: process pool + cache keyed by the rendered pixels
+    if OCR_EMPTY_PAGES:
+        short = [(pdf, pno) for pdf, _d, _st in todo
+                 for pno, (txt, _rows) in sorted(extracted.get(pdf.name, {}).items())
+                 if len(txt) < TEXT_MIN_LEN_FOR_SKIP_OCR]
+        for (name, pno), ocr_txt in ocr_pages(short, DPI, workers).items():
+            # only uncovered regions were OCR'd: the result complements the pdfminer text
+            ocr_txt = _norm_text(ocr_txt)
+            txt, rows = extracted[name][pno]
+            if ocr_txt:
+                extracted[name][pno] = ((txt + "\n" + ocr_txt).strip(), rows)
+
+    for pdf, digest, st in todo:
         base = slugify(pdf.stem)
         print(f"Processing {pdf.name}")
+        if pdf.name not in extracted:
+            # manifest entry untouched (old sha256): the PDF is tried again on the next run
+            print(" -> extraction failed, previous pages kept.")
+            continue
+        pages = extracted[pdf.name]
+        old_pages = (entries.get(pdf.name) or {}).get("pages", {})
+        new_pages: Dict[str, str] = {}
 
-        # 1) extract text per page
-        try:
-            raw_pages = extract_per_page_text(pdf)
-        except Exception as e:
-            print("pdfminer error:", e)
-            raw_pages = []
-
-        # 2) optional: render images (useful for thumbnails and OCR fallback)
-        images = render_page_images(pdf)
-
-        num_pages = max(len(raw_pages), len(images))
+        num_pages = max(pages, default=0)
         if num_pages == 0:
             print(" -> no pages extracted (check PDF integrity).")
             continue
 
+        written = 0
         for idx in range(num_pages):
             pno = idx + 1
             tag = f"p{pno:03d}"
 
-            # text for page
-            txt = raw_pages[idx] if idx < len(raw_pages) else ""
-            txt = _norm_text(txt)
-            txt = _remove_page_noise(txt)
-
-            # OCR fallback if very short and we have image
-            if OCR_EMPTY_PAGES and len(txt) < TEXT_MIN_LEN_FOR_SKIP_OCR and idx < len(images):
-                ocr_txt = _norm_text(ocr_image_to_text(images[idx]))
-                if len(ocr_txt) > len(txt):
-                    txt = ocr_txt
+            # text for page (OCR'd already in 1b when it was too short)
+            txt, rows = pages.get(pno, ("", []))
 
             header = f"[SOURCE:{base}] [PAGE:{pno}]\n"
-            out_txt = (TXT_DIR / f"{base}_{tag}.txt")
-            out_txt.write_text(header + txt, encoding="utf-8")
-
-            # optional page PNG
-            if idx < len(images):
-                img_path = IMG_DIR / f"{base}_{tag}.png"
-                try:
-                    images[idx].save(img_path)
-                except Exception as e:
-                    print(f"Could not save image for page {pno}:", e)
-
-        print(f" -> wrote {num_pages} pages")
+            txt_name = f"{base}_{tag}.txt"
+            existed = txt_name in old_pages or (TXT_DIR / txt_name).exists()
+            new_pages[txt_name], was_changed = _write_if_changed(TXT_DIR / txt_name, header + txt,
+                                                                 old_pages.get(txt_name), WRITE_PAGE_TXT)
+            if was_changed:
+                written += 1
+                changes["changed" if existed else "added"].append(txt_name)
+                page_texts[txt_name] = header + txt
+
+            # table rows as TSV next to the TXT
+            tsv_name = f"{base}_{tag}.tsv"
+            if rows and WRITE_PAGE_TXT:
+                new_pages[tsv_name], _ = _write_if_changed(TXT_DIR / tsv_name, _tsv_text(rows),
+                                                           old_pages.get(tsv_name))
+            else:
+                (TXT_DIR / tsv_name).unlink(missing_ok=True)
+
+        # pages that no longer exist in the new PDF version
+        for out_name in old_pages:
+            if out_name not in new_pages:
+                (TXT_DIR / out_name).unlink(missing_ok=True)
+                if out_name.endswith(".txt"):
+                    changes["removed"].append(out_name)
+
+        entries[pdf.name] = {"sha256": digest, "size": st.st_size, "mtime": st.st_mtime_ns, "pages": new_pages,
+                             "num_pages": num_pages, "images": (entries.get(pdf.name) or {}).get("images")}
+        print(f" -> {num_pages} pages, {written} rewritten")
+
+    # 2) optional: page previews, only where the PDF (or the preview settings) changed
+    if GENERATE_IMAGES:
+        for pdf in pdfs:
+            entry = entries.get(pdf.name)
+            # manifests written before previews existed have no num_pages: count the TXT pages
+            n = (entry or {}).get("num_pages") or sum(1 for o in (entry or {}).get("pages", {}) if o.endswith(".txt"))
+            if not n:
+                continue
+            wanted = preview_signature(entry["sha256"])
+            if not force and entry.get("images") == wanted:
+                continue
+            base = slugify(pdf.stem)
+            done = render_pdf(pdf, base, n, out_dir=IMG_DIR, workers=workers)
+            remove_previews(base, keep_pages=n, out_dir=IMG_DIR)
+            print(f"Previews {pdf.name}: {done}/{n} pages")
+            if done == n:
+                entry["images"] = wanted
+
+    manifest["last_run"] = {
+        "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seconds": round(time.time() - t0, 1),
+        "changes": changes,
+    }
+    _save_manifest(manifest)
+    print(f"Changes: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+          f"{len(changes['removed'])} removed ({manifest['last_run']['seconds']} s)")
+
+    # 3) inverted index + packed corpus as a new generation (workers swap to it on their own)
+    touched = changes["added"] + changes["changed"] + changes["removed"]
+    if touched or force or not current_index_path().exists():
+        if WRITE_PAGE_TXT:
+            idx = build_index(TXT_DIR, changed=None if force else touched)
+        else:
+            idx = build_index(TXT_DIR, pages=page_texts, removed=changes["removed"])
+        print(f"Index: {len(idx.files)} files, {len(idx)} paragraphs, {len(idx.postings)} tokens, {len(idx.codes)} codes")
+        # 4) product table from the fresh code table
+        if BUILD_PRODUCTS:
+            try:
+                n = rebuild_products(idx, {slugify(pathlib.Path(name).stem): name for name in entries})
+                print(f"Products: {n} rows")
+            except Exception as e:
+                print("Product table not rebuilt (python manage.py migrate?):", e)
+        # new corpus version -> cached prefilter results/answers are stale
+        if invalidate_shared():
+            print("Shared answer cache cleared.")
 
     print("Done. Run: python manage.py runserver")
+    return changes
 
 
 if __name__ == "__main__":
-    main()
+    ap = argparse.ArgumentParser(description="Ingest PDFs from media/knowledge into per-page TXT.")
+    ap.add_argument("--force", action="store_true", help="re-extract every PDF and rebuild the index")
+    ap.add_argument("--workers", type=int, default=INGEST_WORKERS, help="process pool size")
+    args = ap.parse_args()
+    main(force=args.force, workers=args.workers)
@@ -0,0 +1,45 @@
+﻿# assistant/management/commands/batch_lookup.py
+import sys
+import json
+import pathlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from assistant import batch, views
+
+
+class Command(BaseCommand):
+    help = ("Look up an order list (one product name or code per line) against the knowledge index "
+            "in one batch and print the matches as a JSON or CSV table.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="text file with one query per line, or - for stdin")
+        parser.add_argument("--format", choices=("json", "csv"), default="csv")
+        parser.add_argument("--top", type=int, default=batch.BATCH_TOP_N, help="matches per line")
+        parser.add_argument("--output", "-o", type=pathlib.Path, default=None, help="write here instead of stdout")
+
+    def handle(self, *args, **opts):
+        if opts["input"] == "-":
+            text = sys.stdin.read()
+        else:
+            try:
+                text = pathlib.Path(opts["input"]).read_text(encoding="utf-8")
+            except OSError as e:
+                raise CommandError(f"cannot read {opts['input']}: {e}")
+        lines = batch.parse_lines(text)
+        if not lines:
+            raise CommandError("no queries in the input")
+
+        kb = views._get_index()
+        result = batch.lookup(kb, lines, views._RANKER, views.MIN_OVERLAP, top_n=opts["top"])
+        if opts["format"] == "json":
+            out = json.dumps(result, ensure_ascii=False, indent=2)
+        else:
+            out = batch.to_csv(result["rows"])
+
+        if opts["output"]:
+            opts["output"].write_text(out, encoding="utf-8")
+        else:
+            self.stdout.write(out, ending="")
+        self.stderr.write(f"{result['lines']} lines, {result['matched_lines']} matched, "
+                          f"{result['elapsed_ms']} ms")
@@ -0,0 +1,48 @@
+﻿# assistant/management/commands/bench.py
+import json
+import pathlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from assistant import bench
+from assistant.fake_openai import FAKE_LATENCY
+
+
+class Command(BaseCommand):
+    help = ("Replay the benchmark query set against the knowledge index: latency percentiles, "
+            "throughput, peak RSS and recall@k (model leg served by a local fake OpenAI server).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stages", default=",".join(bench.STAGES),
+                            help="comma separated: prefilter,extract,ask (default: all)")
+        parser.add_argument("--iterations", type=int, default=3)
+        parser.add_argument("--warmup", type=int, default=1)
+        parser.add_argument("-k", type=int, default=5, help="recall@k cut-off (distinct pages)")
+        parser.add_argument("--cached", action="store_true", help="keep the query/answer caches on")
+        parser.add_argument("--concurrency", type=int, default=1, help="parallel ask() calls")
+        parser.add_argument("--latency", type=float, default=FAKE_LATENCY,
+                            help="fake model latency in seconds")
+        parser.add_argument("--queries", type=pathlib.Path, default=None,
+                            help=f"query set JSON (default: {bench.QUERIES_PATH.name})")
+        parser.add_argument("--json", action="store_true", help="print the raw report as JSON")
+
+    def handle(self, *args, **opts):
+        stages = [s.strip() for s in opts["stages"].split(",") if s.strip()]
+        unknown = set(stages) - set(bench.STAGES)
+        if unknown:
+            raise CommandError(f"unknown stage(s): {', '.join(sorted(unknown))}")
+
+        report = bench.run(
+            stages=stages,
+            iterations=opts["iterations"],
+            warmup=opts["warmup"],
+            k=opts["k"],
+            cached=opts["cached"],
+            concurrency=opts["concurrency"],
+            latency=opts["latency"],
+            queries_path=opts["queries"],
+        )
+        if opts["json"]:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+        else:
+            self.stdout.write(bench.format_report(report))
@@ -0,0 +1,25 @@
+﻿# assistant/management/commands/rebuild_products.py
+import json
+import pathlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from assistant import products
+from assistant.ingest import MANIFEST_PATH, slugify
+from assistant.search_index import KnowledgeIndex
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product table (attribute queries in ask()) from the persisted knowledge index."
+
+    def handle(self, *args, **opts):
+        kb = KnowledgeIndex.load()
+        if kb is None:
+            raise CommandError("no usable index: run assistant/ingest.py (or python -m assistant.search_index) first")
+        try:
+            manifest = json.loads(MANIFEST_PATH.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            manifest = {}
+        pdf_names = {slugify(pathlib.Path(name).stem): name for name in manifest.get("pdfs", {})}
+        n = products.rebuild(kb, pdf_names)
+        self.stdout.write(f"Products: {n} rows from {len(kb.codes)} codes")
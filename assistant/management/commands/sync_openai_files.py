@@ -0,0 +1,40 @@
+﻿# assistant/management/commands/sync_openai_files.py
+import json
+import pathlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from assistant import file_sync
+from assistant.search_index import TXT_DIR
+
+
+class Command(BaseCommand):
+    help = ("Upload the page TXTs that changed since the last sync to the OpenAI Files API (and vector store), "
+            "delete the files of removed pages and update .openai_file_cache.json.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--txt-dir", type=pathlib.Path, default=TXT_DIR)
+        parser.add_argument("--cache", type=pathlib.Path, default=file_sync.SYNC_CACHE_PATH)
+        parser.add_argument("--vector-store", default=file_sync.VECTOR_STORE_ID,
+                            help="vector store id to attach uploads to (env OPENAI_VECTOR_STORE_ID)")
+        parser.add_argument("--workers", type=int, default=file_sync.SYNC_WORKERS, help="concurrent API calls")
+        parser.add_argument("--verify", action="store_true",
+                            help="check every cached file id against the remote file list")
+        parser.add_argument("--dry-run", action="store_true", help="only print what would change")
+        parser.add_argument("--json", action="store_true", help="print the report as JSON")
+
+    def handle(self, *args, **opts):
+        if not opts["txt_dir"].is_dir():
+            raise CommandError(f"no page TXTs in {opts['txt_dir']}: run assistant/ingest.py first")
+        report = file_sync.sync(opts["txt_dir"], opts["cache"], vector_store=opts["vector_store"],
+                                workers=opts["workers"], verify=opts["verify"], dry_run=opts["dry_run"],
+                                log=self.stderr.write)
+        if opts["json"]:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+        else:
+            self.stdout.write(f"{report['uploaded']} uploaded, {report['reused']} renamed, {report['adopted']} adopted, "
+                              f"{report['attached']} attached, {report['deleted']} deleted, "
+                              f"{report['unchanged']} unchanged ({report['seconds']} s)")
+        if report["failed"]:
+            raise CommandError(f"{len(report['failed'])} uploads failed (kept for the next run): "
+                               + ", ".join(report["failed"][:10]))
@@ -0,0 +1,371 @@
+﻿# assistant/metrics.py
+import os
+import json
+import time
+import random
+import pathlib
+import cProfile
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+try:
+    import fcntl
+except ImportError:  # not POSIX: snapshots of exited workers are never folded
+    fcntl = None
+
+"""
+Lightweight instrumentation for the ask pipeline (no external dependency).
+
+- counters + histograms in a per-process registry (METRICS below lists every series)
+- stage(name): timer context manager -> assistant_stage_seconds{stage=...} and, inside a
+  request, the Server-Timing header (metrics_middleware)
+- cross-worker aggregation: every gunicorn worker snapshots its registry to
+  METRICS_DIR/<pid>.json (at most every METRICS_FLUSH_SECONDS); metrics/ merges all
+  snapshots into Prometheus text format. Snapshots are cumulative: when a worker exits
+  (gunicorn child_exit, or found dead by a later merge) its snapshot is folded into
+  METRICS_DIR/retired.json and deleted, so its counts stay, the directory does not grow
+  with worker restarts and a reused pid starts from a fresh file (delete the directory
+  to reset).
+- opt-in profiling: with ASSISTANT_PROFILE_DIR set, requests carrying "X-Profile: 1"
+  (or a random ASSISTANT_PROFILE_RATE share of them) are run under cProfile and dumped
+  there as .prof files (python -m pstats / snakeviz)
+"""
+
+logger = logging.getLogger(__name__)
+
+# ===== Config =====
+BASE = pathlib.Path(__file__).resolve().parents[1]
+METRICS_DIR = (os.getenv("ASSISTANT_METRICS_DIR") or "").strip() or str(BASE / "cache" / "metrics")  # "off": per process only
+METRICS_FLUSH_SECONDS = float(os.getenv("ASSISTANT_METRICS_FLUSH_SECONDS", "2"))
+PROFILE_DIR = os.getenv("ASSISTANT_PROFILE_DIR", "").strip()     # empty: profiling off
+PROFILE_RATE = float(os.getenv("ASSISTANT_PROFILE_RATE", "0"))   # 0..1 share of sampled requests
+PROFILE_HEADER = "X-Profile"
+RETIRED_FILE = "retired.json"  # folded snapshots of exited workers
+# ==================
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 40)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144)
+TOKEN_BUCKETS = (0, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+# name -> (type, help, buckets)
+METRICS = {
+    "assistant_requests_total": ("counter", "HTTP requests by view and status.", None),
+    "assistant_stage_seconds": ("histogram", "Time spent per pipeline stage.", SECONDS_BUCKETS),
+    "assistant_candidates": ("histogram", "Ranked paragraphs per prefilter run.", COUNT_BUCKETS),
+    "assistant_context_bytes": ("histogram", "Context bytes sent to the model.", BYTES_BUCKETS),
+    "assistant_context_tokens": ("histogram", "Context tokens sent to the model.", TOKEN_BUCKETS),
+    "assistant_context_tokens_saved": ("histogram", "Context tokens saved per request (dedup + trim + budget).", TOKEN_BUCKETS),
+    "assistant_context_fragments_dropped_total": ("counter", "Ranked fragments left out of the model context, by reason.", None),
+    "assistant_cache_lookups_total": ("counter", "Query/answer cache lookups by result.", None),
+    "assistant_upstream_calls_total": ("counter", "Model calls by outcome.", None),
+    "assistant_upstream_responses_total": ("counter", "Upstream HTTP responses by status (retries included).", None),
+    "assistant_upstream_retries_total": ("counter", "Upstream retries (async client).", None),
+    "assistant_upstream_tokens_total": ("counter", "Tokens reported by the model (usage).", None),
+    "assistant_index_reloads_total": ("counter", "Index generation swaps by outcome.", None),
+    "assistant_degraded_total": ("counter", "Local-only answers instead of the model, by reason.", None),
+    "assistant_admission_total": ("counter", "Model queue rejections (shed / queue_timeout).", None),
+    "assistant_breaker_transitions_total": ("counter", "Circuit breaker state changes.", None),
+    "assistant_singleflight_total": ("counter", "Coalesced model calls by role (leader/follower/shared_follower/timeout).", None),
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Registry:
+    """Per-process counters/histograms. Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, LabelKey], float] = {}
+        self.histograms: Dict[Tuple[str, LabelKey], list] = {}  # [bucket counts..., +Inf], sum
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    h[0][i] += 1
+                    break
+            else:
+                h[0][-1] += 1
+            h[1] += value
+
+    def reset(self):
+        """Forget everything (a forked worker: the master's warm-up is not its traffic)."""
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": [[n, dict(lk), v] for (n, lk), v in self.counters.items()],
+                "histograms": [[n, dict(lk), list(h[0]), h[1]] for (n, lk), h in self.histograms.items()],
+            }
+
+
+REGISTRY = Registry()
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+
+# --- per-request stage timings (Server-Timing) --------------------------------
+_TIMINGS: contextvars.ContextVar = contextvars.ContextVar("assistant_timings", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        observe("assistant_stage_seconds", elapsed, stage=name)
+        timings = _TIMINGS.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def record_usage(usage):
+    """Token counts from a completion response (resp.usage / last stream chunk)."""
+    if usage is None:
+        return
+    inc("assistant_upstream_tokens_total", getattr(usage, "prompt_tokens", 0) or 0, kind="prompt")
+    inc("assistant_upstream_tokens_total", getattr(usage, "completion_tokens", 0) or 0, kind="completion")
+
+
+def on_upstream_response(response):
+    """httpx event hook (sync clients): one count per HTTP attempt, so SDK retries show up."""
+    inc("assistant_upstream_responses_total", status=response.status_code)
+
+
+async def on_upstream_response_async(response):
+    on_upstream_response(response)
+
+
+def server_timing(timings: dict) -> str:
+    return ", ".join(f"{name};dur={secs * 1000:.1f}" for name, secs in timings.items())
+
+
+# --- cross-worker snapshots ---------------------------------------------------
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+_claimed_pid = None  # pid whose snapshot file this process has taken over
+
+
+def flush(force: bool = False):
+    """Write this worker's snapshot to METRICS_DIR/<pid>.json (tmp + rename)."""
+    global _last_flush, _claimed_pid
+    if METRICS_DIR.lower() == "off":
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < METRICS_FLUSH_SECONDS:
+        return
+    with _flush_lock:
+        _last_flush = now
+        if _claimed_pid != os.getpid():
+            retire(os.getpid())  # left by an earlier process with the same pid
+            _claimed_pid = os.getpid()
+        try:
+            directory = pathlib.Path(METRICS_DIR)
+            directory.mkdir(parents=True, exist_ok=True)
+            tmp = directory / f"{os.getpid()}.json.tmp"
+            tmp.write_text(json.dumps(REGISTRY.snapshot()), encoding="utf-8")
+            os.replace(tmp, directory / f"{os.getpid()}.json")
+        except OSError as e:
+            logger.warning("Metrics snapshot not written: %s", e)
+
+
+def _add(reg: Registry, snap: dict):
+    for name, labels, value in snap["counters"]:
+        reg.inc(name, value, **labels)
+    for name, labels, buckets, total in snap["histograms"]:
+        if name not in METRICS:
+            continue
+        key = (name, tuple(sorted(labels.items())))
+        h = reg.histograms.setdefault(key, [[0] * len(buckets), 0.0])
+        if len(h[0]) != len(buckets):
+            continue  # bucket layout changed between deploys
+        h[0] = [a + b for a, b in zip(h[0], buckets)]
+        h[1] += total
+
+
+def retire(pid: int):
+    """Fold the snapshot of exited process `pid` into RETIRED_FILE (gunicorn child_exit)."""
+    if METRICS_DIR.lower() == "off" or fcntl is None:
+        return
+    directory = pathlib.Path(METRICS_DIR)
+    path = directory / f"{pid}.json"
+    if not path.exists():
+        return
+    try:
+        with open(directory / f"{RETIRED_FILE}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # one read-modify-write of RETIRED_FILE at a time
+            try:
+                snap = json.loads(path.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                return  # another process folded it first
+            except ValueError:
+                snap = None
+            retired = Registry()
+            try:
+                _add(retired, json.loads((directory / RETIRED_FILE).read_text(encoding="utf-8")))
+            except FileNotFoundError:
+                pass
+            if snap is not None:
+                _add(retired, snap)
+                tmp = directory / f"{RETIRED_FILE}.tmp"
+                tmp.write_text(json.dumps(retired.snapshot()), encoding="utf-8")
+                os.replace(tmp, directory / RETIRED_FILE)
+            path.unlink()
+    except (OSError, ValueError) as e:
+        logger.warning("Metrics snapshot of %s not retired: %s", pid, e)
+
+
+def _merged() -> Registry:
+    merged = Registry()
+    snapshots = [REGISTRY.snapshot()]
+    if METRICS_DIR.lower() != "off":
+        from .generations import _alive
+
+        own = f"{os.getpid()}.json"
+        for p in pathlib.Path(METRICS_DIR).glob("*.json"):
+            if p.stem.isdigit() and p.name != own and not _alive(int(p.stem)):
+                retire(int(p.stem))  # exited without child_exit (runserver, killed master)
+        for p in sorted(pathlib.Path(METRICS_DIR).glob("*.json")):
+            if p.name == own:
+                continue
+            try:
+                snapshots.append(json.loads(p.read_text(encoding="utf-8")))
+            except (OSError, ValueError):
+                continue  # worker is just rewriting it
+    for snap in snapshots:
+        _add(merged, snap)
+    return merged
+
+
+def _fmt_labels(labels: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + body + "}"
+
+
+def render_prometheus() -> str:
+    """All workers' metrics in Prometheus text exposition format."""
+    flush(force=True)
+    reg = _merged()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (n, lk), v in sorted(reg.counters.items()):
+                if n == name:
+                    lines.append(f"{name}{_fmt_labels(lk)} {v:g}")
+            continue
+        for (n, lk), (counts, total) in sorted(reg.histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for le, c in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{_fmt_labels(lk, (('le', f'{le:g}' if le != '+Inf' else le),))} {cumulative}")
+            lines.append(f"{name}_sum{_fmt_labels(lk)} {total:.6f}")
+            lines.append(f"{name}_count{_fmt_labels(lk)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+# --- middleware ---------------------------------------------------------------
+def _want_profile(request) -> bool:
+    if not PROFILE_DIR:
+        return False
+    return request.headers.get(PROFILE_HEADER) == "1" or (PROFILE_RATE > 0 and random.random() < PROFILE_RATE)
+
+
+def _dump_profile(profiler: cProfile.Profile, request, elapsed: float):
+    try:
+        directory = pathlib.Path(PROFILE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        slug = request.path.strip("/").replace("/", "_") or "index"
+        profiler.dump_stats(directory / f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{slug}_{elapsed * 1000:.0f}ms.prof")
+    except OSError as e:
+        logger.warning("Profile not written: %s", e)
+
+
+def _finish(request, response, timings: dict, elapsed: float):
+    match = getattr(request, "resolver_match", None)
+    view = (match.url_name if match and match.url_name else None) or (match.view_name if match else "unmatched")
+    timings["total"] = elapsed
+    observe("assistant_stage_seconds", elapsed, stage="request")
+    inc("assistant_requests_total", view=view, status=response.status_code)
+    response["Server-Timing"] = server_timing(timings)
+    flush()
+
+
+def metrics_middleware(get_response):
+    """
+    Per-request stage timings -> Server-Timing header, request counter, optional cProfile.
+    Streaming bodies run after the headers are sent: their stages only reach the histograms.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            timings = {}
+            token = _TIMINGS.set(timings)
+            profiler = cProfile.Profile() if _want_profile(request) else None
+            t0 = time.perf_counter()
+            try:
+                if profiler:
+                    profiler.enable()
+                response = await get_response(request)
+            finally:
+                if profiler:
+                    profiler.disable()
+                _TIMINGS.reset(token)
+            elapsed = time.perf_counter() - t0
+            if profiler:
+                _dump_profile(profiler, request, elapsed)
+            _finish(request, response, timings, elapsed)
+            return response
+
+        markcoroutinefunction(middleware)
+    else:
+        def middleware(request):
+            timings = {}
+            token = _TIMINGS.set(timings)
+            profiler = cProfile.Profile() if _want_profile(request) else None
+            t0 = time.perf_counter()
+            try:
+                if profiler:
+                    profiler.enable()
+                response = get_response(request)
+            finally:
+                if profiler:
+                    profiler.disable()
+                _TIMINGS.reset(token)
+            elapsed = time.perf_counter() - t0
+            if profiler:
+                _dump_profile(profiler, request, elapsed)
+            _finish(request, response, timings, elapsed)
+            return response
+
+    return middleware
+
+
+metrics_middleware.sync_capable = True
+metrics_middleware.async_capable = True
@@ -0,0 +1,47 @@
+﻿# Generated by Django 5.1.1 on 2026-10-17 01:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=32)),
+                ('name', models.CharField(blank=True, max_length=300)),
+                ('name_norm', models.CharField(blank=True, max_length=300)),
+                ('price', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True)),
+                ('currency', models.CharField(blank=True, max_length=3)),
+                ('dimensions', models.CharField(blank=True, max_length=200)),
+                ('size_mm', models.FloatField(blank=True, null=True)),
+                ('source', models.CharField(max_length=200)),
+                ('pdf', models.CharField(blank=True, max_length=255)),
+                ('page', models.PositiveIntegerField()),
+                ('row', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ['source', 'page', 'id'],
+                'indexes': [models.Index(fields=['code'], name='product_code_idx'), models.Index(fields=['price'], name='product_price_idx'), models.Index(fields=['name_norm'], name='product_name_norm_idx'), models.Index(fields=['size_mm'], name='product_size_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=40)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='assistant.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'product'], name='product_term_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,59 @@
+﻿# assistant/minhash.py
+import zlib
+import heapq
+from array import array
+from typing import List, Sequence
+
+"""
+Bottom-k MinHash sketches of paragraphs (near-duplicate detection for the model context).
+
+- shingles: word 3-grams of the folded index tokens, so layout/diacritic differences
+  between catalog editions do not matter
+- sketch: the MINHASH_K smallest crc32 values of the shingles (one hash function, bottom-k
+  variant: C-speed at ingest, no per-permutation Python loop); shorter paragraphs are
+  padded with EMPTY
+- similarity(): Jaccard estimate from two sketches (share of the k smallest values of the
+  union present in both)
+- computed by search_index.py at build time for catalog paragraphs and stored next to the
+  index as minhash.bin (uint32, MINHASH_K per paragraph)
+"""
+
+MINHASH_K = 16
+SHINGLE_WORDS = 3
+EMPTY = 0xFFFFFFFF
+
+
+def sketch(tokens: Sequence[str]) -> List[int]:
+    if len(tokens) < SHINGLE_WORDS:
+        shingles = {" ".join(tokens)} if tokens else set()
+    else:
+        shingles = {" ".join(tokens[i:i + SHINGLE_WORDS]) for i in range(len(tokens) - SHINGLE_WORDS + 1)}
+    hashes = heapq.nsmallest(MINHASH_K, {zlib.crc32(s.encode("utf-8")) for s in shingles})
+    return hashes + [EMPTY] * (MINHASH_K - len(hashes))
+
+
+def empty_sketch() -> List[int]:
+    return [EMPTY] * MINHASH_K
+
+
+def similarity(a: Sequence[int], b: Sequence[int]) -> float:
+    sa, sb = {h for h in a if h != EMPTY}, {h for h in b if h != EMPTY}
+    if not sa or not sb:
+        return 0.0
+    union = heapq.nsmallest(MINHASH_K, sa | sb)
+    return sum(1 for h in union if h in sa and h in sb) / len(union)
+
+
+def write(path, sketches: array):
+    with open(path, "wb") as f:
+        sketches.tofile(f)
+
+
+def read(path, n_paragraphs: int) -> array:
+    """uint32 array of n_paragraphs * MINHASH_K values (ValueError on a size mismatch)."""
+    out = array("I")
+    with open(path, "rb") as f:
+        out.frombytes(f.read())
+    if len(out) != n_paragraphs * MINHASH_K:
+        raise ValueError("minhash.bin does not match the corpus")
+    return out
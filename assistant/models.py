@@ -0,0 +1,46 @@
+﻿# assistant/models.py
+from django.db import models
+
+"""
+Product rows extracted from the catalogs (ingest stage, products.py), queried by ask()
+for attribute questions ("cheie 13 mm sub 50 lei") before any text scoring / model call.
+Only what the catalog states is stored: price/currency stay empty when the page does not
+give them. ProductTerm is the word index of the folded names (products.name_terms), so a
+name word is an index lookup, not a LIKE scan.
+"""
+
+
+class Product(models.Model):
+    code = models.CharField(max_length=32)                   # normalized article code (search_index.normalize_code)
+    name = models.CharField(max_length=300, blank=True)
+    name_norm = models.CharField(max_length=300, blank=True)  # textnorm.fold(name)
+    price = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
+    currency = models.CharField(max_length=3, blank=True)    # RON / EUR / USD, only if the page says so
+    dimensions = models.CharField(max_length=200, blank=True)  # numeric cells of the row: " 13 170 "
+    size_mm = models.FloatField(null=True, blank=True)       # explicit "<n> mm" in the name/row
+    source = models.CharField(max_length=200)                # TXT base name (<source>_pNNN.txt)
+    pdf = models.CharField(max_length=255, blank=True)       # original PDF file name, when known
+    page = models.PositiveIntegerField()
+    row = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ["source", "page", "id"]
+        indexes = [
+            models.Index(fields=["code"], name="product_code_idx"),
+            models.Index(fields=["price"], name="product_price_idx"),
+            models.Index(fields=["name_norm"], name="product_name_norm_idx"),
+            models.Index(fields=["size_mm"], name="product_size_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.code} {self.name}".strip()
+
+
+class ProductTerm(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="terms")
+    term = models.CharField(max_length=40)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["term", "product"], name="product_term_idx"),
+        ]
@@ -0,0 +1,187 @@
+﻿# assistant/ocr.py
+import os
+import hashlib
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LTFigure, LTImage, LTTextContainer
+
+from assistant.page_render import render_page
+
+"""
+OCR fallback for (nearly) empty pages (ingest.py, OCR_EMPTY_PAGES=True; requires Tesseract).
+
+- pages are OCR'd on a process pool (one page per task, Tesseract limited to one thread)
+- only the raster regions of a page are OCR'd: pdfminer LTImage/LTFigure boxes that the
+  page's own text boxes do not already cover; a page with no text and no images at all
+  is OCR'd whole (outlined/vector text)
+- results are cached by content: sha256(rendered region pixels + lang + dpi)
+  => cache/ocr/<2 hex>/<sha256>.txt, so re-ingesting an updated catalog only OCRs
+  regions that actually changed
+"""
+
+# ===== Config =====
+OCR_LANG = os.getenv("OCR_LANG", "ron+eng")
+OCR_CACHE_DIR = pathlib.Path(os.getenv("OCR_CACHE_DIR", "") or pathlib.Path(__file__).resolve().parents[1] / "cache" / "ocr")
+OCR_MIN_REGION_PT = 36.0      # ignore images smaller than this (pt) in either direction (icons, bullets)
+OCR_COVERED_RATIO = 0.6       # skip an image whose area is this much covered by text boxes
+OCR_REGION_PAD_PX = 4
+# ==================
+
+Box = Tuple[float, float, float, float]
+
+
+def _area(b: Box) -> float:
+    return max(0.0, b[2] - b[0]) * max(0.0, b[3] - b[1])
+
+
+def _intersection(a: Box, b: Box) -> float:
+    return _area((max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])))
+
+
+def _walk_images(obj, out: List[Box]):
+    for child in obj:
+        if isinstance(child, LTImage):
+            out.append(child.bbox)
+        elif isinstance(child, LTFigure):
+            # a figure made only of images counts as one region; otherwise look inside
+            if child and all(isinstance(c, LTImage) for c in child):
+                out.append(child.bbox)
+            else:
+                _walk_images(child, out)
+
+
+def uncovered_regions(pdf_path: pathlib.Path, pno: int) -> Tuple[Box, List[Box]]:
+    """
+    (page bbox, [image regions to OCR]) in PDF points for page pno (1-based).
+    regions == [page bbox]: nothing on the page pdfminer can see, OCR it whole.
+    """
+    layout = next(extract_pages(str(pdf_path), page_numbers=[pno - 1]), None)
+    if layout is None:
+        return (0.0, 0.0, 0.0, 0.0), []
+
+    text_boxes = [el.bbox for el in layout if isinstance(el, LTTextContainer) and el.get_text().strip()]
+    images: List[Box] = []
+    _walk_images(layout, images)
+
+    if not images and not text_boxes:
+        return layout.bbox, [layout.bbox]
+
+    regions = []
+    for img in images:
+        if img[2] - img[0] < OCR_MIN_REGION_PT or img[3] - img[1] < OCR_MIN_REGION_PT:
+            continue
+        covered = sum(_intersection(img, t) for t in text_boxes)
+        if covered < OCR_COVERED_RATIO * _area(img):
+            regions.append(img)
+    # top to bottom, left to right (PDF y grows upwards)
+    regions.sort(key=lambda b: (-b[3], b[0]))
+    return layout.bbox, regions
+
+
+def _cache_path(key: str) -> pathlib.Path:
+    return OCR_CACHE_DIR / key[:2] / f"{key}.txt"
+
+
+def _region_key(img, dpi: int) -> str:
+    h = hashlib.sha256()
+    h.update(f"{img.mode}:{img.size[0]}x{img.size[1]}:{OCR_LANG}:{dpi}\n".encode("ascii"))
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+def _ocr_cached(img, dpi: int) -> Tuple[str, bool]:
+    """(text, cache hit)."""
+    key = _region_key(img, dpi)
+    path = _cache_path(key)
+    try:
+        return path.read_text(encoding="utf-8"), True
+    except FileNotFoundError:
+        pass
+
+    import pytesseract  # type: ignore
+    txt = pytesseract.image_to_string(img, lang=OCR_LANG) or ""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(txt, encoding="utf-8")
+    os.replace(tmp, path)
+    return txt, False
+
+
+def _ocr_page(task: Tuple[str, int, int]) -> Tuple[str, int, str, int, int]:
+    """Pool task: (pdf path, page no., dpi) -> (pdf path, page no., text, cache hits, misses)."""
+    pdf_path, pno, dpi = task
+    try:
+        page_box, regions = uncovered_regions(pathlib.Path(pdf_path), pno)
+    except Exception as e:
+        print(f"OCR layout error in {pathlib.Path(pdf_path).name} p{pno}:", e)
+        return pdf_path, pno, "", 0, 0
+    if not regions:
+        return pdf_path, pno, "", 0, 0
+
+    page = render_page(pathlib.Path(pdf_path), pno, dpi)
+    if page is None:
+        return pdf_path, pno, "", 0, 0
+
+    parts, hits, misses = [], 0, 0
+    try:
+        scale_x = page.width / max(1e-6, page_box[2] - page_box[0])
+        scale_y = page.height / max(1e-6, page_box[3] - page_box[1])
+        for x0, y0, x1, y1 in regions:
+            # PDF points (origin bottom-left) -> pixels (origin top-left)
+            crop_box = (
+                max(0, int((x0 - page_box[0]) * scale_x) - OCR_REGION_PAD_PX),
+                max(0, int((page_box[3] - y1) * scale_y) - OCR_REGION_PAD_PX),
+                min(page.width, int((x1 - page_box[0]) * scale_x) + OCR_REGION_PAD_PX),
+                min(page.height, int((page_box[3] - y0) * scale_y) + OCR_REGION_PAD_PX),
+            )
+            if crop_box[2] <= crop_box[0] or crop_box[3] <= crop_box[1]:
+                continue
+            region = page.crop(crop_box)
+            try:
+                txt, hit = _ocr_cached(region, dpi)
+            except Exception as e:
+                print(f"OCR skipped (tesseract not available?) {pathlib.Path(pdf_path).name} p{pno}:", e)
+                return pdf_path, pno, "", hits, misses
+            finally:
+                region.close()
+            hits += hit
+            misses += not hit
+            if txt.strip():
+                parts.append(txt.strip())
+    finally:
+        page.close()
+    return pdf_path, pno, "\n".join(parts), hits, misses
+
+
+def _init_worker():
+    # one Tesseract thread per process; the pool provides the parallelism
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+def ocr_pages(pages: List[Tuple[str, int]], dpi: int, workers: int) -> Dict[Tuple[str, int], str]:
+    """
+    OCR [(pdf path, page no.), ...] -> {(pdf name, page no.): text}.
+    Prints cache statistics; pages without raster content map to "".
+    """
+    tasks = [(str(pdf), pno, dpi) for pdf, pno in pages]
+    if not tasks:
+        return {}
+
+    out: Dict[Tuple[str, int], str] = {}
+    hits = misses = 0
+    if workers <= 1 or len(tasks) <= 1:
+        _init_worker()
+        results = map(_ocr_page, tasks)
+        for pdf_path, pno, txt, h, m in results:
+            out[(pathlib.Path(pdf_path).name, pno)] = txt
+            hits, misses = hits + h, misses + m
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            for pdf_path, pno, txt, h, m in pool.map(_ocr_page, tasks):
+                out[(pathlib.Path(pdf_path).name, pno)] = txt
+                hits, misses = hits + h, misses + m
+    print(f"OCR: {len(tasks)} pages, {hits + misses} regions ({hits} cached, {misses} recognized)")
+    return out
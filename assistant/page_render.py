@@ -0,0 +1,139 @@
+﻿# assistant/page_render.py
+import os
+import re
+import pathlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Sequence, Tuple
+
+"""
+Bounded-memory page previews for static/page_images (ingest.py, GENERATE_IMAGES=True).
+
+- pdftoppm (pdf2image, Poppler) renders RENDER_WINDOW pages at a time (first_page/last_page)
+  into a temp dir (paths_only): never the whole PDF as PIL images in RAM
+- each page -> thumbnails at THUMB_WIDTHS in THUMB_FORMAT (webp/jpeg):
+  static/page_images/<source>_pNNN_w<width>.<ext>; the image is closed and the
+  temp file deleted before the next page
+- windows run on a process pool; ingest skips PDFs whose sha256 already has previews
+- render_page(): one page as a PIL image (OCR fallback)
+"""
+
+# ===== Config =====
+RENDER_DPI = int(os.getenv("RENDER_DPI", "150"))           # thumbnails are downscaled anyway
+RENDER_WINDOW = int(os.getenv("RENDER_WINDOW", "8"))       # pages per pdftoppm call
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(max(1, (os.cpu_count() or 1) // 2))))
+THUMB_WIDTHS = (320, 800, 1600)                            # px; small = inline preview, large = click-through
+THUMB_FORMAT = os.getenv("THUMB_FORMAT", "webp").strip().lower()  # webp | jpeg
+THUMB_QUALITY = int(os.getenv("THUMB_QUALITY", "78"))
+# ==================
+
+BASE = pathlib.Path(__file__).resolve().parents[1]
+IMG_DIR = BASE / "static" / "page_images"
+EXTENSIONS = {"webp": "webp", "jpeg": "jpg"}
+_PAGE_FILE_RE = re.compile(r"-(\d+)\.\w+$")  # pdftoppm: <prefix>-<page>.ppm
+
+
+def thumb_name(stem: str, width: int, fmt: str = THUMB_FORMAT) -> str:
+    """'<source>_pNNN' -> '<source>_pNNN_w<width>.<ext>'."""
+    return f"{stem}_w{width}.{EXTENSIONS.get(fmt, fmt)}"
+
+
+def signature(digest: str) -> dict:
+    """What the manifest stores per PDF; previews are re-rendered when any of it changes."""
+    return {"sha256": digest, "dpi": RENDER_DPI, "widths": list(THUMB_WIDTHS), "format": THUMB_FORMAT}
+
+
+def _save_thumbnails(img, stem: str, out_dir: pathlib.Path, widths: Sequence[int], fmt: str, quality: int):
+    from PIL import Image
+
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    # webp method 2: ~2x faster than the default 4 for a few % larger files
+    options = {"quality": quality, "method": 2} if fmt == "webp" else {"quality": quality, "optimize": True,
+                                                                      "progressive": True}
+    # largest first, each size downscaled from the previous one (cheaper than from the full page)
+    src = img
+    for width in sorted(widths, reverse=True):
+        thumb = src
+        if src.width > width:
+            thumb = src.resize((width, max(1, round(src.height * width / src.width))),
+                               resample=Image.LANCZOS, reducing_gap=2.0)
+        target = out_dir / thumb_name(stem, width, fmt)
+        tmp = target.with_name(target.name + ".tmp")
+        thumb.save(tmp, format=fmt.upper(), **options)
+        os.replace(tmp, target)
+        if src is not img and src is not thumb:
+            src.close()
+        src = thumb
+    if src is not img:
+        src.close()
+
+
+def _render_window(task: Tuple[str, str, int, int, str]) -> int:
+    """Pool task: pages [first, last] (1-based, inclusive) of one PDF -> thumbnails. Returns pages done."""
+    pdf_path, base, first, last, out_dir = task
+    from pdf2image import convert_from_path  # type: ignore
+    from PIL import Image
+
+    done = 0
+    with tempfile.TemporaryDirectory(prefix="render_") as tmp:
+        paths = convert_from_path(pdf_path, dpi=RENDER_DPI, first_page=first, last_page=last,
+                                  output_folder=tmp, paths_only=True, fmt="ppm", thread_count=1)
+        for path in paths:
+            m = _PAGE_FILE_RE.search(path)
+            if not m:
+                continue
+            with Image.open(path) as img:
+                _save_thumbnails(img, f"{base}_p{int(m.group(1)):03d}", pathlib.Path(out_dir),
+                                 THUMB_WIDTHS, THUMB_FORMAT, THUMB_QUALITY)
+            os.unlink(path)
+            done += 1
+    return done
+
+
+def render_pdf(pdf_path: pathlib.Path, base: str, num_pages: int, out_dir: pathlib.Path = IMG_DIR,
+               workers: int = RENDER_WORKERS) -> int:
+    """Thumbnails for every page of one PDF, window by window. Returns the number of pages rendered."""
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tasks = [(str(pdf_path), base, first, min(first + RENDER_WINDOW - 1, num_pages), str(out_dir))
+             for first in range(1, num_pages + 1, RENDER_WINDOW)]
+
+    try:
+        if workers <= 1 or len(tasks) <= 1:
+            return sum(map(_render_window, tasks))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return sum(pool.map(_render_window, tasks))
+    except Exception as e:
+        print(f"Image generation skipped for {pathlib.Path(pdf_path).name}: pdf2image/Poppler error:", e)
+        return 0
+
+
+def remove_previews(base: str, keep_pages: int = 0, out_dir: pathlib.Path = IMG_DIR) -> int:
+    """Delete thumbnails of pages > keep_pages (keep_pages=0: every page of that source)."""
+    removed = 0
+    pattern = re.compile(rf"^{re.escape(base)}_p(\d+)_w\d+\.\w+$")
+    for path in pathlib.Path(out_dir).glob(f"{base}_p*_w*.*"):
+        m = pattern.match(path.name)
+        if m and int(m.group(1)) > keep_pages:
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+
+def render_page(pdf_path: pathlib.Path, pno: int, dpi: int):
+    """One page (1-based) as a PIL image, or None. Caller closes it."""
+    try:
+        from pdf2image import convert_from_path  # type: ignore
+        images = convert_from_path(str(pdf_path), dpi=dpi, first_page=pno, last_page=pno, thread_count=1)
+        return images[0] if images else None
+    except Exception as e:
+        print(f"Page render failed ({pathlib.Path(pdf_path).name} p{pno}):", e)
+        return None
+
+
+def preview_urls(stem: str, static_url: str = "/static/", out_dir: pathlib.Path = IMG_DIR) -> Optional[Dict[int, str]]:
+    """{width: URL} for '<source>_pNNN' if its thumbnails exist, else None."""
+    if not (pathlib.Path(out_dir) / thumb_name(stem, THUMB_WIDTHS[0])).exists():
+        return None
+    return {w: f"{static_url}page_images/{thumb_name(stem, w)}" for w in THUMB_WIDTHS}
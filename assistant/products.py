@@ -0,0 +1,354 @@
+﻿# assistant/products.py
+import os
+import re
+import logging
+from decimal import Decimal, InvalidOperation
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from .search_index import PAGE_HEADER_RE, KnowledgeIndex, line_codes, normalize_code
+from .textnorm import fold
+
+"""
+Structured product store (models.Product) built from the catalog rows the index already found.
+
+Ingest stage (ingest.py step 4, or python manage.py rebuild_products):
+- one product per article-code hit of the code table (search_index: code -> page, row)
+- name: the title block of the page the code belongs to (the text lines right above a
+  "• ..." bullet list): the block a code line opens (KRONUS layout, direct title), else
+  the nearest block before it on the same page (inherited). A code that has a direct
+  title on any page takes that one; inherited titles that differ between the pages of a
+  code are dropped (text of another page leaks into some PDF pages). No title -> empty
+  name, nothing is guessed
+- price: the last "123.45" / "1 234,50" number of the row; currency only when the page, or
+  else another page of the same catalog, states it ("Preturile sunt exprimate in lei",
+  "Lista de preturi in lei", "Preţ/Lei"); otherwise left empty
+- dimensions: the size cells of the row. Series ("1,5-13,0 mm", "3 - 19 / 10",
+  "4,0 / 5,0 / 6,0 mm": a capacity or the contents of a set), piece counts ("6 piese"),
+  the packaging unit cell "1" and cells >= DIMENSION_MAX_MM (lengths, weights) are no
+  sizes; when the row has "a x b" sizes only those count
+- size_mm: one explicit "<n> mm" of the name/row that is not part of a series or an
+  "a x b" product
+
+Query path (views._local_answer, before any text scoring or model call):
+parse_query("cheie 13 mm sub 50 lei") -> name words + size + price bounds (+ currency),
+search() -> one indexed SQL query (name words via ProductTerm, price/size indexes).
+It answers only when the match is unambiguous, otherwise [] and the text path runs:
+the name must start with a query word (the product type: "cheie ..." and not "Mandrina
+cu cheie"), and a price bound needs every matching product to have a price.
+"""
+
+logger = logging.getLogger(__name__)
+
+# ===== Config =====
+PRODUCT_TITLE_MAX_LINES = 3                                   # lines of a title block
+DIMENSION_MAX_MM = 100                                        # larger row cells are lengths / weights
+PRODUCT_QUERY_LIMIT = int(os.getenv("PRODUCT_QUERY_LIMIT", "12"))
+# ==================
+
+PRICE_RE = re.compile(r"(?<![\d.,])(\d{1,3}(?:[ .]\d{3})+|\d+)[.,](\d{2})(?![\d.,])(?!\s*mm)")
+NUMBER_RE = re.compile(r"(?<![\w.,/-])\d+(?:[.,]\d+)?(?![\w.,/-])")
+MM_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*mm\b", re.I)
+_NUM = r"\d+(?:[.,]\d+)?"
+# "1,5-13,0 mm", "3 - 19 / 10", "4,0 / 5,0 / 6,0 mm", "2, 3, 4, 5", "1,0-10,0 mm x 0,5 mm"
+SERIES_RE = re.compile(rf"(?<![\d.,]){_NUM}(?:\s*mm)?(?:(?:\s*[-–/]\s*|,\s+)Ø?\s*{_NUM}(?![\w.,]))+(?:\s*mm\b)?"
+                       rf"(?:\s*x\s*{_NUM}\s*mm\b)?", re.I)
+SIZE_PRODUCT_RE = re.compile(rf"(?<![\w.,]){_NUM}(?:\s*[x×]\s*{_NUM})+(?![\w.,])", re.I)   # "10 x 13"
+COUNT_RE = re.compile(r"(?<![\w.,])\d+\s*(?:piese|bucati|buc|pcs)\b\.?", re.I)
+CURRENCIES = {"lei": "RON", "ron": "RON", "eur": "EUR", "euro": "EUR", "usd": "USD"}
+# on folded page text: "preturile sunt exprimate in lei", "pret (eur)", "price list in euro"
+PAGE_CURRENCY_RE = re.compile(r"\b(?:pret|price)[^\n]{0,60}?\b(lei|ron|eur|euro|usd)\b")
+
+QUERY_SIZE_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*mm\b")
+QUERY_MAX_PRICE_RE = re.compile(r"(?:\b(?:sub|maxim|max|pana la)|<=?)\s*(\d+(?:[.,]\d+)?)\s*(lei|ron|eur|euro|usd)?\b")
+QUERY_MIN_PRICE_RE = re.compile(r"(?:\b(?:peste|minim|min|de la)|>=?)\s*(\d+(?:[.,]\d+)?)\s*(lei|ron|eur|euro|usd)?\b")
+QUERY_WORD_RE = re.compile(r"[a-z]{3,}")
+QUERY_STOPWORDS = {
+    "caut", "cauta", "vreau", "arata", "aveti", "care", "sunt", "este", "pentru", "din", "mai",
+    "pret", "pretul", "preturi", "lei", "ron", "eur", "euro", "usd", "ieftin", "ieftina",
+}
+
+
+# ----------------------- extraction -----------------------
+def _to_decimal(s: str) -> Optional[Decimal]:
+    try:
+        return Decimal(s.replace(",", "."))
+    except InvalidOperation:
+        return None
+
+
+def _number_key(s: str) -> str:
+    """'13', '13,0', '13.00' -> '13' (what dimensions store and queries compare)."""
+    d = _to_decimal(s)
+    return format(d.normalize(), "f") if d is not None else s
+
+
+def _is_title_line(ln: str) -> bool:
+    return (not ln.startswith("•") and len(ln.split()) >= 2 and sum(ch.isalpha() for ch in ln) >= 6
+            and not line_codes(ln))
+
+
+def _opened_title(lines: List[str], i: int) -> str:
+    """KRONUS layout: a bare code line opens the block ("7187HHXP7" / "Set capete ..." / "• ...")."""
+    j = k = i + 1
+    if {normalize_code(c) for c in line_codes(lines[i])} != {normalize_code(lines[i])}:
+        return ""  # a table row: what follows is the next product
+    if j >= len(lines) or not _is_title_line(lines[j]) or not lines[j][0].isupper():
+        return ""
+    # the title may wrap onto a spec line ("Mandrina cu cheie 1,5-13,0 mm" / "1/2\"-20UNF")
+    while k < len(lines) and k - j < PRODUCT_TITLE_MAX_LINES and not lines[k].startswith("•") and not line_codes(lines[k]):
+        k += 1
+    return " ".join(lines[j:k]) if k < len(lines) and lines[k].startswith("•") else ""
+
+
+def page_titles(raw: str) -> Dict[str, Tuple[str, bool]]:
+    """normalized code -> (product title, direct?) on one page (see module docstring)."""
+    lines = [ln.strip() for ln in raw.splitlines() if ln.strip() and not PAGE_HEADER_RE.match(ln.strip())]
+    titles = []  # (first line index, title)
+    for i, ln in enumerate(lines):
+        if not ln.startswith("•") or (i and lines[i - 1].startswith("•")):
+            continue
+        j = i
+        while j > 0 and i - j < PRODUCT_TITLE_MAX_LINES and _is_title_line(lines[j - 1]):
+            j -= 1
+        # a block starting in lower case is the wrapped tail of the previous bullet
+        if j < i and lines[j][0].isupper():
+            titles.append((j, " ".join(lines[j:i])))
+
+    out: Dict[str, str] = {}
+    for i, ln in enumerate(lines):
+        codes = line_codes(ln)
+        if not codes:
+            continue
+        title, direct = _opened_title(lines, i), True
+        if not title:
+            before = [t for start, t in titles if start < i]
+            title, direct = (before[-1] if before else ""), False
+        for code in codes:
+            key = normalize_code(code)
+            if key not in out or (direct and not out[key][1]):
+                out[key] = (title, direct)
+    return out
+
+
+def resolve_titles(pages: List[Dict[str, Tuple[str, bool]]]) -> Dict[str, str]:
+    """code -> the title every page of it may use: its first direct title, else the inherited one all pages agree on."""
+    direct: Dict[str, str] = {}
+    inherited: Dict[str, set] = {}
+    for titles in pages:
+        for code, (title, is_direct) in titles.items():
+            if not title:
+                continue
+            if is_direct:
+                direct.setdefault(code, title)
+            else:
+                inherited.setdefault(code, set()).add(title)
+    out = {code: next(iter(ts)) for code, ts in inherited.items() if len(ts) == 1}
+    out.update(direct)
+    return out
+
+
+def term_key(word: str) -> str:
+    """Light stemming shared by the name index and queries: cheie/chei, clesti/cleste."""
+    return word[:-1] if len(word) > 4 else word
+
+
+def name_terms(name_norm: str) -> List[str]:
+    return sorted({term_key(w)[:40] for w in QUERY_WORD_RE.findall(name_norm)})
+
+
+def page_currency(raw: str) -> str:
+    m = PAGE_CURRENCY_RE.search(fold(raw))
+    return CURRENCIES[m.group(1)] if m else ""
+
+
+def size_mm(text: str) -> Optional[float]:
+    """The one explicit "<n> mm" of a text outside series / "a x b" products, else None."""
+    sizes = {_number_key(m.group(1)) for m in MM_RE.finditer(SIZE_PRODUCT_RE.sub(" ", SERIES_RE.sub(" ", text)))}
+    return float(_to_decimal(sizes.pop())) if len(sizes) == 1 else None
+
+
+def _is_size_cell(number: str) -> bool:
+    value = _to_decimal(number)
+    return value is not None and number != "1" and value < DIMENSION_MAX_MM
+
+
+def parse_row(code: str, row: str) -> dict:
+    """price / dimensions / size_mm of one code row (the code itself is not a dimension)."""
+    cells = [c for c in row.split(" | ")]
+    rest = " | ".join(c.replace(code, " ") if normalize_code(c) != code else "" for c in cells)
+    price = None
+    prices = PRICE_RE.findall(rest)
+    if prices:
+        whole, cents = prices[-1]
+        price = _to_decimal(re.sub(r"[ .]", "", whole) + "." + cents)
+        rest = PRICE_RE.sub(" ", rest)
+    rest = SERIES_RE.sub(" ", COUNT_RE.sub(" ", rest))
+    pairs = SIZE_PRODUCT_RE.findall(rest)
+    if pairs:
+        numbers = [n for pair in pairs for n in re.findall(_NUM, pair)]
+    else:
+        numbers = [n for n in NUMBER_RE.findall(rest) if _is_size_cell(n)]
+    return {
+        "price": price,
+        "dimensions": (" " + " ".join(_number_key(n) for n in numbers) + " ") if numbers else "",
+        "size_mm": size_mm(row),
+    }
+
+
+def _page_text(kb: KnowledgeIndex, file_idx: int) -> str:
+    path = kb.txt_dir / kb.files[file_idx]
+    try:
+        return path.read_text(encoding="utf-8", errors="ignore")
+    except OSError:
+        # no TXT export: the page's paragraphs from the packed corpus
+        return "\n\n".join(kb.text(pid) for pid in kb.paragraphs.file_paragraphs(file_idx))
+
+
+def extract_products(kb: KnowledgeIndex, pdf_names: Optional[Dict[str, str]] = None) -> list:
+    """Unsaved Product objects for every code hit of the index. pdf_names: source -> PDF file name."""
+    from .models import Product  # Django must be set up (see rebuild)
+
+    by_file: Dict[int, list] = {}
+    for code, hits in kb.codes.items():
+        for file_idx, page, row in hits:
+            by_file.setdefault(file_idx, []).append((code, page, row))
+
+    # a catalog states its price currency once (cover / price-list page) or per page
+    page_currencies: Dict[int, str] = {}
+    source_currency: Dict[str, str] = {}
+    for file_idx, name in enumerate(kb.files):
+        cur = page_currencies[file_idx] = page_currency(_page_text(kb, file_idx))
+        if cur:
+            source_currency.setdefault(name.rsplit("_p", 1)[0], cur)
+
+    titles = resolve_titles([page_titles(_page_text(kb, file_idx)) for file_idx in sorted(by_file)])
+
+    products = []
+    for file_idx in sorted(by_file):
+        source = kb.files[file_idx].rsplit("_p", 1)[0]
+        currency = page_currencies[file_idx] or source_currency.get(source, "")
+        for code, page, row in by_file[file_idx]:
+            name = titles.get(code, "")[:300]
+            fields = parse_row(code, row)
+            if fields["size_mm"] is None and name:
+                fields["size_mm"] = size_mm(name)
+            products.append(Product(
+                code=code[:32], name=name, name_norm=fold(name), price=fields["price"],
+                currency=currency if fields["price"] is not None else "",
+                dimensions=fields["dimensions"][:200], size_mm=fields["size_mm"],
+                source=source[:200], pdf=(pdf_names or {}).get(source, "")[:255], page=page, row=row,
+            ))
+    return products
+
+
+def rebuild(kb: KnowledgeIndex, pdf_names: Optional[Dict[str, str]] = None) -> int:
+    """
+    Replace the product table with the rows of `kb` (one transaction). Returns the row count.
+    Works from a plain script too: Django is set up on demand.
+    """
+    from django.conf import settings
+    if not settings.configured:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "kiosk_site.settings")
+        import django
+        django.setup()
+    from django.db import transaction
+    from .models import Product, ProductTerm
+
+    products = extract_products(kb, pdf_names)
+    with transaction.atomic():
+        ProductTerm.objects.all().delete()
+        Product.objects.all().delete()
+        Product.objects.bulk_create(products, batch_size=1000)  # sqlite: primary keys are set
+        ProductTerm.objects.bulk_create(
+            (ProductTerm(product_id=p.pk, term=t) for p in products for t in name_terms(p.name_norm)),
+            batch_size=5000,
+        )
+    return len(products)
+
+
+# ----------------------- query -----------------------
+class ProductQuery(NamedTuple):
+    words: List[str]
+    size_mm: Optional[float]
+    min_price: Optional[Decimal]
+    max_price: Optional[Decimal]
+    currency: str
+
+
+def parse_query(text: str) -> Optional[ProductQuery]:
+    """
+    Attribute query = product words + at least one of size ("13 mm") / price bound
+    ("sub 50 lei", "peste 100"). Anything else -> None (normal text path).
+    """
+    q = fold(text)
+    size = min_price = max_price = None
+    currency = ""
+
+    m = QUERY_SIZE_RE.search(q)
+    if m:
+        size = float(_to_decimal(m.group(1)))
+        q = q[:m.start()] + " " + q[m.end():]
+    for regex in (QUERY_MAX_PRICE_RE, QUERY_MIN_PRICE_RE):
+        m = regex.search(q)
+        if not m:
+            continue
+        value = _to_decimal(m.group(1))
+        if regex is QUERY_MAX_PRICE_RE:
+            max_price = value
+        else:
+            min_price = value
+        currency = currency or CURRENCIES.get(m.group(2) or "", "")
+        q = q[:m.start()] + " " + q[m.end():]
+
+    words = [w for w in QUERY_WORD_RE.findall(q) if w not in QUERY_STOPWORDS]
+    if not words or (size is None and min_price is None and max_price is None):
+        return None
+    return ProductQuery(words, size, min_price, max_price, currency)
+
+
+def search(pq: ProductQuery, limit: int = PRODUCT_QUERY_LIMIT, sources: Optional[List[str]] = None) -> list:
+    """
+    Products whose name starts with a query word, has every query word (term_key) and is
+    within the size/price bounds, cheapest first. sources: only these catalogs (TXT base
+    names, ask/ "source" filter). [] when a price bound is asked but some of the matching
+    products have no price: the answer would be incomplete, the text path answers.
+    """
+    from django.db import DatabaseError
+    from django.db.models import F, Q
+    from .models import Product, ProductTerm
+
+    qs = Product.objects.all()
+    for w in pq.words:
+        qs = qs.filter(id__in=ProductTerm.objects.filter(term=term_key(w)).values("product_id"))
+    head = Q()
+    for w in pq.words:
+        head |= Q(name_norm__startswith=term_key(w))
+    qs = qs.filter(head)
+    if sources is not None:
+        qs = qs.filter(source__in=sources)
+    if pq.size_mm is not None:
+        qs = qs.filter(Q(size_mm=pq.size_mm) | Q(dimensions__contains=f" {_number_key(str(pq.size_mm))} "))
+    priced = pq.max_price is not None or pq.min_price is not None
+    unpriced = qs.filter(price__isnull=True)
+    if pq.max_price is not None:
+        qs = qs.filter(price__lte=pq.max_price)
+    if pq.min_price is not None:
+        qs = qs.filter(price__gte=pq.min_price)
+    if pq.currency and priced:
+        qs = qs.filter(currency=pq.currency)  # a price without a stated currency is not comparable
+    try:
+        if priced and unpriced.exists():
+            return []
+        rows = qs.order_by(F("price").asc(nulls_last=True), "source", "page", "id")[:limit * 2]
+        out, seen = [], set()
+        for p in rows:
+            # the same code can sit in two rows of one page (name row + price row)
+            key = (p.code, p.source, p.page, p.price)
+            if key not in seen:
+                seen.add(key)
+                out.append(p)
+        return out[:limit]
+    except DatabaseError as e:
+        # no migrate yet / table missing: the text path answers instead
+        logger.warning("Product query skipped: %s", e)
+        return []
@@ -0,0 +1,246 @@
+﻿# assistant/ranking.py
+import os
+import time
+import threading
+import weakref
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .search_index import FLAG_CATALOG, FLAG_CODE, FLAG_PRICE, KnowledgeIndex
+
+"""
+Pluggable paragraph ranking over the KnowledgeIndex.
+
+- every ranker sees the same gated candidates (>= min_overlap distinct query tokens AND a
+  catalog keyword), so switching rankers never widens what may reach the model
+- query tokens arrive expanded (KnowledgeIndex.expand): token -> [(term, weight), ...];
+  a misspelled token counts through its nearest vocabulary terms, scaled by similarity
+- "bm25"    : Okapi BM25 with the lengths/IDF precomputed by ingest + catalog boosts
+- "overlap" : the original set-overlap score (+1 for Preț/Price), kept for comparison
+- select with env RANKER=bm25|overlap (default: bm25)
+- rank_batch(): many queries in one term-at-a-time pass (ask/batch/), same results as rank()
+"""
+
+# ===== Config =====
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+PRICE_BOOST = float(os.getenv("RANK_PRICE_BOOST", "1.0"))   # paragraph mentions Preț/Price
+CODE_BOOST = float(os.getenv("RANK_CODE_BOOST", "0.5"))     # paragraph contains an article code
+MIN_SCORE_RATIO = float(os.getenv("RANK_MIN_SCORE_RATIO", "0.6"))  # keep score >= ratio * best
+# ==================
+
+
+class Ranker:
+    name = ""
+
+    def score(self, kb: KnowledgeIndex, q_terms: Dict[str, List[Tuple[str, float]]],
+              candidates: Iterable[int]) -> Dict[int, float]:
+        raise NotImplementedError
+
+
+class OverlapRanker(Ranker):
+    """Legacy score: number of shared tokens, +1 when the paragraph mentions a price."""
+    name = "overlap"
+
+    def score(self, kb, q_terms, candidates):
+        overlap = kb.overlap(q_terms)
+        return {
+            para_id: overlap.get(para_id, 0) + (1 if kb.flags(para_id) & FLAG_PRICE else 0)
+            for para_id in candidates
+        }
+
+
+class BM25Ranker(Ranker):
+    """Okapi BM25 over paragraph units plus additive boosts for price / product-code paragraphs."""
+    name = "bm25"
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B,
+                 price_boost: float = PRICE_BOOST, code_boost: float = CODE_BOOST):
+        self.k1 = k1
+        self.b = b
+        self.price_boost = price_boost
+        self.code_boost = code_boost
+        # index or shard -> (per-paragraph length norm, per-paragraph flags), from kb.para_range.start
+        self._stats: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _paragraph_stats(self, kb) -> Tuple[List[float], List[int]]:
+        """
+        Length norms k1 * (1 - b + b * len / avgdl) and flags, computed once per loaded index
+        (or shard, with its own avgdl); position i is paragraph kb.para_range.start + i.
+        """
+        stats = self._stats.get(kb)
+        if stats is None:
+            avgdl = kb.avgdl or 1.0
+            ids = kb.para_range
+            stats = ([self.k1 * (1.0 - self.b + self.b * kb.lengths[pid] / avgdl) for pid in ids],
+                     [kb.flags(pid) for pid in ids])
+            with self._lock:
+                self._stats[kb] = stats
+        return stats
+
+    def boost(self, flags: int) -> float:
+        return (self.price_boost if flags & FLAG_PRICE else 0.0) + (self.code_boost if flags & FLAG_CODE else 0.0)
+
+    def score(self, kb, q_terms, candidates):
+        wanted = set(candidates)
+        out = {para_id: 0.0 for para_id in wanted}
+        norms, _flags = self._paragraph_stats(kb)
+        base = kb.para_range.start
+        for terms in q_terms.values():
+            # one query token contributes once: its best-scoring term in the paragraph
+            best: Dict[int, float] = {}
+            for term, weight in terms:
+                idf = kb.idf.get(term)
+                if idf is None:
+                    continue
+                for para_id, tf in kb.postings[term]:
+                    if para_id not in wanted:
+                        continue
+                    sc = weight * idf * tf * (self.k1 + 1.0) / (tf + norms[para_id - base])
+                    if sc > best.get(para_id, 0.0):
+                        best[para_id] = sc
+            for para_id, sc in best.items():
+                out[para_id] += sc
+
+        for para_id in wanted:
+            out[para_id] += self.boost(kb.flags(para_id))
+        return out
+
+
+RANKERS = {
+    OverlapRanker.name: OverlapRanker,
+    BM25Ranker.name: BM25Ranker,
+}
+
+
+def get_ranker(name: Optional[str] = None) -> Ranker:
+    name = (name or os.getenv("RANKER", "bm25") or "bm25").strip().lower()
+    return RANKERS.get(name, BM25Ranker)()
+
+
+def warm(kb: KnowledgeIndex, ranker: Ranker):
+    """Per-index statistics of `ranker`, computed before the index serves (views._warm_index)."""
+    if isinstance(ranker, BM25Ranker):
+        ranker._paragraph_stats(kb)
+
+
+def rank(kb: KnowledgeIndex, q_tokens: Iterable[str], ranker: Ranker, min_overlap: int,
+         top_k: int = 40, min_score_ratio: float = MIN_SCORE_RATIO) -> List[Tuple[float, int]]:
+    """
+    Expand the query tokens (exact + trigram neighbours), gate by overlap + catalog keyword,
+    score with `ranker`, then cut by score:
+    only fragments scoring >= min_score_ratio * best survive (top_k is a hard upper bound).
+    Returns [(score, para_id), ...] best first.
+    """
+    return rank_terms(kb, kb.expand(q_tokens), ranker, min_overlap, top_k, min_score_ratio)
+
+
+def rank_terms(kb: KnowledgeIndex, q_terms: Dict[str, List[Tuple[str, float]]], ranker: Ranker, min_overlap: int,
+               top_k: int = 40, min_score_ratio: float = MIN_SCORE_RATIO) -> List[Tuple[float, int]]:
+    """rank() on already expanded query terms (shards.py expands once for all shards)."""
+    candidates = [
+        para_id for para_id, overlap in kb.overlap(q_terms).items()
+        if overlap >= min_overlap and kb.flags(para_id) & FLAG_CATALOG
+    ]
+    if not candidates:
+        return []
+
+    return _cut(ranker.score(kb, q_terms, candidates), top_k, min_score_ratio)
+
+
+def explain(kb: KnowledgeIndex, q_tokens: Iterable[str], ranker: Ranker, min_overlap: int,
+            top_k: int = 40, min_score_ratio: float = MIN_SCORE_RATIO,
+            q_terms: Optional[Dict[str, List[Tuple[str, float]]]] = None) -> dict:
+    """
+    rank() stage by stage, for debug/preview/: the expanded terms, how many paragraphs each
+    gate let through, the wall time of every stage (ms) and [(score, para_id, overlap), ...]
+    of the survivors. Same result as rank(), no caching. q_terms: already expanded (shards).
+    """
+    timings: Dict[str, float] = {}
+    t = time.perf_counter()
+
+    def lap(stage: str):
+        nonlocal t
+        now = time.perf_counter()
+        timings[stage] = round((now - t) * 1000, 3)
+        t = now
+
+    if q_terms is None:
+        q_terms = kb.expand(q_tokens)
+    lap("expand")
+    overlap = kb.overlap(q_terms)
+    lap("overlap")
+    candidates = [pid for pid, n in overlap.items() if n >= min_overlap and kb.flags(pid) & FLAG_CATALOG]
+    lap("gate")
+    scores = ranker.score(kb, q_terms, candidates) if candidates else {}
+    lap("score")
+    ranked = _cut(scores, top_k, min_score_ratio)
+    lap("cut")
+    return {
+        "terms": {term: [[v, round(w, 3)] for v, w in variants] for term, variants in q_terms.items()},
+        "matched": len(overlap),
+        "candidates": len(candidates),
+        "scored": len(scores),
+        "timings_ms": timings,
+        "ranked": [(sc, pid, overlap[pid]) for sc, pid in ranked],
+    }
+
+
+def _cut(scores: Dict[int, float], top_k: int, min_score_ratio: float) -> List[Tuple[float, int]]:
+    if not scores:
+        return []
+    ranked = sorted(((sc, para_id) for para_id, sc in scores.items()), key=lambda t: (-t[0], t[1]))
+    best = ranked[0][0]
+    cutoff = best * min_score_ratio if best > 0 else 0.0
+    return [(sc, para_id) for sc, para_id in ranked[:top_k] if sc >= cutoff]
+
+
+def rank_batch(kb: KnowledgeIndex, queries: List[Iterable[str]], ranker: Ranker, min_overlap: int,
+               top_k: int = 40, min_score_ratio: float = MIN_SCORE_RATIO) -> List[List[Tuple[float, int]]]:
+    """
+    rank() for many token sets at once (order lists). The expanded terms of all queries are
+    merged and each posting list is turned into one sparse row of BM25 weights over the
+    catalog paragraphs (term -> {para_id: weight}, precomputed length norms) once per batch;
+    every query then counts overlap over those rows (Counter.update, C speed) and sums
+    weights only for its gated candidates. Gate, scores and cut are exactly rank()'s with a BM25Ranker;
+    other rankers fall back to rank() per query.
+    """
+    if not isinstance(ranker, BM25Ranker):
+        return [rank(kb, q, ranker, min_overlap, top_k, min_score_ratio) for q in queries]
+
+    expanded = [kb.expand(q_tokens) for q_tokens in queries]
+    norms, flags = ranker._paragraph_stats(kb)
+    k1_1 = ranker.k1 + 1.0
+    rows: Dict[str, Dict[int, float]] = {}
+    for q_terms in expanded:
+        for terms in q_terms.values():
+            for term, _w in terms:
+                if term not in rows:
+                    idf = kb.idf.get(term, 0.0)
+                    rows[term] = {para_id: idf * tf * k1_1 / (tf + norms[para_id])
+                                  for para_id, tf in kb.postings.get(term, ())
+                                  if flags[para_id] & FLAG_CATALOG}
+
+    out = []
+    for q_terms in expanded:
+        groups = [terms for terms in q_terms.values() if terms]
+        overlap: Counter = Counter()
+        for terms in groups:
+            if len(terms) == 1:
+                overlap.update(rows[terms[0][0]].keys())
+            else:
+                overlap.update(set().union(*(rows[term].keys() for term, _w in terms)))
+
+        scores = {}
+        for para_id in [pid for pid, n in overlap.items() if n >= min_overlap]:
+            sc = 0.0
+            for terms in groups:
+                if len(terms) == 1:
+                    term, weight = terms[0]  # a lone fuzzy neighbour still counts with its similarity
+                    sc += weight * rows[term].get(para_id, 0.0)
+                else:
+                    sc += max(weight * rows[term].get(para_id, 0.0) for term, weight in terms)
+            scores[para_id] = sc + ranker.boost(flags[para_id])
+        out.append(_cut(scores, top_k, min_score_ratio))
+    return out
@@ -0,0 +1,509 @@
+﻿# assistant/search_index.py
+import os
+import re
+import gc
+import json
+import math
+import shutil
+import hashlib
+import pathlib
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from .corpus import PackedCorpus, ParagraphStore, _source_page
+from . import generations, minhash
+from .fuzzy import FUZZY_MAX_TERMS, FUZZY_MIN_LEN, TrigramIndex
+from .textnorm import fold
+
+"""
+Inverted index over the knowledge pages:
+- built (or refreshed) by ingest.py, from the TXT pages or straight from extracted page texts
+- loaded once per worker by views.py
+- maps token -> [(paragraph id, term frequency), ...]; every paragraph keeps its file
+- tokens are folded (textnorm.fold: lower case, ş/ș ţ/ț unified, no diacritics) both here
+  and at query time, so "șurubelniță", "şurubelniţă" and "surubelnita" are one token
+- typo tolerance: character-trigram index over the vocabulary (fuzzy.py); expand() maps an
+  unknown query token to its nearest vocabulary terms before scoring
+- candidate generation touches only the posting lists of the query tokens
+- ranking statistics (paragraph lengths, IDF, average length) are precomputed here
+- exact article-code lookup table: normalized code -> [(file, page, row), ...]
+- corpus_version: content hash of all indexed paragraphs (cache keys depend on it)
+- paragraph texts live in the packed corpus (corpus.py: corpus.bin + corpus.idx, mmap)
+- MinHash sketch per catalog paragraph (minhash.py), for near-duplicate removal when the
+  model context is assembled (context.py)
+
+On-disk layout (one generation dir of media/knowledge_index/, see generations.py;
+build_index() writes a new one and switches CURRENT to it, workers reload in the background):
+  index.json  {"version": 7,
+               "postings": {"token": [[para_id, tf], ...], ...},
+               "lengths": [tokens per paragraph, ...],
+               "idf": {"token": idf, ...},
+               "avgdl": average paragraph length,
+               "codes": {"82422010660": [[file_idx, page, "row text"], ...], ...},
+               "trigrams": {"vocab": [...], "keys": [...], "offsets": [...], "ids": [...]},
+               "corpus_version": "sha256 prefix"}
+  corpus.bin / corpus.idx   files, paragraph texts, file of each paragraph, flags
+  minhash.bin               uint32 x MINHASH_K per paragraph
+flags: FLAG_CATALOG (Preț/Price/Cod/Code present), FLAG_PRICE (Preț/Price present),
+       FLAG_CODE (looks like it contains a product/article code)
+"""
+
+INDEX_VERSION = 7
+
+BASE = pathlib.Path(__file__).resolve().parents[1]
+TXT_DIR = BASE / "media" / "knowledge_txt"
+INDEX_DIR = BASE / "media" / "knowledge_index"
+INDEX_FILE = "index.json"
+INDEX_PATH = INDEX_DIR / INDEX_FILE  # flat layout written before index generations
+MINHASH_FILE = "minhash.bin"
+
+TOKEN_RE = re.compile(r"[a-z0-9\-]+")  # applied to folded text
+CATALOG_KEYWORDS = re.compile(r"\b(preț|pret|price|cod|code)\b", re.IGNORECASE | re.UNICODE)
+PRICE_KEYWORDS = re.compile(r"\b(preț|pret|price)\b", re.IGNORECASE | re.UNICODE)
+# Unior article numbers are 11 digits (82422010660), KRONUS codes 6 digits (902742)
+PRODUCT_CODE_RE = re.compile(r"(?<![\d.,])\d{6,11}(?![\d.,])")
+# model numbers with a letter suffix (7187HHXP7, 040E030); only taken when alone on a line
+MODEL_CODE_LINE_RE = re.compile(r"\d{3,6}[A-Z][A-Z0-9]{0,8}")
+# the same article number printed in groups ("23126 00001", "824-2201-0660")
+GROUPED_CODE_LINE_RE = re.compile(r"\d{2,6}(?:[ \-]\d{2,6}){1,3}")
+CODE_SEPARATORS_RE = re.compile(r"[\s\-./]+")
+QUERY_CODE_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9\-./]*")
+# explicit catalog fields ("Denumire: ...", "Preț: 12,50", "Cod: 607494")
+FIELD_NAME_RE = re.compile(r"(?:Denumire|Produs|Articol|Lamp[ăa]|Lantern[ăa])[:\-]?\s*(.+)", re.I)
+FIELD_PRICE_RE = re.compile(r"(?:Preț|Pret|Price)[:\-]?\s*([0-9][0-9\.\, ]*)", re.I)
+FIELD_CODE_RE = re.compile(r"(?:Cod|Code)[:\-]?\s*([A-Za-z0-9\-/]+)", re.I)
+PAGE_HEADER_RE = re.compile(r"^\[SOURCE:(.+?)\]\s*\[PAGE:(\d+)\]")
+CODE_ROW_LINES = 4     # a kód sora + az utána következő sorok (méret, ár, ...)
+CODE_MAX_HITS = 8      # ennyi előfordulást tartunk meg kódonként
+
+FLAG_CATALOG = 1
+FLAG_PRICE = 2
+FLAG_CODE = 4
+
+PARA_WINDOW = 6  # sorok száma a "kevés bekezdés" esetén képzett ablakokban
+
+
+# ----------------------- helpers -----------------------
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(fold(text))
+
+
+def split_paragraphs(raw: str, window: int = PARA_WINDOW) -> List[str]:
+    """
+    Paragraph units, exactly as the old per-request scan produced them:
+    blank-line separated blocks, plus fixed line windows when a page has < 4 blocks.
+    """
+    paras = [p.strip() for p in re.split(r"\n\s*\n+", raw) if p.strip()]
+    if len(paras) < 4:
+        lines = [ln.strip() for ln in raw.splitlines() if ln.strip()]
+        for i in range(0, len(lines), window):
+            paras.append("\n".join(lines[i:i + window]))
+    return paras
+
+
+def paragraph_flags(text: str) -> int:
+    low = text.lower()
+    flags = 0
+    if CATALOG_KEYWORDS.search(low):
+        flags |= FLAG_CATALOG
+    if PRICE_KEYWORDS.search(low):
+        flags |= FLAG_PRICE
+    if PRODUCT_CODE_RE.search(low):
+        flags |= FLAG_CODE
+    return flags
+
+
+def normalize_code(s: str) -> str:
+    """Canonical lookup key: no spaces/dashes/dots/slashes, upper case."""
+    return CODE_SEPARATORS_RE.sub("", s or "").upper()
+
+
+def query_code_keys(query: str) -> List[str]:
+    """
+    Lookup keys of the article codes a query may contain (82422010660, 824-2201-0660,
+    7187HHXP7): the whole query and each code-like word, normalized, >= 4 digits.
+    """
+    keys = []
+    for cand in [query] + QUERY_CODE_RE.findall(query or ""):
+        key = normalize_code(cand)
+        if key not in keys and sum(ch.isdigit() for ch in key) >= 4:
+            keys.append(key)
+    return keys
+
+
+def catalog_fields(text: str) -> dict:
+    """Explicit name/price/code fields of a paragraph (None where absent; nothing is guessed)."""
+    fields = {}
+    for key, regex in (("name", FIELD_NAME_RE), ("price", FIELD_PRICE_RE), ("code", FIELD_CODE_RE)):
+        m = regex.search(text or "")
+        fields[key] = m.group(1).strip() if m else None
+    return fields
+
+
+def page_number(raw: str) -> int:
+    m = PAGE_HEADER_RE.match(raw)
+    return int(m.group(2)) if m else 0
+
+
+def line_codes(ln: str) -> List[str]:
+    """Article codes on one (stripped) line, as printed."""
+    codes = PRODUCT_CODE_RE.findall(ln)
+    if MODEL_CODE_LINE_RE.fullmatch(ln):
+        codes.append(ln)
+    elif GROUPED_CODE_LINE_RE.fullmatch(ln):
+        joined = normalize_code(ln)
+        if 10 <= len(joined) <= 11:
+            codes.append(joined)
+    return codes
+
+
+def extract_codes(raw: str) -> List[tuple]:
+    """
+    Article codes on one TXT page with the row they sit in.
+    Returns [(normalized code, row text), ...]. Table-mode pages (ingest TABLE_MODE) already
+    hold one row per line ("code | Ø | price"); on legacy pages the row is the code line plus
+    the following lines up to the next code (max CODE_ROW_LINES), joined with " | ".
+    """
+    lines = [ln.strip() for ln in raw.splitlines() if ln.strip() and not PAGE_HEADER_RE.match(ln)]
+    found = []
+    for i, ln in enumerate(lines):
+        codes = line_codes(ln)
+        if not codes:
+            continue
+        row = [ln]
+        if " | " not in ln:
+            for nxt in lines[i + 1:i + CODE_ROW_LINES]:
+                if " | " in nxt or PRODUCT_CODE_RE.match(nxt) or MODEL_CODE_LINE_RE.fullmatch(nxt):
+                    break
+                row.append(nxt)
+        row_text = " | ".join(row)
+        for code in codes:
+            found.append((normalize_code(code), row_text))
+    return found
+
+
+def bm25_idf(n_docs: int, doc_freq: int) -> float:
+    """Okapi BM25 IDF (the +1 variant, never negative)."""
+    return math.log(1.0 + (n_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+
+# ----------------------- index -----------------------
+class KnowledgeIndex:
+    def __init__(self, paragraphs, postings: Dict[str, List[list]],
+                 lengths: List[int], idf: Dict[str, float], avgdl: float,
+                 codes: Dict[str, List[list]], txt_dir: pathlib.Path = TXT_DIR,
+                 corpus_version: Optional[str] = None, trigrams: Optional[TrigramIndex] = None,
+                 sketches: Optional[array] = None):
+        self.paragraphs = paragraphs  # ParagraphStore (build) or PackedCorpus (load)
+        self.postings = postings
+        self.lengths = lengths
+        self.idf = idf
+        self.avgdl = avgdl
+        self.codes = codes
+        self.txt_dir = pathlib.Path(txt_dir)
+        self.corpus_version = corpus_version or self._content_hash()
+        self.trigrams = trigrams if trigrams is not None else TrigramIndex.build(postings)
+        self.sketches = sketches if sketches is not None else self._sketch_all()
+
+    def __len__(self):
+        return len(self.paragraphs)
+
+    @property
+    def files(self) -> List[str]:
+        return self.paragraphs.files
+
+    @property
+    def para_range(self) -> range:
+        """Paragraph ids covered (a shards.Shard covers a sub-range)."""
+        return range(len(self.paragraphs))
+
+    def _content_hash(self) -> str:
+        h = hashlib.sha256()
+        for pid in range(len(self.paragraphs)):
+            h.update(self.files[self.paragraphs.file_idx(pid)].encode("utf-8"))
+            h.update(b"\0")
+            h.update(self.paragraphs.text(pid).encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()[:16]
+
+    def _sketch_all(self) -> array:
+        out = array("I")
+        for pid in range(len(self.paragraphs)):
+            if self.paragraphs.flags(pid) & FLAG_CATALOG:
+                out.extend(minhash.sketch(tokenize(self.paragraphs.text(pid))))
+            else:
+                out.extend(minhash.empty_sketch())
+        return out
+
+    # --- build / persist ---
+    @classmethod
+    def build(cls, txt_dir: pathlib.Path = TXT_DIR, window: int = PARA_WINDOW) -> "KnowledgeIndex":
+        return cls.update(None, txt_dir, window=window)
+
+    @classmethod
+    def update(cls, old: Optional["KnowledgeIndex"], txt_dir: pathlib.Path = TXT_DIR,
+               changed: Iterable[str] = (), window: int = PARA_WINDOW,
+               pages: Optional[Dict[str, str]] = None, removed: Iterable[str] = ()) -> "KnowledgeIndex":
+        """
+        Incremental rebuild after an ingest run (see ingest.py change report):
+        paragraphs, postings and codes of files not in `changed` are carried over from `old`
+        with remapped ids; only changed/new files are re-read and re-tokenized.
+        Source of page texts:
+        - pages=None: the TXT files in txt_dir (files no longer on disk drop out)
+        - pages={name: text}: the given texts are the changed/new pages, the rest of the
+          file set is old.files minus `removed` (ingest without the TXT export)
+        old=None -> full build.
+        """
+        # sok apró lista keletkezik: a ciklikus GC itt csak lassít
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return cls._update(old, pathlib.Path(txt_dir), set(changed), window, pages, set(removed))
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    @classmethod
+    def _update(cls, old, txt_dir, changed, window, pages, removed):
+        store = ParagraphStore()
+        postings: Dict[str, List[list]] = {}
+        lengths: List[int] = []
+        codes: Dict[str, List[list]] = {}
+        sketches = array("I")
+        k = minhash.MINHASH_K
+
+        if pages is None:
+            names = sorted(p.name for p in txt_dir.glob("*.txt"))
+        else:
+            changed = changed | set(pages)
+            keep = set(old.files) - removed if old else set()
+            names = sorted(keep | set(pages))
+
+        old_pos = {name: i for i, name in enumerate(old.files)} if old else {}
+        old_paras: Dict[int, List[int]] = {}
+        if old:
+            for pid in range(len(old.paragraphs)):
+                old_paras.setdefault(old.paragraphs.file_idx(pid), []).append(pid)
+        para_map = [-1] * (len(old.paragraphs) if old else 0)  # old para id -> new para id (-1: dropped)
+        file_map: Dict[int, int] = {}   # old file idx -> new file idx
+
+        for name in names:
+            if name in old_pos and name not in changed:
+                old_idx = old_pos[name]
+                file_idx = store.add_file(name)
+                file_map[old_idx] = file_idx
+                for pid in old_paras.get(old_idx, ()):
+                    para_map[pid] = store.add(file_idx, old.paragraphs.flags(pid), old.paragraphs.text(pid))
+                    lengths.append(old.lengths[pid])
+                    sketches.extend(old.sketches[pid * k:(pid + 1) * k])
+                continue
+
+            if pages is not None and name in pages:
+                raw = pages[name]
+            else:
+                try:
+                    raw = (txt_dir / name).read_text(encoding="utf-8", errors="ignore")
+                except Exception:
+                    continue
+            file_idx = store.add_file(name)
+            page = page_number(raw)
+            for code, row in extract_codes(raw):
+                hits = codes.setdefault(code, [])
+                if len(hits) < CODE_MAX_HITS and [file_idx, page, row] not in hits:
+                    hits.append([file_idx, page, row])
+            for p in split_paragraphs(raw, window):
+                flags = paragraph_flags(p)
+                para_id = store.add(file_idx, flags, p)
+                tokens = tokenize(p)
+                lengths.append(len(tokens))
+                # only catalog paragraphs can reach the model context
+                sketches.extend(minhash.sketch(tokens) if flags & FLAG_CATALOG else minhash.empty_sketch())
+                for tok, tf in Counter(tokens).items():
+                    postings.setdefault(tok, []).append([para_id, tf])
+
+        if old:
+            touched = set(postings)
+            for tok, plist in old.postings.items():
+                kept = [[para_map[pid], tf] for pid, tf in plist if para_map[pid] >= 0]
+                if kept:
+                    postings.setdefault(tok, []).extend(kept)
+            for tok in touched:
+                postings[tok].sort()
+            for code, hits in old.codes.items():
+                kept = [[file_map[f], page, row] for f, page, row in hits if f in file_map]
+                if kept:
+                    merged = codes.setdefault(code, [])
+                    merged.extend(kept)
+                    merged.sort(key=lambda h: h[0])
+                    del merged[CODE_MAX_HITS:]
+
+        n_docs = len(store)
+        idf = {tok: bm25_idf(n_docs, len(plist)) for tok, plist in postings.items()}
+        avgdl = (sum(lengths) / n_docs) if n_docs else 0.0
+        return cls(store, postings, lengths, idf, avgdl, codes, txt_dir, sketches=sketches)
+
+    def save(self, path: pathlib.Path = INDEX_PATH):
+        """Packed corpus next to index.json, then index.json (tmp + rename each)."""
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        store = self.paragraphs
+        if not isinstance(store, ParagraphStore):
+            store = ParagraphStore()
+            for file_idx, name in enumerate(self.files):
+                store.add_file(name)
+                for pid in self.paragraphs.file_paragraphs(file_idx):
+                    store.add(file_idx, self.paragraphs.flags(pid), self.paragraphs.text(pid))
+        store.write(path.parent, self.corpus_version)
+        tmp = path.parent / (MINHASH_FILE + ".tmp")
+        minhash.write(tmp, self.sketches)
+        os.replace(tmp, path.parent / MINHASH_FILE)
+
+        data = {
+            "version": INDEX_VERSION,
+            "postings": self.postings,
+            "lengths": self.lengths,
+            "idf": self.idf,
+            "avgdl": self.avgdl,
+            "codes": self.codes,
+            "trigrams": self.trigrams.to_json(),
+            "corpus_version": self.corpus_version,
+        }
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, path)  # atomic: a worker never sees a half-written index
+
+    @classmethod
+    def load(cls, path: Optional[pathlib.Path] = None, txt_dir: pathlib.Path = TXT_DIR) -> Optional["KnowledgeIndex"]:
+        """path: index.json of a generation (default: the current one). None if missing/outdated."""
+        path = pathlib.Path(path) if path is not None else current_index_path()
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != INDEX_VERSION:
+                return None
+            corpus = PackedCorpus(path.parent)
+            sketches = minhash.read(path.parent / MINHASH_FILE, len(corpus))
+        except (OSError, ValueError):
+            return None
+        if corpus.corpus_version != data["corpus_version"]:
+            return None  # index.json and corpus.* from different ingest runs
+        return cls(corpus, data["postings"], data["lengths"], data["idf"], data["avgdl"],
+                   data["codes"], txt_dir, corpus_version=data["corpus_version"],
+                   trigrams=TrigramIndex.from_json(data["trigrams"]), sketches=sketches)
+
+    # --- query ---
+    def file_path(self, para_id: int) -> str:
+        return str(self.txt_dir / self.files[self.paragraphs.file_idx(para_id)])
+
+    def source_page(self, file_idx: int) -> Tuple[str, int]:
+        """(source, page) of a TXT page; from the packed file table when loaded."""
+        sources = getattr(self.paragraphs, "sources", None)
+        return tuple(sources[file_idx]) if sources is not None else _source_page(self.files[file_idx])
+
+    def text(self, para_id: int) -> str:
+        return self.paragraphs.text(para_id)
+
+    def flags(self, para_id: int) -> int:
+        return self.paragraphs.flags(para_id)
+
+    def sketch(self, para_id: int) -> array:
+        k = minhash.MINHASH_K
+        return self.sketches[para_id * k:(para_id + 1) * k]
+
+    def lookup_code(self, code: str) -> List[dict]:
+        """Exact article-code lookup (dict hit, no text scan)."""
+        out = []
+        for file_idx, page, row in self.codes.get(normalize_code(code), ()):
+            name = self.files[file_idx]
+            out.append({
+                "code": normalize_code(code),
+                "file_idx": file_idx,
+                "source": name.rsplit("_p", 1)[0],
+                "page": page,
+                "file": str(self.txt_dir / name),
+                "row": row,
+            })
+        return out
+
+    def expand(self, q_tokens: Iterable[str], max_terms: int = FUZZY_MAX_TERMS) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        query token -> [(vocabulary term, weight), ...]:
+        known tokens map to themselves (1.0); unknown alphabetic tokens of >= FUZZY_MIN_LEN
+        letters to their nearest terms by trigram similarity (weight = similarity);
+        anything else to [] (it cannot match).
+        """
+        out: Dict[str, List[Tuple[str, float]]] = {}
+        for tok in set(q_tokens):
+            if tok in self.postings:
+                out[tok] = [(tok, 1.0)]
+            elif len(tok) >= FUZZY_MIN_LEN:
+                out[tok] = self.trigrams.nearest(tok, max_terms)
+            else:
+                out[tok] = []
+        return out
+
+    def overlap(self, q_tokens) -> Dict[int, int]:
+        """
+        para_id -> number of distinct query tokens present (posting lists only).
+        q_tokens: tokens, or expand() groups (a paragraph counts once per query token,
+        whichever of its terms it contains).
+        """
+        groups = q_tokens if isinstance(q_tokens, Mapping) else {t: [(t, 1.0)] for t in set(q_tokens)}
+        counts: Dict[int, int] = {}
+        for terms in groups.values():
+            if len(terms) == 1:
+                paras = (para_id for para_id, _tf in self.postings.get(terms[0][0], ()))
+            else:
+                paras = {para_id for term, _w in terms for para_id, _tf in self.postings.get(term, ())}
+            for para_id in paras:
+                counts[para_id] = counts.get(para_id, 0) + 1
+        return counts
+
+
+def current_index_path(index_dir: pathlib.Path = INDEX_DIR) -> pathlib.Path:
+    """index.json of the live generation (flat layout when no generation was published yet)."""
+    return generations.generation_dir(index_dir) / INDEX_FILE
+
+
+def build_index(txt_dir: pathlib.Path = TXT_DIR, index_dir: pathlib.Path = INDEX_DIR,
+                changed: Optional[Iterable[str]] = None, pages: Optional[Dict[str, str]] = None,
+                removed: Iterable[str] = ()) -> KnowledgeIndex:
+    """
+    Rebuild the index (+ packed corpus) as a new generation and make it current
+    (generations.py: temp dir, rename, CURRENT replace; unreferenced old ones are collected).
+    With `changed` (TXT names from the ingest change report) or `pages` (page texts when
+    the TXT export is off) the current index is updated incrementally instead;
+    a missing/outdated index still means a full build from the same source.
+    """
+    incremental = changed is not None or pages is not None
+    old = KnowledgeIndex.load(current_index_path(index_dir), txt_dir) if incremental else None
+    if old is None and pages is None:
+        idx = KnowledgeIndex.build(txt_dir)
+    else:
+        idx = KnowledgeIndex.update(old, txt_dir, changed or (), pages=pages, removed=removed)
+    tmp = generations.new_tmp_dir(index_dir)
+    try:
+        idx.save(tmp / INDEX_FILE)
+        generations.publish(index_dir, tmp, idx.corpus_version)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    generations.collect(index_dir)
+    return idx
+
+
+def load_or_build(path: Optional[pathlib.Path] = None, txt_dir: pathlib.Path = TXT_DIR) -> KnowledgeIndex:
+    """Load the persisted index; if missing/outdated, build it in memory from the TXT pages."""
+    idx = KnowledgeIndex.load(path, txt_dir)
+    if idx is None:
+        idx = KnowledgeIndex.build(txt_dir)
+    return idx
+
+
+if __name__ == "__main__":
+    # python -m assistant.search_index  -> reindex the existing TXT pages without re-running ingest
+    built = build_index()
+    print(f"Index: {len(built.files)} files, {len(built)} paragraphs, {len(built.postings)} tokens, "
+          f"{len(built.codes)} codes, {len(built.trigrams)} fuzzy terms -> {current_index_path()}")
@@ -0,0 +1,195 @@
+﻿# assistant/shards.py
+import time
+import threading
+import weakref
+from bisect import bisect_left
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from . import ranking
+from .ranking import MIN_SCORE_RATIO, BM25Ranker, Ranker, _cut, rank_terms
+from .search_index import KnowledgeIndex
+from .textnorm import fold
+
+"""
+Per-catalog shards of the knowledge index: the ask/ "source" filter (views._rank_local_snippets).
+
+- one shard per source, i.e. the [SOURCE:...] header ingest writes (<source>_pNNN.txt);
+  pages are indexed in name order, so a shard is a contiguous paragraph-id range of the
+  generation and its posting lists are bisected slices of the global ones: nothing is
+  copied on disk or in memory, a new generation brings new shards
+- scored with the generation's statistics (IDF, average length): a shard's scores are on
+  the global scale, so the merged top-k of the named shards is exactly ranking.rank()'s
+  restricted to them
+- an explicit source filter (catalog name or a part of it, comma separated) selects the
+  shards; each is ranked with its own score cut, then they are merged into one top-k with
+  the cut of ranking.rank()
+- no filter: views ranks the whole index at once. Vocabulary routing and a parallel fan-out
+  over all shards were measured and dropped: ranking is pure Python, the GIL serialises the
+  fan-out and the merged result equals the global ranking (bench --stages prefilter, p50
+  0.85 ms global vs 0.93 ms routed)
+"""
+
+_FIRST = itemgetter(0)
+
+
+class _ShardPostings:
+    """term -> the slice of the global posting list that falls into [lo, hi)."""
+
+    def __init__(self, postings: Dict[str, List[list]], lo: int, hi: int):
+        self._postings = postings
+        self._lo = lo
+        self._hi = hi
+
+    def _bounds(self, plist) -> Tuple[int, int]:
+        i = bisect_left(plist, self._lo, key=_FIRST)
+        return i, bisect_left(plist, self._hi, i, key=_FIRST)
+
+    def df(self, term: str) -> int:
+        plist = self._postings.get(term)
+        if not plist:
+            return 0
+        i, j = self._bounds(plist)
+        return j - i
+
+    def get(self, term: str, default=()):
+        plist = self._postings.get(term)
+        if not plist:
+            return default
+        i, j = self._bounds(plist)
+        return plist[i:j] if i < j else default
+
+    def __getitem__(self, term: str):
+        return self.get(term, [])
+
+    def __contains__(self, term: str) -> bool:
+        return self.df(term) > 0
+
+
+class Shard:
+    """
+    One catalog as a KnowledgeIndex for ranking.rank_terms(): own postings over para_range;
+    IDF, avgdl, flags and lengths are the generation's. Holds no reference to the index
+    itself, so the shard table dies with its generation (shards_of: weak keys).
+    """
+
+    def __init__(self, kb: KnowledgeIndex, source: str, files: range, lo: int, hi: int):
+        self.paragraphs = kb.paragraphs
+        self.source = source
+        self.files_range = files
+        self.para_range = range(lo, hi)
+        self.postings = _ShardPostings(kb.postings, lo, hi)
+        self.idf = kb.idf
+        self.avgdl = kb.avgdl
+        self.lengths = kb.lengths
+
+    def __len__(self):
+        return len(self.para_range)
+
+    def __repr__(self):
+        return f"<Shard {self.source}: {len(self.files_range)} files, {len(self)} paragraphs>"
+
+    def flags(self, para_id: int) -> int:
+        return self.paragraphs.flags(para_id)
+
+    overlap = KnowledgeIndex.overlap
+
+
+def _build(kb: KnowledgeIndex) -> List[Shard]:
+    shards: List[Shard] = []
+    start = 0
+    for file_idx in range(1, len(kb.files) + 1):
+        if file_idx < len(kb.files) and kb.source_page(file_idx)[0] == kb.source_page(start)[0]:
+            continue
+        lo, hi = kb.paragraphs.file_paragraphs(start).start, kb.paragraphs.file_paragraphs(file_idx - 1).stop
+        if hi > lo:
+            shards.append(Shard(kb, kb.source_page(start)[0], range(start, file_idx), lo, hi))
+        start = file_idx
+
+    return shards
+
+
+_TABLES: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_TABLES_LOCK = threading.Lock()
+
+
+def shards_of(kb: KnowledgeIndex) -> List[Shard]:
+    """The shard table of a loaded index, built on first use (LiveIndex warms it before the swap)."""
+    table = _TABLES.get(kb)
+    if table is None:
+        with _TABLES_LOCK:
+            table = _TABLES.get(kb)
+            if table is None:
+                table = _TABLES[kb] = _build(kb)
+    return table
+
+
+def warm(kb: KnowledgeIndex, ranker: Ranker) -> int:
+    """Shard table + per-shard BM25 statistics (views._warm_index: before a generation is served)."""
+    table = shards_of(kb)
+    if isinstance(ranker, BM25Ranker):
+        for shard in table:
+            ranker._paragraph_stats(shard)
+    return len(table)
+
+
+def resolve(kb: KnowledgeIndex, source: str) -> Optional[List[str]]:
+    """
+    Explicit source filter -> shard names. "" -> None (no filter); each comma separated
+    part matches a source exactly or as a case/diacritic-insensitive substring.
+    [] when nothing matches.
+    """
+    wanted = [fold(part.strip()) for part in (source or "").split(",") if part.strip()]
+    if not wanted:
+        return None
+    names = [s.source for s in shards_of(kb)]
+    return [n for n in names if any(w == fold(n) or w in fold(n) for w in wanted)]
+
+
+def select(kb: KnowledgeIndex, sources: Sequence[str]) -> List[Shard]:
+    """The shards named by resolve(), in index order."""
+    return [s for s in shards_of(kb) if s.source in sources]
+
+
+def search(kb: KnowledgeIndex, q_tokens: Iterable[str], ranker: Ranker, min_overlap: int, sources: Sequence[str],
+           top_k: int = 40, min_score_ratio: float = MIN_SCORE_RATIO) -> List[Tuple[float, int]]:
+    """ranking.rank() over the named shards: [(score, para_id), ...] best first."""
+    q_terms = kb.expand(q_tokens)
+    results = [rank_terms(s, q_terms, ranker, min_overlap, top_k, min_score_ratio) for s in select(kb, sources)]
+    return _cut({pid: sc for ranked in results for sc, pid in ranked}, top_k, min_score_ratio)
+
+
+def explain(kb: KnowledgeIndex, q_tokens: Iterable[str], ranker: Ranker, min_overlap: int, sources: Sequence[str],
+            top_k: int = 40, min_score_ratio: float = MIN_SCORE_RATIO) -> dict:
+    """
+    search() as ranking.explain() reports it (debug/preview/), shard by shard: selection
+    time, then per named shard its candidates and stage timings.
+    """
+    t0 = time.perf_counter()
+    q_terms = kb.expand(q_tokens)
+    t1 = time.perf_counter()
+    selected = select(kb, sources)
+    t2 = time.perf_counter()
+    parts = [ranking.explain(s, q_tokens, ranker, min_overlap, top_k, min_score_ratio, q_terms=q_terms)
+             for s in selected]
+    t3 = time.perf_counter()
+    overlap = {pid: ov for part in parts for _sc, pid, ov in part["ranked"]}
+    ranked = _cut({pid: sc for part in parts for sc, pid, _ov in part["ranked"]}, top_k, min_score_ratio)
+    t4 = time.perf_counter()
+    return {
+        "terms": {term: [[v, round(w, 3)] for v, w in variants] for term, variants in q_terms.items()},
+        "matched": sum(part["matched"] for part in parts),
+        "candidates": sum(part["candidates"] for part in parts),
+        "scored": sum(part["scored"] for part in parts),
+        "timings_ms": {"expand": round((t1 - t0) * 1000, 3), "select": round((t2 - t1) * 1000, 3),
+                       "shards": round((t3 - t2) * 1000, 3), "merge": round((t4 - t3) * 1000, 3)},
+        "shards": [{"source": s.source, "paragraphs": len(s), "candidates": part["candidates"],
+                    "kept": len(part["ranked"]), "timings_ms": part["timings_ms"]} for s, part in zip(selected, parts)],
+        "ranked": [(sc, pid, overlap[pid]) for sc, pid in ranked],
+    }
+
+
+def stats(kb: KnowledgeIndex) -> List[dict]:
+    """Shard table for debug views / bench: name, files, paragraphs, average paragraph length."""
+    return [{"source": s.source, "files": len(s.files_range), "paragraphs": len(s),
+             "avgdl": round(sum(s.lengths[i] for i in s.para_range) / max(1, len(s)), 1)} for s in shards_of(kb)]
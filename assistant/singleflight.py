@@ -0,0 +1,322 @@
+﻿# assistant/singleflight.py
+import os
+import time
+import asyncio
+import pathlib
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from django.core.cache.backends.filebased import FileBasedCache
+
+from . import metrics
+from .cache import _shared_backend
+
+try:
+    import fcntl
+except ImportError:  # not POSIX: the file tier falls back to cache.add (see below)
+    fcntl = None
+
+"""
+Single-flight coalescing of identical model calls (a promotion chip tapped on several
+kiosks within the same second -> one upstream call, every caller gets its answer).
+
+- key: cache.cache_key(normalized query, context hash, model, temperature) (views._flight_key)
+- in process: the first caller of a key runs the call, concurrent callers of the same key
+  wait for its result (threads: do(); coroutines: do_async(), also across event loops -
+  under WSGI every async_to_sync request runs its own); an error is re-raised to every waiter
+- across workers: the leader of a key also holds a shared lock; leaders of other workers
+  poll "<name>:result:<key>" in the shared cache tier instead of calling; if the lock is
+  released without a result (leader failed) one of them takes over. The lock must be
+  atomic: FileBasedCache.add() is a check followed by a write, so with the file tier the
+  lock is an flock on <cache dir>/<name>-<key>.lock (released by the kernel if the leader
+  dies); with locmem/db the tier's add() is it (locmem: under a lock, db: primary key).
+  Without fcntl (not POSIX) the file tier falls back to add() and two workers may both
+  call for the same key - use the db tier there
+- nobody waits longer than SINGLEFLIGHT_WAIT: after that the caller makes its own call;
+  with a timeout (views: the rest of the request's latency budget) every wait - in process,
+  shared lock, shared result - ends at it and raises FlightTimeout instead (the caller
+  answers degraded, no second upstream call)
+- the shared value must be picklable (views passes the answer text, not the SDK object)
+"""
+
+# ===== Config =====
+SINGLEFLIGHT = os.getenv("SINGLEFLIGHT", "1") != "0"
+SINGLEFLIGHT_WAIT = float(os.getenv("SINGLEFLIGHT_WAIT", "60"))    # seconds (model client timeout)
+SINGLEFLIGHT_POLL = 0.05                                            # shared result poll interval
+SINGLEFLIGHT_RESULT_TTL = 5                                         # seconds a shared result is kept (pollers only)
+# ==================
+
+
+class FlightTimeout(Exception):
+    """The leader's result did not arrive within the caller's timeout."""
+
+
+class _FileLock:
+    """flock on a lock file: one holder across processes; the file is removed on release."""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self) -> bool:
+        while True:
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            try:
+                current = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                self._fd = fd
+                return True
+            os.close(fd)  # the previous holder removed the file after our open(): retry
+
+    def release(self):
+        if self._fd is not None:
+            self.path.unlink(missing_ok=True)  # before unlocking: nobody locks a removed file
+            os.close(self._fd)
+            self._fd = None
+
+    def held(self) -> bool:
+        """By another process (a free lock is released again right away)."""
+        if self.acquire():
+            self.release()
+            return False
+        return True
+
+    # non-blocking system calls: fine on the event loop
+    async def aacquire(self) -> bool:
+        return self.acquire()
+
+    async def arelease(self):
+        self.release()
+
+    async def aheld(self) -> bool:
+        return self.held()
+
+
+class _CacheLock:
+    """cache.add() as the lock (atomic for locmem and db)."""
+
+    def __init__(self, shared, key: str, ttl: int):
+        self.shared, self.key, self.ttl = shared, key, ttl
+
+    def acquire(self) -> bool:
+        return self.shared.add(self.key, os.getpid(), timeout=self.ttl)
+
+    def release(self):
+        self.shared.delete(self.key)
+
+    def held(self) -> bool:
+        return self.shared.has_key(self.key)
+
+    async def aacquire(self) -> bool:
+        return await self.shared.aadd(self.key, os.getpid(), timeout=self.ttl)
+
+    async def arelease(self):
+        await self.shared.adelete(self.key)
+
+    async def aheld(self) -> bool:
+        return await self.shared.ahas_key(self.key)
+
+
+def _shared_lock(shared, name: str, key: str, ttl: int):
+    if fcntl is not None and isinstance(shared, FileBasedCache):
+        os.makedirs(shared._dir, exist_ok=True)
+        return _FileLock(pathlib.Path(shared._dir) / f"{name}-{key}.lock")
+    return _CacheLock(shared, f"{name}:lock:{key}", ttl)
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        # key -> the leader's result; a concurrent.futures.Future, so threads and coroutines
+        # of any event loop (async_to_sync: one loop per request under WSGI) can wait for it
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.shared_followers = 0
+        self.timeouts = 0
+
+    def _join(self, key: str):
+        """(future, leader?) for key: the first caller becomes the leader."""
+        with self._lock:
+            fut = self._calls.get(key)
+            if fut is not None:
+                return fut, False
+            fut = self._calls[key] = Future()
+            return fut, True
+
+    def _finish(self, key: str, fut: Future, value=None, error: BaseException = None):
+        with self._lock:
+            self._calls.pop(key, None)
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(value)
+
+    def _count(self, attr: str, role: str):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+        metrics.inc("assistant_singleflight_total", flight=self.name, role=role)
+
+    def _keys(self, key: str):
+        return f"{self.name}:lock:{key}", f"{self.name}:result:{key}"
+
+    def _limit(self, timeout: Optional[float]) -> float:
+        return SINGLEFLIGHT_WAIT if timeout is None else max(0.0, min(SINGLEFLIGHT_WAIT, timeout))
+
+    def _waited_out(self, timeout: Optional[float]):
+        """A wait ran out: with a caller deadline that is FlightTimeout, otherwise the caller calls itself."""
+        if timeout is not None:
+            self._count("timeouts", "timeout")
+            raise FlightTimeout()
+        self._count("leaders", "timeout")
+
+    # --- threads ---
+    def do(self, key: str, fn: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        """timeout: the caller's remaining budget (s); no wait of this call lasts longer."""
+        if not SINGLEFLIGHT:
+            return fn()
+        fut, leader = self._join(key)
+        if not leader:
+            try:
+                value = fut.result(self._limit(timeout))
+            except FutureTimeout:
+                self._waited_out(timeout)
+                return fn()
+            self._count("followers", "follower")
+            return value
+
+        try:
+            value = self._shared_do(key, fn, timeout)
+        except BaseException as e:
+            self._finish(key, fut, error=e)
+            raise
+        self._finish(key, fut, value)
+        return value
+
+    def _shared_do(self, key: str, fn: Callable[[], Any], timeout: Optional[float]) -> Any:
+        shared = _shared_backend()
+        if shared is None:
+            self._count("leaders", "leader")
+            return fn()
+        result_key = self._keys(key)[1]
+        limit = self._limit(timeout)
+        deadline = time.monotonic() + limit
+        while True:
+            try:
+                value = shared.get(result_key)
+                if value is not None:
+                    self._count("shared_followers", "shared_follower")
+                    return value
+                lock = _shared_lock(shared, self.name, key, int(limit) + 5)
+                leader = lock.acquire()
+            except Exception:
+                leader = True  # shared tier unusable: no cross-worker coalescing
+                shared = None
+            if leader:
+                self._count("leaders", "leader")
+                try:
+                    value = fn()
+                    if shared is not None:
+                        shared.set(result_key, value, timeout=SINGLEFLIGHT_RESULT_TTL)
+                    return value
+                finally:
+                    if shared is not None:
+                        lock.release()
+            # another worker is calling: wait for its result (or for its lock to go away)
+            while time.monotonic() < deadline:
+                time.sleep(min(SINGLEFLIGHT_POLL, max(0.0, deadline - time.monotonic())))
+                value = shared.get(result_key)
+                if value is not None:
+                    self._count("shared_followers", "shared_follower")
+                    return value
+                if not lock.held():
+                    break
+            if time.monotonic() >= deadline:
+                self._waited_out(timeout)
+                return fn()
+
+    # --- asyncio (ask/async/) ---
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[Any]], timeout: Optional[float] = None) -> Any:
+        if not SINGLEFLIGHT:
+            return await fn()
+        fut, leader = self._join(key)
+        if not leader:
+            try:
+                # shield: a timed-out follower must not cancel the leader's future
+                value = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(fut)), self._limit(timeout))
+            except asyncio.TimeoutError:
+                self._waited_out(timeout)
+                return await fn()
+            self._count("followers", "follower")
+            return value
+
+        try:
+            value = await self._shared_do_async(key, fn, timeout)
+        except BaseException as e:
+            self._finish(key, fut, error=e)
+            raise
+        self._finish(key, fut, value)
+        return value
+
+    async def _shared_do_async(self, key: str, fn: Callable[[], Awaitable[Any]], timeout: Optional[float]) -> Any:
+        shared = _shared_backend()
+        if shared is None:
+            self._count("leaders", "leader")
+            return await fn()
+        result_key = self._keys(key)[1]
+        limit = self._limit(timeout)
+        deadline = time.monotonic() + limit
+        while True:
+            try:
+                value = await shared.aget(result_key)
+                if value is not None:
+                    self._count("shared_followers", "shared_follower")
+                    return value
+                lock = _shared_lock(shared, self.name, key, int(limit) + 5)
+                leader = await lock.aacquire()
+            except Exception:
+                leader = True
+                shared = None
+            if leader:
+                self._count("leaders", "leader")
+                try:
+                    value = await fn()
+                    if shared is not None:
+                        await shared.aset(result_key, value, timeout=SINGLEFLIGHT_RESULT_TTL)
+                    return value
+                finally:
+                    if shared is not None:
+                        await lock.arelease()
+            while time.monotonic() < deadline:
+                await asyncio.sleep(min(SINGLEFLIGHT_POLL, max(0.0, deadline - time.monotonic())))
+                value = await shared.aget(result_key)
+                if value is not None:
+                    self._count("shared_followers", "shared_follower")
+                    return value
+                if not await lock.aheld():
+                    break
+            if time.monotonic() >= deadline:
+                self._waited_out(timeout)
+                return await fn()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": SINGLEFLIGHT,
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "shared_followers": self.shared_followers,
+            "timeouts": self.timeouts,
+        }
+
+
+MODEL_FLIGHT = SingleFlight("model")
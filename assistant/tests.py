@@ -0,0 +1,848 @@
+﻿# assistant/tests.py
+import os
+import json
+import time
+import asyncio
+import pathlib
+import random
+import tempfile
+import subprocess
+import sys
+import multiprocessing
+import threading
+
+import httpx
+from asgiref.sync import async_to_sync
+from decimal import Decimal
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from openai import OpenAI
+
+from . import (bench, cache, context, fake_openai, file_sync, fuzzy, generations, ingest, metrics, products,
+               shards, textnorm, upstream, views)
+from .models import Product
+from .ranking import BM25Ranker, rank, rank_batch
+from .search_index import INDEX_FILE, KnowledgeIndex, build_index, tokenize
+from .singleflight import FlightTimeout, SingleFlight
+
+"""
+Regression tests (python manage.py test assistant). Pure units where possible; the
+knowledge indexes are built from small page texts (in memory or in a temp directory),
+never from media/knowledge_txt, so the suite runs without an ingested catalog.
+"""
+
+NO_SHARED_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+SHARED_CACHE = dict(NO_SHARED_CACHE, assistant={"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                                                "LOCATION": "tests-shared"})
+
+# two small catalogs, built in memory (KnowledgeIndex.update with page texts)
+TINY_PAGES = {
+    "CAT_A_p001.txt": "[SOURCE:CAT_A] [PAGE:1]\nSurubelnita izolata 1000V\nCod: 607494 Pret: 25,00 lei\n\n"
+                      "Surubelnite set 6 piese izolate\nCod: 607495 Pret: 80,00 lei\n\n"
+                      "Cheie reglabila cromata 300 mm\nCod: 607496 Pret: 60,00 lei\n\n"
+                      "Text fara nimic despre surubelnita",
+    "CAT_B_p001.txt": "[SOURCE:CAT_B] [PAGE:1]\nCheie fixa 13 mm cromata\nCod: 700001 Pret: 12,00 lei\n\n"
+                      "Bit torx T20 pentru surubelnita\nCod: 700002 Pret: 5,00 lei\n\n"
+                      "Cleste pentru taiat gresie\nCod: 700003\n\nCheie tubulara torx",
+}
+
+
+def tiny_index() -> KnowledgeIndex:
+    return KnowledgeIndex.update(None, pages=TINY_PAGES)
+
+
+# ---------- single-flight ----------
+@override_settings(CACHES=NO_SHARED_CACHE)
+class SingleFlightTests(SimpleTestCase):
+    def _coalesced(self, request, started):
+        """Leader request first, then two identical ones while its call is in flight."""
+        results, errors = [], []
+
+        def run():
+            try:
+                results.append(request())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        threads[0].start()
+        self.assertTrue(started.wait(2))
+        for t in threads[1:]:
+            t.start()
+        for t in threads:
+            t.join(10)
+        self.assertEqual(errors, [])
+        return results
+
+    def test_do_async_across_event_loops(self):
+        # WSGI gthread: every ask/async/ request runs in its own async_to_sync loop
+        flight, calls, started = SingleFlight("test"), [], threading.Event()
+
+        async def call():
+            calls.append(1)
+            started.set()
+            await asyncio.sleep(0.3)
+            return "answer"
+
+        results = self._coalesced(lambda: async_to_sync(flight.do_async)("same question", call), started)
+        self.assertEqual(results, ["answer"] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((flight.leaders, flight.followers), (1, 2))
+
+    def test_do_threads_share_the_error(self):
+        flight, calls, started = SingleFlight("test"), [], threading.Event()
+
+        def call():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            raise RuntimeError("upstream down")
+
+        def request():
+            try:
+                return flight.do("same question", call)
+            except RuntimeError as e:
+                return str(e)
+
+        self.assertEqual(self._coalesced(request, started), ["upstream down"] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+    def test_follower_wait_is_capped_by_the_budget(self):
+        flight, calls, started = SingleFlight("test"), [], threading.Event()
+
+        def call():
+            calls.append(1)
+            started.set()
+            time.sleep(1.0)
+            return "answer"
+
+        leader = threading.Thread(target=flight.do, args=("k", call))
+        leader.start()
+        self.assertTrue(started.wait(2))
+        t0 = time.monotonic()
+        with self.assertRaises(FlightTimeout):
+            flight.do("k", call, timeout=0.2)
+        self.assertLess(time.monotonic() - t0, 0.6)
+        leader.join(5)
+        self.assertEqual(len(calls), 1)  # no second upstream call
+
+
+@override_settings(CACHES=SHARED_CACHE)
+class SharedSingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        from django.core.cache import caches
+        self.shared = caches["assistant"]
+        self.shared.clear()
+
+    def test_dead_leader_in_another_worker(self):
+        # its lock stays until the TTL: the wait ends with the caller's budget, not after a minute
+        flight, calls = SingleFlight("test"), []
+        lock_key, _result_key = flight._keys("k")
+        self.shared.add(lock_key, 1, timeout=60)
+
+        def call():
+            calls.append(1)
+            return "answer"
+
+        async def acall():
+            return call()
+
+        for run in (lambda: flight.do("k", call, timeout=0.3),
+                    lambda: async_to_sync(flight.do_async)("k", acall, timeout=0.3)):
+            t0 = time.monotonic()
+            with self.assertRaises(FlightTimeout):
+                run()
+            self.assertLess(time.monotonic() - t0, 1.0)
+        self.assertEqual(calls, [])
+        self.assertEqual(flight.stats()["timeouts"], 2)
+
+    def test_result_of_another_worker(self):
+        flight = SingleFlight("test")
+        lock_key, result_key = flight._keys("k")
+        self.shared.add(lock_key, 1, timeout=60)
+        threading.Timer(0.1, lambda: self.shared.set(result_key, "answer")).start()
+        self.assertEqual(flight.do("k", lambda: "own call", timeout=2), "answer")
+        self.assertEqual(flight.shared_followers, 1)
+
+
+def _flight_worker(start, results, calls_path, key):
+    # one "gunicorn worker": a fresh SingleFlight, the same shared file tier
+    def call():
+        with open(calls_path, "a") as f:
+            f.write(f"{os.getpid()}\n")
+        time.sleep(0.3)
+        return "answer"
+
+    start.wait(5)
+    results.put(SingleFlight("test").do(key, call, timeout=5))
+
+
+class FileTierSingleFlightTests(SimpleTestCase):
+    def test_two_processes_one_call(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        tier = dict(NO_SHARED_CACHE, assistant={"BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                                                "LOCATION": tmp.name})
+        ctx = multiprocessing.get_context("fork")
+        calls_path = pathlib.Path(tmp.name) / "calls"
+        with override_settings(CACHES=tier):
+            for key in ("k1", "k2", "k3"):
+                calls_path.write_text("")
+                start, results = ctx.Event(), ctx.Queue()
+                procs = [ctx.Process(target=_flight_worker, args=(start, results, calls_path, key)) for _ in range(2)]
+                for p in procs:
+                    p.start()
+                start.set()
+                answers = [results.get(timeout=10) for _ in procs]
+                for p in procs:
+                    p.join(5)
+                self.assertEqual(answers, ["answer", "answer"])
+                self.assertEqual(len(calls_path.read_text().split()), 1, key)  # one upstream call per key
+        self.assertEqual(list(pathlib.Path(tmp.name).glob("*.lock")), [])
+
+
+# ---------- query / answer cache ----------
+@override_settings(CACHES=SHARED_CACHE)
+class AnswerCacheTests(SimpleTestCase):
+    def setUp(self):
+        from django.core.cache import caches
+        caches["assistant"].clear()
+        self.now = 1000.0
+        self.enterContext(mock.patch.object(cache, "time", mock.Mock(monotonic=lambda: self.now)))
+
+    def test_lru_evicts_the_least_recent(self):
+        lru = cache.LRUCache(2, ttl=60)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        self.assertEqual(lru.get("a"), 1)  # b is now the oldest
+        lru.set("c", 3)
+        self.assertEqual((lru.get("a"), lru.get("b"), lru.get("c")), (1, None, 3))
+
+    def test_local_entry_expires_after_ttl(self):
+        tier = cache.TwoTierCache("test", 8, ttl=60)
+        tier.set("k", "answer")
+        self.now += 59
+        self.assertEqual(tier.get("k"), "answer")
+        self.now += 2
+        self.assertIsNone(tier.local.get("k"))
+        self.assertEqual(len(tier.local), 0)  # dropped on the expired lookup
+
+    def test_other_worker_hits_the_shared_tier(self):
+        leader, other = cache.TwoTierCache("test", 8, 60), cache.TwoTierCache("test", 8, 60)
+        leader.set("k", "answer")
+        self.assertEqual(other.get("k"), "answer")
+        self.assertEqual(other.get("k"), "answer")
+        self.assertEqual((other.hits_shared, other.hits_local, other.misses), (1, 1, 0))
+
+    def test_key_follows_the_corpus_version(self):
+        kb = tiny_index()
+        key = views._answer_key(kb, "Cheie cromată 13 mm?")
+        self.assertEqual(views._answer_key(kb, "13 mm cheie CROMATA"), key)  # folded, token order ignored
+        self.assertNotEqual(views._answer_key(kb, "Cheie cromată 13 mm?", ["CAT_B"]), key)
+
+        cache.ANSWER_CACHE.set(key, "old answer")
+        self.addCleanup(cache.ANSWER_CACHE.clear)
+        reingested = KnowledgeIndex.update(None, pages=dict(TINY_PAGES, **{
+            "CAT_B_p002.txt": "[SOURCE:CAT_B] [PAGE:2]\nCleste patent\nCod: 700004 Pret: 30,00 lei"}))
+        self.assertNotEqual(reingested.corpus_version, kb.corpus_version)
+        self.assertIsNone(cache.ANSWER_CACHE.get(views._answer_key(reingested, "Cheie cromată 13 mm?")))
+
+
+# ---------- ranking ----------
+class FoldExpandTests(SimpleTestCase):
+    def test_fold_unifies_romanian_spellings(self):
+        self.assertEqual(textnorm.fold("ȘURUBELNIȚĂ"), "surubelnita")
+        self.assertEqual(textnorm.fold("şurubelniţă"), textnorm.fold("șurubelniță"))  # cedilla == comma below
+        self.assertEqual(textnorm.fold("Cheie 13 mm"), "cheie 13 mm")
+        self.assertEqual(textnorm.fold(None), "")
+        self.assertEqual(tokenize("Șurubelniță izolată"), ["surubelnita", "izolata"])
+
+    def test_expand_weights(self):
+        kb = tiny_index()
+        groups = kb.expand(["surubelnita", "surubelnta", "cromat", "xyz", "607499"])
+        self.assertEqual(groups["surubelnita"], [("surubelnita", 1.0)])
+        self.assertEqual([t for t, _w in groups["surubelnta"]], ["surubelnita", "surubelnite"])
+        for _term, weight in groups["surubelnta"] + groups["cromat"]:
+            self.assertLess(weight, 1.0)
+        dice = 2 * len(fuzzy.trigrams("surubelnta") & fuzzy.trigrams("surubelnita")) / (
+            len(fuzzy.trigrams("surubelnta")) + len(fuzzy.trigrams("surubelnita")))
+        self.assertAlmostEqual(groups["surubelnta"][0][1], dice, places=3)
+        self.assertEqual(groups["cromat"], [("cromata", mock.ANY)])
+        self.assertEqual((groups["xyz"], groups["607499"]), ([], []))  # too short / codes match exactly only
+        self.assertEqual(len(kb.expand(["surubelnta"], max_terms=1)["surubelnta"]), 1)
+
+    def test_typo_ranks_the_same_paragraph_lower(self):
+        kb, ranker = tiny_index(), BM25Ranker()
+        exact = rank(kb, set(tokenize("surubelnita izolata pret")), ranker, min_overlap=2)
+        typo = rank(kb, set(tokenize("surubelnta izolata pret")), ranker, min_overlap=2)
+        self.assertEqual(typo[0][1], exact[0][1])
+        self.assertLess(typo[0][0], exact[0][0])  # the fuzzy term counts with its similarity
+
+
+class ContextBuildTests(SimpleTestCase):
+    MODEL = "test-model"
+
+    def setUp(self):
+        # CAT_C page 7 reprints CAT_B page 1 (same rows under another catalog header)
+        reprint = TINY_PAGES["CAT_B_p001.txt"].replace("[SOURCE:CAT_B] [PAGE:1]", "[SOURCE:CAT_C] [PAGE:7]")
+        self.kb = KnowledgeIndex.update(None, pages=dict(TINY_PAGES, **{"CAT_C_p007.txt": reprint}))
+        self.enterContext(mock.patch.dict(context._ENCODERS, {self.MODEL: None}))  # the 4 chars/token estimate
+        self.q_tokens = tokenize("bit torx cheie cromata")
+
+    def pid(self, file_name, text):
+        return next(pid for pid in range(len(self.kb))
+                    if self.kb.file_path(pid).endswith(file_name) and self.kb.text(pid).startswith(text))
+
+    def test_near_duplicate_is_dropped(self):
+        first, reprint = self.pid("CAT_B_p001.txt", "Bit torx"), self.pid("CAT_C_p007.txt", "Bit torx")
+        other = self.pid("CAT_A_p001.txt", "Cheie reglabila")
+        ctx, stats = context.build_context(self.kb, self.q_tokens, [first, reprint, other], self.MODEL)
+        self.assertEqual((stats.fragments, stats.kept, stats.duplicates), (3, 2, 1))
+        self.assertIn("CAT_B_p001.txt", ctx)
+        self.assertNotIn("CAT_C_p007.txt", ctx)
+
+    def test_budget_skips_what_does_not_fit(self):
+        big = self.pid("CAT_B_p001.txt", "[SOURCE:CAT_B]")
+        bigger = self.pid("CAT_A_p001.txt", "Cheie reglabila")
+        small = self.pid("CAT_B_p001.txt", "Cheie tubulara")
+
+        def cost(pid):
+            return context.build_context(self.kb, self.q_tokens, [pid], self.MODEL, budget=0)[1].tokens
+
+        budget = cost(big) + context.count_tokens(context.SEPARATOR, self.MODEL) + cost(small)
+        self.assertGreater(cost(bigger), cost(small))
+        ctx, stats = context.build_context(self.kb, self.q_tokens, [big, bigger, small], self.MODEL, budget=budget)
+        self.assertEqual((stats.kept, stats.over_budget, stats.tokens), (2, 1, budget))
+        self.assertNotIn("reglabila", ctx)  # a shorter fragment further down still got in
+        self.assertTrue(ctx.endswith("Cheie tubulara torx"))
+
+    def test_estimate_without_tiktoken(self):
+        with mock.patch.dict(sys.modules, {"tiktoken": None}), mock.patch.dict(context._ENCODERS, clear=True), \
+                self.assertLogs(context.logger, "WARNING"):
+            self.assertIsNone(context._encoder("gpt-4o-mini"))
+            self.assertEqual(context.count_tokens("x" * 9, "gpt-4o-mini"), -(-9 // context.CHARS_PER_TOKEN))
+            _ctx, stats = context.build_context(self.kb, self.q_tokens, [0, 1], "gpt-4o-mini")
+        self.assertFalse(stats.exact)
+
+
+class RankBatchTests(SimpleTestCase):
+    def test_same_as_rank(self):
+        kb, ranker = tiny_index(), BM25Ranker()
+        queries = {
+            "cheie cromata": "exact",
+            "torxx bit pret": "one fuzzy neighbour",
+            "surubelnit pret": "several fuzzy neighbours",
+            "surubelnitx izolata": "several fuzzy neighbours",
+        }
+        expected = [("torxx", 1), ("surubelnit", 2), ("surubelnitx", 2)]
+        for tok, n in expected:
+            self.assertEqual(len(kb.expand([tok])[tok]), n, tok)
+        tokens = [set(tokenize(q)) for q in queries]
+        batch = rank_batch(kb, tokens, ranker, min_overlap=2)
+        for (q, kind), q_tokens, got in zip(queries.items(), tokens, batch):
+            want = rank(kb, q_tokens, ranker, min_overlap=2)
+            self.assertTrue(want, q)
+            self.assertEqual([pid for _sc, pid in got], [pid for _sc, pid in want], f"{q} ({kind})")
+            for (sc_got, _), (sc_want, _) in zip(got, want):
+                self.assertAlmostEqual(sc_got, sc_want, places=9, msg=f"{q} ({kind})")
+
+
+@override_settings(CACHES=NO_SHARED_CACHE)
+class BenchCommandTests(SimpleTestCase):
+    def test_report_on_a_fixture_index(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        queries = pathlib.Path(tmp.name) / "queries.json"
+        queries.write_text(json.dumps([
+            {"query": "surubelnita izolata pret", "kind": "text", "relevant": ["CAT_A_p001.txt"]},
+            {"query": "cod 700002", "kind": "code", "relevant": ["CAT_B_p001.txt"]},
+            {"query": "ce program aveti azi"},
+        ]), encoding="utf-8")
+        out = StringIO()
+        with mock.patch.object(views, "_get_index", tiny_index):
+            call_command("bench", iterations=2, warmup=0, latency=0.01, queries=queries, stdout=out)
+        report = out.getvalue()
+        self.assertRegex(report, r"p50 ms +p95 ms")
+        for stage in ("prefilter", "extract", "ask"):
+            self.assertRegex(report, rf"\n{stage} +6 ")  # 3 queries x 2 iterations
+        self.assertIn("recall@5: 1.0 over 2 labeled queries", report)
+        self.assertIn("status {'200': 6}", report)
+
+
+class ShardTests(SimpleTestCase):
+    def test_same_scale_as_the_global_ranking(self):
+        kb, ranker = tiny_index(), BM25Ranker()
+        everything = [s.source for s in shards.shards_of(kb)]
+        self.assertEqual(everything, ["CAT_A", "CAT_B"])
+        for q in ("cheie cromata", "surubelnita pret", "torx bit pret", "cheie pret"):
+            q_tokens = set(tokenize(q))
+            want = rank(kb, q_tokens, ranker, min_overlap=2)
+            self.assertEqual(shards.search(kb, q_tokens, ranker, 2, everything), want, q)
+            # one catalog: a subset of the same scores (CAT_B's rare terms are not inflated)
+            scores = dict((pid, sc) for sc, pid in rank(kb, q_tokens, ranker, min_overlap=2, min_score_ratio=0))
+            for sc, pid in shards.search(kb, q_tokens, ranker, 2, ["CAT_B"]):
+                self.assertAlmostEqual(sc, scores[pid], places=9, msg=q)
+
+
+# ---------- product store ----------
+# catalog layouts of the cited cases: a drill set next to single drills, a chuck whose title
+# wraps onto a spec line (KRONUS), a code whose row leaks onto another page
+PRODUCT_PAGES = {
+    "UNIOR_p001.txt": "[SOURCE:UNIOR] [PAGE:1]\n"
+                      "Burghie cilindrice pentru metal DIN 338\n• material HSS, laminate\n• taiere pe dreapta\n"
+                      "11001410080 | 8,0 | 117 | 3.20\n11001410060 | 6,0 | 101 | 2.10\n"
+                      "Trusa burghie DIN 338, HSS\n• caseta metalica\n"
+                      "11001430006 | 6 piese | 2,0-8,0 mm / 6 piese | 39.02\n"
+                      "Cheie fixa dubla dreapta DIN 895\n• forjata, cromata\n"
+                      "71121013 | 10 x 13 | 130 | 24.50\n71121416 | 14 x 16 | 160 | 31.40\n"
+                      "Preturile sunt exprimate in lei\n",
+    "UNIOR_p002.txt": "[SOURCE:UNIOR] [PAGE:2]\nFreza din carbura solida Z-2\n• pentru masini CNC\n"
+                      "11001430006 | 6 piese | 2,0-8,0 mm / 6 piese | 39.02\n",
+    "KRONUS_p001.txt": "[SOURCE:KRONUS] [PAGE:1]\nPanza Bi-Metal pentru fierastrau sabie\n• dinti frezati\n"
+                       "73513A\nMandrina cu cheie 1,5-13,0 mm\n1/2\"-20UNF\n• capacitate mandrina: 1,5-13,0 mm\n"
+                       "Cleste pentru spart nuci\n• aliaj de zinc\n73513A\n1,5 - 13,0 mm\n1\n41.59\n"
+                       "Preturile sunt exprimate in lei\n",
+}
+
+
+class ProductParserTests(SimpleTestCase):
+    def test_series_counts_and_lengths_are_no_sizes(self):
+        row = products.parse_row("73513A", "73513A | 1,5-13,0                            1                 41.59")
+        self.assertEqual(row, {"price": Decimal("41.59"), "dimensions": "", "size_mm": None})
+        row = products.parse_row("11001430006", "11001430006 | 6 piese | 2,0-8,0 mm / 6 piese | 39.02")
+        self.assertEqual((row["dimensions"], row["size_mm"]), ("", None))
+        self.assertEqual(products.parse_row("11453170002", "11453170002 | 6 piese | 2, 3, 4, 5, 6, 8 | 95.82")["dimensions"], "")
+        self.assertEqual(products.parse_row("71121013", "71121013 | 10 x 13 | 130")["dimensions"], " 10 13 ")
+        self.assertEqual(products.parse_row("440AD08L110", "440AD08L110 | 8 | 110 | 279.10")["dimensions"], " 8 ")
+
+    def test_size_mm(self):
+        self.assertIsNone(products.size_mm("Mandrina cu cheie 1,5-13 mm"))
+        self.assertIsNone(products.size_mm("Set burghie Turbo Steps 25 piese Ø 1,0 - 13,0 mm x 0,5 mm"))
+        self.assertEqual(products.size_mm("Cheie reglabila 300 mm"), 300.0)
+
+    def test_titles_stay_in_their_block(self):
+        pages = {name: products.page_titles(text) for name, text in PRODUCT_PAGES.items()}
+        self.assertEqual(pages["KRONUS_p001.txt"]["73513A"], ('Mandrina cu cheie 1,5-13,0 mm 1/2"-20UNF', True))
+        titles = products.resolve_titles(list(pages.values()))
+        self.assertEqual(titles["11001410060"], "Burghie cilindrice pentru metal DIN 338")
+        self.assertNotIn("11001430006", titles)  # "Trusa burghie" on p1, "Freza" on p2
+
+
+class ProductQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        products.rebuild(KnowledgeIndex.update(None, pages=PRODUCT_PAGES))
+
+    def codes(self, query):
+        return [p.code for p in products.search(products.parse_query(query))]
+
+    def test_size_and_price(self):
+        self.assertEqual(self.codes("cheie 13 mm sub 50 lei"), ["71121013"])  # not the chuck
+        self.assertEqual(self.codes("burghiu 8 mm pret"), ["11001410080"])    # not the 2-8 mm set
+        self.assertEqual(self.codes("cheie 16 mm"), ["71121416"])
+
+    def test_ambiguous_falls_through(self):
+        self.assertEqual(self.codes("mandrina 13 mm"), [])              # 1,5-13 mm is a capacity
+        self.assertEqual(self.codes("trusa sub 100 lei"), [])           # the set has no title
+        Product.objects.filter(code="11001410060").update(price=None)
+        self.assertEqual(self.codes("burghiu sub 10 lei"), [])          # an unpriced drill may match
+
+
+class LiveIndexTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.index_dir = pathlib.Path(tmp.name)
+        self.fail_next = 0
+        self.warmed = []
+
+    def publish(self, value):
+        tmp = generations.new_tmp_dir(self.index_dir)
+        (tmp / "value").write_text(value, encoding="utf-8")
+        return generations.publish(self.index_dir, tmp, value)
+
+    def load(self, gen_dir):
+        if self.fail_next:
+            self.fail_next -= 1
+            raise OSError("partial copy")
+        return (gen_dir / "value").read_text(encoding="utf-8")
+
+    def served(self, live, value, wait=5.0):
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            if live.get() == value and not live._reloading:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_failed_reload_is_retried(self):
+        self.publish("one")
+        live = generations.LiveIndex(self.index_dir, self.load, warm=self.warmed.append)
+        self.assertEqual(live.get(), "one")
+        self.assertEqual(self.warmed, ["one"])
+
+        self.fail_next = 1
+        self.publish("two")
+        with mock.patch.object(generations, "RELOAD_RETRY", 0.2), self.assertLogs(generations.logger, "ERROR"):
+            self.assertFalse(self.served(live, "two", wait=0.1))  # failed, still serving the old one
+            self.assertEqual(live.get(), "one")
+            self.assertTrue(self.served(live, "two"))             # same CURRENT, tried again
+        self.assertEqual(self.warmed, ["one", "two"])             # warmed before it was served
+
+    def test_reload_of_a_published_generation(self):
+        txt_dir = self.index_dir / "txt"
+        txt_dir.mkdir()
+        for name, text in TINY_PAGES.items():
+            (txt_dir / name).write_text(text, encoding="utf-8")
+        build_index(txt_dir, self.index_dir)
+        old = generations.current(self.index_dir)
+        live = generations.LiveIndex(self.index_dir, lambda d: KnowledgeIndex.load(d / INDEX_FILE, txt_dir),
+                                     warm=lambda kb: self.warmed.append(kb.corpus_version))
+        self.assertEqual(live.get().lookup_code("700004"), [])
+
+        build_index(txt_dir, self.index_dir, pages={"CAT_B_p002.txt": "[SOURCE:CAT_B] [PAGE:2]\n"
+                                                                      "Cleste patent\nCod: 700004 Pret: 30,00 lei"})
+        deadline = time.monotonic() + 5
+        while live.generation == old and time.monotonic() < deadline:
+            live.get()
+            time.sleep(0.01)
+        self.assertEqual(live.generation, generations.current(self.index_dir))
+        self.assertEqual([h["page"] for h in live.get().lookup_code("700004")], [2])
+        self.assertEqual(self.warmed[1:], [live.get().corpus_version])  # the new one, warmed once
+        generations.collect(self.index_dir)
+        self.assertFalse((self.index_dir / old).exists())  # no longer leased once swapped
+
+
+@override_settings(CACHES=NO_SHARED_CACHE)
+class AskStreamTests(SimpleTestCase):
+    def setUp(self):
+        kb = tiny_index()
+        self.enterContext(mock.patch.object(views, "_get_index", lambda: kb))
+        self.enterContext(bench.caches_bypassed())
+
+    def post(self, message, **headers):
+        return views.ask_stream(RequestFactory().post("/ask/stream/", data=json.dumps({"message": message}),
+                                                      content_type="application/json", **headers))
+
+    def events(self, response):
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        body = b"".join(response.streaming_content).decode("utf-8")
+        self.assertTrue(body.endswith("\n\n"))
+        out = []
+        for block in body[:-2].split("\n\n"):
+            event, data = block.split("\n")
+            self.assertTrue(event.startswith("event: ") and data.startswith("data: "), block)
+            out.append((event[len("event: "):], json.loads(data[len("data: "):])))
+        return out
+
+    def test_local_answer_is_one_event(self):
+        events = self.events(self.post("cod 607494", HTTP_ACCEPT="text/event-stream"))
+        self.assertEqual([e for e, _ in events], ["local", "done"])
+        self.assertIn("607494", events[0][1]["answer_html"])
+
+    def test_model_tokens_stream_as_deltas(self):
+        pre_context = "[FILE:CAT_A_p001.txt]\nSurubelnita izolata 1000V Cod: 607494 Pret: 25,00 lei"
+        with mock.patch.object(views, "_local_answer", return_value=("", pre_context)), \
+                bench.fake_model(0.01) as server:
+            events = self.events(self.post("ce surubelnita recomandati", HTTP_ACCEPT="text/event-stream"))
+        names = [e for e, _ in events]
+        self.assertEqual((names[0], names[-1], server.calls), ("status", "done", 1))
+        self.assertEqual(set(names[1:-1]), {"delta"})
+        self.assertEqual(events[0][1], {"fragments": 1})
+        self.assertEqual("".join(d["text"] for e, d in events if e == "delta"), fake_openai.FAKE_REPLY)
+
+    def test_json_without_event_stream_accept(self):
+        response = self.post("cod 607494", HTTP_ACCEPT="application/json")
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertIn("607494", json.loads(response.content)["answer_html"])
+
+
+class DebugKnowledgeTests(SimpleTestCase):
+    def setUp(self):
+        self.kb = tiny_index()
+        self.enterContext(mock.patch.object(views, "_debug_index", lambda: self.kb))
+
+    def get(self, **params):
+        return views.debug_knowledge(RequestFactory().get("/debug/knowledge/", params))
+
+    def test_cursor_walks_the_corpus(self):
+        first = json.loads(self.get(limit=1, head=20).content)
+        self.assertEqual([(f["source"], f["page"]) for f in first["files"]], [("CAT_A", 1)])
+        self.assertEqual(first["next_cursor"], f"{self.kb.corpus_version[:8]}.1")
+        self.assertLessEqual(len(first["files"][0]["head"]), 20)
+
+        second = json.loads(self.get(limit=1, cursor=first["next_cursor"]).content)
+        self.assertEqual([(f["source"], f["page"]) for f in second["files"]], [("CAT_B", 1)])
+        self.assertIsNone(second["next_cursor"])
+        self.assertEqual(self.get(cursor="nonsense").status_code, 400)
+
+    def test_cursor_of_an_older_corpus_is_refused(self):
+        cursor = json.loads(self.get(limit=1).content)["next_cursor"]
+        self.kb = KnowledgeIndex.update(None, pages=dict(TINY_PAGES, **{
+            "CAT_B_p002.txt": "[SOURCE:CAT_B] [PAGE:2]\nCleste patent\nCod: 700004 Pret: 30,00 lei"}))
+        response = self.get(limit=1, cursor=cursor)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.content)["corpus_version"], self.kb.corpus_version[:8])
+
+    def test_ndjson_ends_with_the_cursor_line(self):
+        for params, last in (({"limit": 1}, f"{self.kb.corpus_version[:8]}.1"), ({}, None)):
+            response = self.get(format="ndjson", **params)
+            self.assertEqual(response["Content-Type"], views.NDJSON)
+            body = b"".join(response.streaming_content).decode("utf-8")
+            self.assertTrue(body.endswith("\n"))
+            rows = [json.loads(line) for line in body.splitlines()]
+            self.assertEqual(rows[-1], {"next_cursor": last})
+            self.assertTrue(all("file_idx" in row for row in rows[:-1]))
+            self.assertEqual(len(rows) - 1, params.get("limit", 2))
+
+
+class UpstreamTests(SimpleTestCase):
+    def test_wsgi_calls_share_the_sync_client(self):
+        async def aping():
+            return await upstream.chat_completion(model="test", messages=[{"role": "user", "content": "ping"}])
+
+        def ping():
+            return async_to_sync(aping)()
+
+        with mock.patch.object(upstream, "ASGI", False), bench.fake_model(0.01) as server:
+            threads = [threading.Thread(target=ping) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            ping()
+        self.assertEqual(server.calls, 5)
+        self.assertEqual(len(upstream._LOOP_STATE), 0)  # no AsyncOpenAI per fresh loop
+
+    def test_gate_slot_held_until_the_call_ends(self):
+        from .admission import MODEL_GATE, Budget
+        from .async_views import _complete
+
+        seen = []
+
+        def slow(kwargs):
+            seen.append(kwargs["timeout"])
+            time.sleep(0.6)  # the upstream, slower than the budget
+            raise TimeoutError()
+
+        active = MODEL_GATE.active
+        with mock.patch.object(upstream, "ASGI", False), mock.patch.object(upstream, "_sync_chat_completion", slow):
+            with self.assertRaises(asyncio.TimeoutError):
+                async_to_sync(_complete)("burghiu 8 mm", "context", Budget(0.5))
+            self.assertEqual(MODEL_GATE.active, active + 1)  # still running on the thread pool
+            time.sleep(0.8)
+        self.assertEqual(MODEL_GATE.active, active)
+        self.assertLessEqual(seen[0], 0.2 + 0.01)  # the budget went to the client as its timeout
+
+
+class IngestTests(SimpleTestCase):
+    def test_failed_range_keeps_the_pdf_out(self):
+        def extract(task):
+            _path, first, last = task
+            if first == ingest.PAGES_PER_TASK:
+                return None  # pdfminer error in the last range
+            return [(pno + 1, "text", []) for pno in range(first, last)]
+
+        pdfs = [pathlib.Path("A.pdf"), pathlib.Path("B.pdf")]
+        with mock.patch.object(ingest, "_page_count", lambda pdf: ingest.PAGES_PER_TASK + (5 if pdf.name == "A.pdf" else 0)), \
+                mock.patch.object(ingest, "_extract_range", extract):
+            out = ingest._extract_pdfs(pdfs, workers=1)
+        self.assertEqual(list(out), ["B.pdf"])  # A keeps its previous pages and manifest entry
+        self.assertEqual(len(out["B.pdf"]), ingest.PAGES_PER_TASK)
+
+
+class FileSyncTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.txt_dir = pathlib.Path(tmp.name) / "txt"
+        self.txt_dir.mkdir()
+        self.cache_path = pathlib.Path(tmp.name) / "cache.json"
+        self.server = fake_openai.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = OpenAI(api_key="test", base_url=self.server.base_url, http_client=httpx.Client(timeout=10),
+                             max_retries=0)
+        self.addCleanup(self.client.close)
+        for patcher in (mock.patch.object(file_sync, "backoff", return_value=0),
+                        mock.patch.object(file_sync, "SYNC_RETRIES", 10)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write(self, **pages):
+        for stem, text in pages.items():
+            (self.txt_dir / f"{stem}.txt").write_text(text, encoding="utf-8")
+
+    def sync(self, **kwargs):
+        kwargs.setdefault("workers", 2)
+        return file_sync.sync(self.txt_dir, self.cache_path, client=self.client, log=lambda _msg: None, **kwargs)
+
+    def file_ids(self):
+        return {name: e["file_id"] for name, e in file_sync.load_cache(self.cache_path)["files"].items()}
+
+    def test_injected_failures_are_retried(self):
+        self.write(**{f"CAT_A_p00{i}": f"pagina {i}" for i in range(1, 7)})
+        self.server.files_fail_rate = 0.3
+        random.seed(7)
+        with self.assertLogs(file_sync.logger, "WARNING"):
+            report = self.sync(vector_store="vs_test")
+        self.assertTrue(file_sync.backoff.called)  # some uploads got a 429 / 500 first
+        self.assertEqual((report["uploaded"], report["failed"]), (6, []))
+        ids = self.file_ids()
+        self.assertEqual(set(ids.values()), set(self.server.files))
+        self.assertEqual(self.server.vector_stores["vs_test"], set(ids.values()))
+
+        report = self.sync(vector_store="vs_test")
+        self.assertEqual((report["unchanged"], report["uploaded"]), (6, 0))
+        self.assertEqual(self.server.uploads, 6)
+
+    def test_changed_page_deleted_only_after_its_upload(self):
+        self.write(CAT_A_p001="pagina 1", CAT_A_p002="pagina 2")
+        self.sync()
+        old = self.file_ids()["CAT_A_p001.txt"]
+
+        self.write(CAT_A_p001="pagina 1, pret nou")
+        self.server.files_fail_rate = 1.0
+        with self.assertLogs(file_sync.logger, "WARNING"):
+            report = self.sync()
+        self.assertEqual(report["failed"], ["CAT_A_p001.txt"])
+        self.assertEqual(report["deleted"], 0)
+        self.assertIn(old, self.server.files)            # still the only copy of that page
+        self.assertEqual(self.file_ids()["CAT_A_p001.txt"], old)
+
+        self.server.files_fail_rate = 0
+        report = self.sync()
+        self.assertEqual((report["uploaded"], report["deleted"]), (1, 1))
+        self.assertNotIn(old, self.server.files)
+        self.assertNotEqual(self.file_ids()["CAT_A_p001.txt"], old)
+
+    def test_renamed_page_keeps_its_file(self):
+        self.write(CAT_A_p001="pagina 1", CAT_A_p002="pagina 2")
+        self.sync()
+        fid = self.file_ids()["CAT_A_p002.txt"]
+        (self.txt_dir / "CAT_A_p002.txt").rename(self.txt_dir / "CAT_B_p002.txt")
+
+        report = self.sync()
+        self.assertEqual((report["reused"], report["uploaded"], report["deleted"]), (1, 0, 0))
+        self.assertEqual(self.file_ids(), {"CAT_A_p001.txt": mock.ANY, "CAT_B_p002.txt": fid})
+        self.assertEqual(self.server.uploads, 2)
+
+    def test_failed_delete_is_carried_over(self):
+        self.write(CAT_A_p001="pagina 1", CAT_A_p002="pagina 2")
+        self.sync()
+        fid = self.file_ids()["CAT_A_p002.txt"]
+        (self.txt_dir / "CAT_A_p002.txt").unlink()
+
+        with mock.patch.object(self.client.files, "delete", side_effect=RuntimeError("connection reset")), \
+                self.assertLogs(file_sync.logger, "ERROR"):
+            report = self.sync()
+        self.assertEqual(report["deleted"], 0)
+        self.assertEqual(file_sync.load_cache(self.cache_path)["pending_delete"], [fid])
+        self.assertIn(fid, self.server.files)
+
+        report = self.sync()
+        self.assertEqual(report["deleted"], 1)
+        self.assertEqual(file_sync.load_cache(self.cache_path)["pending_delete"], [])
+        self.assertNotIn(fid, self.server.files)
+
+    def test_interrupted_run_keeps_its_uploads(self):
+        self.write(**{f"CAT_A_p00{i}": f"pagina {i}" for i in range(1, 5)})
+
+        def log(msg):
+            if "uploaded" in msg:
+                raise KeyboardInterrupt()  # Ctrl-C after the first checkpoint
+
+        with mock.patch.object(file_sync, "SYNC_CHECKPOINT", 1), self.assertRaises(KeyboardInterrupt):
+            file_sync.sync(self.txt_dir, self.cache_path, client=self.client, workers=1, log=log)
+        saved = self.file_ids()
+        self.assertTrue(saved)
+        self.assertLessEqual(set(saved.values()), set(self.server.files))
+
+        report = self.sync()
+        self.assertEqual(report["uploaded"], 4 - len(saved))  # the paid uploads were not repeated
+        self.assertEqual(len(self.file_ids()), 4)
+
+    def test_legacy_cache_is_adopted(self):
+        self.write(CAT_A_p001="pagina 1", CAT_A_p002="pagina 2, mai lunga")
+        same = self.client.files.create(file=("CAT_A_p001.txt", b"pagina 1", "text/plain"), purpose="assistants")
+        stale = self.client.files.create(file=("CAT_A_p002.txt", b"pagina 2", "text/plain"), purpose="assistants")
+        self.cache_path.write_text(json.dumps({"CAT_A_p001.txt": same.id, "CAT_A_p002.txt": stale.id}),
+                                   encoding="utf-8")
+
+        report = self.sync()
+        self.assertEqual((report["adopted"], report["uploaded"], report["deleted"]), (1, 1, 1))
+        cache = file_sync.load_cache(self.cache_path)
+        self.assertEqual(cache["files"]["CAT_A_p001.txt"]["file_id"], same.id)
+        self.assertTrue(all(e.get("sha256") for e in cache["files"].values()))
+        self.assertNotIn(stale.id, self.server.files)
+
+
+class MetricsSnapshotTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = pathlib.Path(tmp.name)
+        patcher = mock.patch.object(metrics, "METRICS_DIR", tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, pid, reloads):
+        reg = metrics.Registry()
+        reg.inc("assistant_index_reloads_total", reloads, outcome="test")
+        (self.dir / f"{pid}.json").write_text(json.dumps(reg.snapshot()), encoding="utf-8")
+
+    def reloads(self):
+        merged = metrics._merged()
+        own = metrics.REGISTRY.counters.get(("assistant_index_reloads_total", (("outcome", "test"),)), 0)
+        return merged.counters.get(("assistant_index_reloads_total", (("outcome", "test"),)), 0) - own
+
+    def test_dead_workers_are_folded(self):
+        dead = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"],
+                              capture_output=True, text=True).stdout.strip()
+        self.write(dead, 3)
+        metrics.retire(12345678)  # no such snapshot: nothing happens
+        self.assertEqual(self.reloads(), 3)
+        self.assertEqual(sorted(p.name for p in self.dir.glob("*.json")), [metrics.RETIRED_FILE])
+        self.write(dead, 2)  # the pid is reused by a worker that then exits too
+        metrics.retire(int(dead))
+        self.assertEqual(self.reloads(), 5)
+
+    def test_forked_worker_starts_empty(self):
+        import runpy
+        from django.conf import settings
+
+        conf = runpy.run_path(str(pathlib.Path(settings.BASE_DIR) / "gunicorn.conf.py"))
+        master = metrics.Registry()
+        master.inc("assistant_index_reloads_total", outcome="test")
+        master.observe("assistant_stage_seconds", 0.5, stage="index_load")  # warm-up in the master
+        worker = type("Worker", (), {})()
+        with mock.patch.object(metrics, "REGISTRY", master):
+            conf["post_fork"](None, worker)
+        self.assertEqual(master.snapshot(), {"counters": [], "histograms": []})
+
+    def test_reused_pid_starts_a_fresh_file(self):
+        self.write(os.getpid(), 7)  # left by an earlier process with our pid
+        with mock.patch.object(metrics, "_claimed_pid", None):
+            metrics.flush(force=True)
+        self.assertEqual(self.reloads(), 7)
+
+
+class CodeAnswerTests(SimpleTestCase):
+    def test_bare_code_row_falls_back_to_its_page(self):
+        kb = KnowledgeIndex.update(None, pages={
+            "CAT_C_p425.txt": "[SOURCE:CAT_C] [PAGE:425]\n82422010660\n82422010670\nØ\n6.6\n6.7\n\n"
+                              "Burghie cilindrice cu doua capete\npentru metal\n\n"
+                              "• burghie cilindrice scurte, HSS, rectificate",
+        })
+        answer_html, context = views._local_answer(kb, "82422010660")
+        self.assertEqual(answer_html, "")  # no bare "Cod: 82422010660" card
+        self.assertIn("Burghie cilindrice cu doua capete", context)
+
+        answer_html, _context = views._local_answer(tiny_index(), "607494")
+        self.assertIn("Cod: 607494 Pret: 25,00 lei", answer_html)  # the row has a price: fast path as before
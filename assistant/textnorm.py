@@ -0,0 +1,28 @@
+﻿# assistant/textnorm.py
+import unicodedata
+
+"""
+Text normalization shared by ingest (index tokens) and query time (search, cache keys):
+- lower case
+- Romanian cedilla forms unified with the comma-below forms (ş->ș, ţ->ț, Ş->Ș, Ţ->Ț);
+  old PDFs and keyboards produce both
+- NFKD + combining marks dropped: ă/â->a, î->i, ș->s, ț->t ("șurubelniță" == "surubelnita")
+Anything that builds index tokens or looks them up must go through fold().
+"""
+
+_CEDILLA_TO_COMMA = str.maketrans({"ş": "ș", "Ş": "Ș", "ţ": "ț", "Ţ": "Ț"})
+# combining diacritical marks (U+0300..U+036F): what NFKD splits off Latin letters
+_DROP_COMBINING = dict.fromkeys(range(0x300, 0x370))
+
+
+def unify_romanian(s: str) -> str:
+    return (s or "").translate(_CEDILLA_TO_COMMA)
+
+
+def fold(s: str) -> str:
+    """Lower case, cedilla/comma unified, diacritics removed."""
+    s = (s or "").lower()
+    if s.isascii():
+        return s
+    # translate() instead of a per-character loop: this runs over the whole corpus at ingest
+    return unicodedata.normalize("NFKD", unify_romanian(s)).translate(_DROP_COMBINING)
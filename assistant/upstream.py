@@ -0,0 +1,183 @@
+﻿# assistant/upstream.py
+import os
+import time
+import random
+import asyncio
+import logging
+import weakref
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError
+
+from . import metrics
+
+"""
+OpenAI access for the async views (async_views.py):
+- under ASGI (ASSISTANT_ASGI=1, set by kiosk_site/asgi.py): one AsyncOpenAI + tuned
+  httpx.AsyncClient per event loop (keep-alive pool, split timeouts), an asyncio semaphore
+  caps concurrent upstream calls per worker; the worker has one long-lived loop
+- under WSGI every async_to_sync call runs on a fresh loop, so a per-loop client would
+  be built, leak its pool and never be reused: the call goes to the process-wide sync
+  client (views._client) on a small thread pool, capped by a process-wide
+  threading.BoundedSemaphore. The async path only pays off under ASGI; under WSGI the
+  async views work, but hold a worker thread just like views.py
+- retry with jittered exponential backoff on 429 / 5xx / connection errors / timeouts
+  (honours Retry-After when the server sends it)
+"""
+
+logger = logging.getLogger(__name__)
+
+# ===== Config =====
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "8"))
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "20"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "10"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "45"))
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))  # seconds
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "8"))
+ASGI = os.getenv("ASSISTANT_ASGI", "0") == "1"   # kiosk_site/asgi.py sets it
+# ==================
+
+# event loop -> (AsyncOpenAI, Semaphore); only under ASGI (one loop per worker)
+_LOOP_STATE: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+# WSGI: process-wide cap and threads for the sync client (built lazily, inside the worker)
+_SYNC_SEMAPHORE = threading.BoundedSemaphore(UPSTREAM_MAX_CONCURRENCY)
+_SYNC_POOL: "ThreadPoolExecutor | None" = None
+_SYNC_POOL_LOCK = threading.Lock()
+
+
+def _build_client() -> AsyncOpenAI:
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            read=UPSTREAM_READ_TIMEOUT,
+            write=UPSTREAM_CONNECT_TIMEOUT,
+            pool=UPSTREAM_CONNECT_TIMEOUT,
+        ),
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        event_hooks={"response": [metrics.on_upstream_response_async]},
+    )
+    # saját retry (lent), az SDK-é kikapcsolva
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client, max_retries=0)
+
+
+def _state():
+    loop = asyncio.get_running_loop()
+    state = _LOOP_STATE.get(loop)
+    if state is None:
+        state = (_build_client(), asyncio.Semaphore(UPSTREAM_MAX_CONCURRENCY))
+        _LOOP_STATE[loop] = state
+    return state
+
+
+def get_async_client() -> AsyncOpenAI:
+    return _state()[0]
+
+
+def _sync_pool() -> ThreadPoolExecutor:
+    global _SYNC_POOL
+    if _SYNC_POOL is None:
+        with _SYNC_POOL_LOCK:
+            if _SYNC_POOL is None:
+                # more threads than call slots: backoff sleeps do not hold a slot
+                _SYNC_POOL = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_CONNECTIONS, thread_name_prefix="upstream")
+    return _SYNC_POOL
+
+
+def retryable(exc: Exception) -> bool:
+    """Connection errors, timeouts, 429 and 5xx are worth another attempt."""
+    if isinstance(exc, (APIConnectionError, APITimeoutError)):
+        return True
+    if isinstance(exc, APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return False
+
+
+def backoff(attempt: int, exc: Exception) -> float:
+    """Seconds to wait before retry `attempt` + 1 (Retry-After if sent, else full jitter)."""
+    retry_after = None
+    if isinstance(exc, APIStatusError):
+        try:
+            retry_after = float(exc.response.headers.get("retry-after", ""))
+        except (TypeError, ValueError):
+            retry_after = None
+    if retry_after is not None:
+        return min(retry_after, UPSTREAM_BACKOFF_MAX)
+    # full jitter: uniform(0, base * 2^attempt), capped
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _retry_delay(attempt: int, exc: Exception) -> float:
+    """Backoff before retry `attempt` + 1; re-raises `exc` when it is not retried."""
+    if attempt >= UPSTREAM_RETRIES or not retryable(exc):
+        raise exc
+    delay = backoff(attempt, exc)
+    logger.warning("Upstream %s, retry %d/%d in %.2fs", type(exc).__name__,
+                   attempt + 1, UPSTREAM_RETRIES, delay)
+    metrics.inc("assistant_upstream_retries_total")
+    return delay
+
+
+def _sync_chat_completion(kwargs):
+    from .views import _client  # process-wide sync client (bench.fake_model replaces it)
+
+    # a thread cannot be cancelled: kwargs["timeout"] bounds the whole call, retries included
+    kwargs = dict(kwargs)
+    timeout = kwargs.pop("timeout", None)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    client = _client().with_options(max_retries=0)
+    attempt = 0
+    while True:
+        try:
+            with _SYNC_SEMAPHORE:
+                left = None if deadline is None else max(0.1, deadline - time.monotonic())
+                return client.chat.completions.create(**kwargs, **({} if left is None else {"timeout": left}))
+        except Exception as e:
+            delay = _retry_delay(attempt, e)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise
+            attempt += 1
+            time.sleep(delay)
+
+
+def chat_completion(done: Optional[Callable[[], None]] = None, **kwargs) -> "asyncio.Future":
+    """
+    Starts client.chat.completions.create(**kwargs) behind the concurrency cap, with retries;
+    returns an awaitable future. Waiting for the semaphore does not count against the retry
+    budget. kwargs["timeout"]: seconds for the whole call (the request's latency budget).
+    done(): called once, when the call has really finished - a caller that stops waiting
+    (asyncio.wait_for) does not stop a sync call on the thread pool, so a slot held for it
+    (admission.MODEL_GATE) must be released here, not by the caller.
+    """
+    if not ASGI:
+        cf = _sync_pool().submit(_sync_chat_completion, kwargs)
+        if done is not None:
+            cf.add_done_callback(lambda _f: done())
+        return asyncio.wrap_future(cf)
+    task = asyncio.ensure_future(_async_chat_completion(kwargs))
+    if done is not None:
+        task.add_done_callback(lambda _t: done())  # also when cancelled before it started
+    return task
+
+
+async def _async_chat_completion(kwargs):
+    client, semaphore = _state()
+    attempt = 0
+    while True:
+        try:
+            async with semaphore:
+                return await client.chat.completions.create(**kwargs)
+        except Exception as e:
+            delay = _retry_delay(attempt, e)
+            attempt += 1
+            await asyncio.sleep(delay)
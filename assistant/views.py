@@ -2,21 +2,36 @@
 import os
 import re
 import json
-import heapq
+import time
+import hashlib
+import itertools
 import pathlib
 import logging
 import html
+import threading
 
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET
-from dotenv import load_dotenv
 
 import httpx
 from openai import OpenAI
 
-load_dotenv()
+from .search_index import (CATALOG_KEYWORDS, INDEX_DIR, INDEX_FILE, KnowledgeIndex, catalog_fields, tokenize,
+                           current_index_path, line_codes, query_code_keys)
+from . import ranking
+from .ranking import explain, get_ranker, rank
+from .cache import ANSWER_CACHE, PREFILTER_CACHE, cache_key, cache_stats, normalize_query
+from . import batch, metrics, products, shards
+from .admission import BREAKER, MODEL_GATE, SHED_RETRY_AFTER, Budget, QueueTimeout, Shed
+from .context import build_context
+from .generations import LiveIndex
+from .singleflight import MODEL_FLIGHT, FlightTimeout
+from .upstream import retryable
+from .page_render import preview_urls
+
 logger = logging.getLogger(__name__)
 
 # --- OpenAI modell és kliens -------------------------------------------------
@@ -24,16 +39,26 @@ OPENAI_MODEL = (os.getenv("OPENAI_MODEL", "gpt-4o-mini") or "").strip()
 if OPENAI_MODEL.lower() == "gpt-40-mini":
     OPENAI_MODEL = "gpt-4o-mini"
 logger.info(f"OPENAI_MODEL resolved to: {OPENAI_MODEL}")
-
-# proxy env-k kiürítése
-for k in ["HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY",
-          "http_proxy", "https_proxy", "all_proxy", "OPENAI_PROXY"]:
-    os.environ.pop(k, None)
-
-client = OpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    http_client=httpx.Client(timeout=60)
-)
+MODEL_TEMPERATURE = 0.2
+
+# a kliens az első hívásnál épül, a workerben (gunicorn preload_app: a master nem nyithat
+# kapcsolatkészletet, amit a forkolt workerek örökölnének); a proxy env-ket apps.py üríti.
+# bench.fake_model lecseréli.
+client = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def _client() -> OpenAI:
+    global client
+    if client is None:
+        with _CLIENT_LOCK:
+            if client is None:
+                client = OpenAI(
+                    api_key=os.getenv("OPENAI_API_KEY"),
+                    # minden HTTP próbálkozás számolódik (az SDK retry-jai is)
+                    http_client=httpx.Client(timeout=60, event_hooks={"response": [metrics.on_upstream_response]})
+                )
+    return client
 
 # --- Tudásbázis --------------------------------------------------------------
 BASE = pathlib.Path(__file__).resolve().parents[1]
@@ -55,60 +80,194 @@ Reguli FOARTE importante:
 - Răspunde concis, în română, tip bullet-list; nu include alte surse decât contextul.
 """.strip()
 
-CATALOG_KEYWORDS = re.compile(r"\b(preț|pret|price|cod|code)\b", re.IGNORECASE | re.UNICODE)
 MIN_OVERLAP = 2  # legalább 2 közös token
+CODE_PAGE_PARAGRAPHS = 4  # puszta kódsornál ennyi bekezdés megy tovább a kód oldaláról
+_RANKER = get_ranker()  # env RANKER=bm25|overlap
 
 
 def index(request):
     return render(request, "assistant/index.html", {})
 
 
-def _list_text_files():
-    return [str(p) for p in TXT_DIR.glob("*.txt")]
+# workerenként egy élő index (ingest.py ír új generációt); újra-ingest után
+# a háttérben cseréljük, addig a régiből szolgálunk ki (generations.py)
+def _load_generation(gen_dir: pathlib.Path):
+    with metrics.stage("index_load"):
+        kb = KnowledgeIndex.load(gen_dir / INDEX_FILE, TXT_DIR)
+    if kb is not None:
+        logger.info("Knowledge index loaded from %s: %d files, %d paragraphs", gen_dir.name, len(kb.files), len(kb))
+    return kb
+
+
+def _build_in_memory():
+    # nincs használható generáció: a TXT oldalakból építjük, memóriában
+    with metrics.stage("index_load"):
+        return KnowledgeIndex.build(TXT_DIR)
+
+
+def _warm_index(kb):
+    # a betöltő szálban, a csere előtt: az első kérés az új generáción nem fizet érte
+    with metrics.stage("index_warm"):
+        ranking.warm(kb, _RANKER)
+        shards.warm(kb, _RANKER)  # a forrásszűrő (source) shardjai
+
+
+_LIVE_INDEX = LiveIndex(INDEX_DIR, _load_generation, fallback=_build_in_memory, warm=_warm_index)
+
 
+def _get_index():
+    # kérésenként egy stat() a CURRENT fájlon
+    return _LIVE_INDEX.get()
 
-def _prefilter_local_snippets(txt_files, query: str, top_k: int = 40, window: int = 6) -> str:
+
+def _rank_local_snippets(kb, query: str, top_k: int = 40, sources=None):
     """
-    Heurisztikus előszűrés:
-    - token-átfedés alapján pontoz
-    - CSAK olyan jelölt, ahol katalógus-jel (Preț/Price/Cod) van
-    - a blokk elejére betesszük a [FILE:...] fejléct, hogy lásd a forrást
+    Rangsorolás az invertált indexen (ranking.py, env RANKER):
+    - csak a kérdés tokenjeinek posting listáit járjuk be
+    - CSAK olyan jelölt, ahol legalább MIN_OVERLAP közös token és katalógus-jel (Preț/Price/Cod) van
+    - pontszám szerinti levágás: a legjobbhoz képest gyenge fragmentumok kiesnek
+    - sources szűrő: csak a megnevezett katalógusok shardjai (shards.py), a globális
+      pontskálán rangsorolva, az eredmények összefésülve
+    Visszaad: [(score, para_id), ...] csökkenő sorrendben.
     """
-    q_tokens = set(re.findall(r"[a-z0-9ăâîșţșț\-]+", (query or "").lower()))
+    q_tokens = set(tokenize(query))
     if not q_tokens:
-        return ""
+        return []
+    if sources is not None:
+        return shards.search(kb, q_tokens, _RANKER, MIN_OVERLAP, sources, top_k=top_k)
+    return rank(kb, q_tokens, _RANKER, MIN_OVERLAP, top_k=top_k)
+
+
+def _prefilter_ranked(kb, query: str, top_k: int = 40, sources=None):
+    """
+    Heurisztikus előszűrés: a rangsorolt fragmentumok összefűzve,
+    a blokk elejére betesszük a [FILE:...] fejléct, hogy lásd a forrást.
+    Visszaad: (pre_context, [para_id, ...]) – a para_id-k a context.py-nak kellenek.
+    Cache: (normalizált kérdés, top_k, korpusz-verzió, forrásszűrő).
+    """
+    key = cache_key(normalize_query(query), top_k, kb.corpus_version, "ranked", *(sources or ()))
+    cached = PREFILTER_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    top = _rank_local_snippets(kb, query, top_k=top_k, sources=sources)
+    metrics.observe("assistant_candidates", len(top))
+    pre_context = "\n\n---\n\n".join(f"[FILE:{kb.file_path(pid)}]\n{kb.text(pid)}" for _score, pid in top)
+    result = (pre_context, [pid for _score, pid in top])
+    PREFILTER_CACHE.set(key, result)
+    return result
+
+
+def _prefilter_local_snippets(kb, query: str, top_k: int = 40) -> str:
+    return _prefilter_ranked(kb, query, top_k=top_k)[0]
 
-    candidates = []
-    for path in txt_files:
-        try:
-            raw = pathlib.Path(path).read_text(encoding="utf-8", errors="ignore")
-        except Exception:
-            continue
 
-        paras = [p.strip() for p in re.split(r"\n\s*\n+", raw) if p.strip()]
-        if len(paras) < 4:
-            lines = [ln.strip() for ln in raw.splitlines() if ln.strip()]
-            for i in range(0, len(lines), window):
-                paras.append("\n".join(lines[i:i + window]))
-
-        for p in paras:
-            p_low = p.lower()
-            p_tokens = set(re.findall(r"[a-z0-9ăâîșţșț\-]+", p_low))
-            overlap = len(q_tokens & p_tokens)
-
-            if overlap >= MIN_OVERLAP and CATALOG_KEYWORDS.search(p_low):
-                bonus = 1 if re.search(r"\b(preț|pret|price)\b", p_low) else 0
-                score = overlap + bonus
-                block = f"[FILE:{path}]\n{p}"  # <—— forrás jelölése
-                heapq.heappush(candidates, (score, block))
-                if len(candidates) > top_k:
-                    heapq.heappop(candidates)
-
-    if not candidates:
+def _model_context(kb, query: str, pre_context: str, para_ids: list) -> str:
+    """
+    A modellnek küldött kontextus (context.py): near-duplikátumok ki, csak az egyező
+    sorok környezete, CONTEXT_TOKEN_BUDGET tokenig. A megspórolt tokeneket mérjük.
+    """
+    context, stats = build_context(kb, tokenize(query), para_ids, OPENAI_MODEL, raw_context=pre_context)
+    metrics.observe("assistant_context_tokens", stats.tokens)
+    metrics.observe("assistant_context_tokens_saved", stats.saved)
+    if stats.duplicates:
+        metrics.inc("assistant_context_fragments_dropped_total", stats.duplicates, reason="duplicate")
+    if stats.over_budget:
+        metrics.inc("assistant_context_fragments_dropped_total", stats.over_budget, reason="budget")
+    logger.info("Model context: %d/%d fragments, %d tokens (%d saved, %d duplicates, %d over budget%s)",
+                stats.kept, stats.fragments, stats.tokens, stats.saved, stats.duplicates, stats.over_budget,
+                "" if stats.exact else ", estimated")
+    return context
+
+
+# --- Cikkszám gyorsút --------------------------------------------------------
+def _lookup_codes(kb, query: str, sources=None) -> list:
+    """
+    Ha a kérdésben cikkszám van (82422010660, 824-2201-0660, 7187HHXP7),
+    közvetlenül a kódindexből keresünk – nincs szövegpásztázás, nincs modellhívás.
+    """
+    hits = []
+    for key in query_code_keys(query):
+        hits.extend(h for h in kb.lookup_code(key) if sources is None or h["source"] in sources)
+    return hits
+
+
+def _bare_code_hit(hit: dict) -> bool:
+    # a sorban csak kód(ok) vannak: se név, se ár, se méret (pl. 82422010660 egy oszlopban)
+    rest = hit["row"]
+    for code in line_codes(rest):
+        rest = rest.replace(code, " ")
+    return not re.search(r"\w", rest)
+
+
+def _code_page_context(kb, hits: list):
+    """
+    Puszta kódsorok helyett: a kód oldalának bekezdései – elöl az, amelyikben a kód áll,
+    utána a szöveges (névvel, leírással) bekezdések oldalsorrendben, oldalanként legfeljebb
+    CODE_PAGE_PARAGRAPHS. Visszaad: (pre_context, [para_id, ...]), mint _prefilter_ranked.
+    """
+    para_ids = []
+    for file_idx in dict.fromkeys(h["file_idx"] for h in hits):
+        page = kb.paragraphs.file_paragraphs(file_idx)
+        codes = {h["code"] for h in hits if h["file_idx"] == file_idx}
+        own = [pid for pid in page if codes & set(tokenize(kb.text(pid)))]
+        prose = [pid for pid in page if pid not in own and re.search(r"[^\W\d_]{4,}", kb.text(pid))]
+        para_ids += (own + prose)[:CODE_PAGE_PARAGRAPHS]
+    pre_context = "\n\n---\n\n".join(f"[FILE:{kb.file_path(pid)}]\n{kb.text(pid)}" for pid in para_ids)
+    return pre_context, para_ids
+
+
+def _page_preview_html(file_path: str) -> str:
+    # oldal-előnézet (ingest GENERATE_IMAGES): kis kép, kattintásra a nagy
+    urls = preview_urls(pathlib.Path(file_path).stem, settings.STATIC_URL)
+    if not urls:
         return ""
+    small, large = urls[min(urls)], urls[max(urls)]
+    return (f"<a href='{html.escape(large)}' target='_blank' rel='noopener'>"
+            f"<img class='page-thumb' src='{html.escape(small)}' loading='lazy' alt='previzualizare pagină'></a>")
 
-    top = [frag for _score, frag in sorted(candidates, key=lambda t: -t[0])]
-    return "\n\n---\n\n".join(top)
+
+def _format_code_hits(hits: list) -> str:
+    parts = []
+    for i, h in enumerate(hits, 1):
+        row = [f"<b>{i}. Cod: {html.escape(h['code'])}</b>", html.escape(h["row"])]
+        row.append(f"<i>Source: {html.escape(h['file'])} (pag. {h['page']})</i>")
+        preview = _page_preview_html(h["file"])
+        if preview:
+            row.append(preview)
+        parts.append("<br>".join(row))
+    return "<div class='catalog-results'>" + "<hr>".join(parts) + "</div>"
+
+
+# --- Attribútum-lekérdezés a terméktáblából ---------------------------------
+def _format_products(rows: list) -> str:
+    # csak a katalógusban szereplő adatok: ár valuta nélkül, ha az oldal nem adja meg
+    parts = []
+    for i, p in enumerate(rows, 1):
+        row = [f"<b>{i}. {html.escape(p.name or '(fără denumire)')}</b>", f"Cod: {html.escape(p.code)}"]
+        if p.price is not None:
+            row.append(f"Preț: {html.escape(f'{p.price} {p.currency}'.strip())}")
+        if p.dimensions.strip():
+            row.append(f"Dimensiuni: {html.escape(p.dimensions.strip())}")
+        file_path = str(TXT_DIR / f"{p.source}_p{p.page:03d}.txt")
+        row.append(f"<i>Source: {html.escape(p.pdf or p.source)} (pag. {p.page})</i>")
+        preview = _page_preview_html(file_path)
+        if preview:
+            row.append(preview)
+        parts.append("<br>".join(row))
+    return "<div class='catalog-results'>" + "<hr>".join(parts) + "</div>"
+
+
+def _product_answer(user_text: str, sources=None) -> str:
+    """
+    "cheie 13 mm sub 50 lei": egyetlen indexelt SQL lekérdezés (products.py) –
+    se szövegpontozás, se modellhívás. Üres, ha nem attribútum-kérdés vagy nincs találat.
+    """
+    pq = products.parse_query(user_text)
+    if pq is None:
+        return ""
+    rows = products.search(pq, sources=sources)
+    return _format_products(rows) if rows else ""
 
 
 # --- Automatikus kinyerés kontextusból ---------------------------------------
@@ -116,7 +275,7 @@ def _extract_catalog_entries(pre_context: str) -> str:
     """
     Kinyer Denumire/Preț/Cod mezőket a kontextusból.
     Csak akkor ad vissza tételt, ha VAN Preț vagy Cod.
-    Ha a Preț mellett nincs valuta, automatikusan RON-t teszünk.
+    Valutát nem találunk ki: ami a szövegben nincs, az a válaszban sincs.
     A [FILE:...] fejléceket megtartjuk, hogy visszakövethető legyen a forrás.
     """
     if not pre_context:
@@ -135,21 +294,13 @@ def _extract_catalog_entries(pre_context: str) -> str:
             continue
 
         # NE használjunk first_line „találgatást”, csak explicit mezőket
-        name_match = re.search(r"(?:Denumire|Produs|Articol|Lamp[ăa]|Lantern[ăa])[:\-]?\s*(.+)", body, re.I)
-        price_match = re.search(r"(?:Preț|Pret|Price)[:\-]?\s*([0-9][0-9\.\, ]*)", body, re.I)
-        code_match = re.search(r"(?:Cod|Code)[:\-]?\s*([A-Za-z0-9\-/]+)", body, re.I)
-
-        name = name_match.group(1).strip() if name_match else None
-        price = price_match.group(1).strip() if price_match else None
-        code = code_match.group(1).strip() if code_match else None
+        fields = catalog_fields(body)
+        name, price, code = fields["name"], fields["price"], fields["code"]
 
         # csak akkor listázzuk, ha VAN (price vagy code)
         if not (price or code):
             continue
 
-        if price and not re.search(r"\b(RON|EUR|USD)\b", price, re.I):
-            price = price + " RON"
-
         entries.append({"name": name, "price": price, "code": code, "source": source})
 
     if not entries:
@@ -166,94 +317,417 @@ def _extract_catalog_entries(pre_context: str) -> str:
             row.append(f"Cod: {html.escape(e['code'])}")
         if e["source"]:
             row.append(f"<i>Source: {html.escape(e['source'])}</i>")
+            preview = _page_preview_html(e["source"])
+            if preview:
+                row.append(preview)
         parts.append("<br>".join(row))
     return "<div class='catalog-results'>" + "<hr>".join(parts) + "</div>"
 
 
+# --- Tartalék válasz (modell nélkül) -----------------------------------------
+DEGRADED_NOTE_HTML = (
+    "<p class='degraded-note'>Asistentul nu poate formula acum un răspuns complet; "
+    "iată fragmentele relevante din catalog:</p>"
+)
+DEGRADED_SNIPPET_CHARS = 300
+
+
+def _degraded_answer(context: str, reason: str) -> str:
+    """
+    A rangsorolt (már megvágott) fragmentumok, az _extract_catalog_entries formájában –
+    ha a modell lassú/hibás, vagy nem fér bele a késleltetési keretbe (admission.py).
+    """
+    metrics.inc("assistant_degraded_total", reason=reason)
+    parts = []
+    for i, block in enumerate(re.split(r"\n\s*---\s*\n", context or ""), 1):
+        file_match = re.search(r"^\[FILE:(.+?)\]\s*", block)
+        source = file_match.group(1).strip() if file_match else None
+        body = re.sub(r"^\[FILE:.+?\]\s*", "", block).strip()
+        if not body:
+            continue
+        fields = catalog_fields(body)
+        row = [f"<b>{len(parts) + 1}. {html.escape(fields['name'] or '(fără denumire)')}</b>"]
+        if fields["price"]:
+            row.append(f"Preț: {html.escape(fields['price'])}")
+        if fields["code"]:
+            row.append(f"Cod: {html.escape(fields['code'])}")
+        snippet = " ".join(ln.strip() for ln in body.splitlines()
+                           if ln.strip() and ln.strip() != "…" and not ln.startswith("[SOURCE:"))
+        if snippet:
+            row.append(html.escape(snippet[:DEGRADED_SNIPPET_CHARS]))
+        if source:
+            row.append(f"<i>Source: {html.escape(source)}</i>")
+            preview = _page_preview_html(source)
+            if preview:
+                row.append(preview)
+        parts.append("<br>".join(row))
+    if not parts:
+        return NO_CONTEXT_HTML
+    return DEGRADED_NOTE_HTML + "<div class='catalog-results'>" + "<hr>".join(parts) + "</div>"
+
+
+def _shed_response():
+    # teli a modell-sor: azonnal "próbáld újra", nem várakoztatjuk a kioszkot
+    response = JsonResponse({"answer_html": SHED_HTML, "retry_after": SHED_RETRY_AFTER}, status=503)
+    response["Retry-After"] = str(SHED_RETRY_AFTER)
+    return response
+
+
 # --- API ---------------------------------------------------------------------
-@csrf_exempt
-def ask(request):
-    if request.method != "POST":
-        return JsonResponse({"error": "POST only"}, status=405)
+NO_KNOWLEDGE_HTML = "Nu am încă fișiere de cunoștințe. Rulează mai întâi <code>assistant/ingest.py</code>."
+NO_CONTEXT_HTML = (
+    "Nu am găsit fragmente locale relevante pentru întrebarea ta.<br>"
+    "Te rog verifică fișierele din <code>media/knowledge_txt</code> "
+    "și folosește termeni apropiați de denumirile/codurile din catalog."
+)
+SHED_HTML = "Sunt multe cereri în acest moment. Te rog încearcă din nou în câteva secunde."
+EMPTY_ANSWER_TEXT = (
+    "Nu am găsit ceva clar în fragmentele din context. "
+    "Îmi dai un cod sau o denumire mai precisă?"
+)
+
 
-    # body parse (JSON + form)
+def _read_message(request):
+    # body parse (JSON + form) -> (kérdés, forrásszűrő)
     payload = {}
     try:
         if request.body:
             payload = json.loads(request.body.decode("utf-8"))
     except Exception:
         payload = {}
+    if not isinstance(payload, dict):
+        payload = {}
 
     user_text = (payload.get("message") or payload.get("text") or "").strip()
     if not user_text:
         user_text = (request.POST.get("message") or request.POST.get("text") or "").strip()
-    if not user_text:
-        return JsonResponse({"error": "empty message"}, status=400)
+    source = str(payload.get("source") or request.POST.get("source") or request.GET.get("source") or "").strip()
+    return user_text, source
 
-    # tudásfájlok
-    txt_files = _list_text_files()
-    if not txt_files:
-        return JsonResponse(
-            {"answer_html": "Nu am încă fișiere de cunoștințe. Rulează mai întâi <code>assistant/ingest.py</code>."},
-            status=400,
-        )
 
-    pre_context = _prefilter_local_snippets(txt_files, user_text, top_k=40)
+def _source_filter(kb, source: str):
+    """
+    ask/ "source" (katalógusnév vagy részlete, vesszővel több) -> (shard-nevek vagy None, hibaválasz vagy None).
+    """
+    if not source:
+        return None, None
+    sources = shards.resolve(kb, source)
+    if not sources:
+        return None, JsonResponse({"error": "unknown source", "sources": [s.source for s in shards.shards_of(kb)]},
+                                  status=400)
+    return sources, None
 
-    # hard gate – kontextus nélkül nem kérdezünk
-    if not (pre_context or "").strip() or not CATALOG_KEYWORDS.search(pre_context.lower()):
-        return JsonResponse({
-            "answer_html": (
-                "Nu am găsit fragmente locale relevante pentru întrebarea ta.<br>"
-                "Te rog verifică fișierele din <code>media/knowledge_txt</code> "
-                "și folosește termeni apropiați de denumirile/codurile din catalog."
-            )
-        }, status=200)
 
-    # 1) próbáljuk saját kinyeréssel (stabil, RON hozzáadása)
-    auto_html = _extract_catalog_entries(pre_context)
+def _local_answer(kb, user_text: str, sources=None):
+    """
+    Minden, ami modell nélkül megválaszolható (sources: csak ezekből a katalógusokból).
+    Visszaad: (answer_html, context) – ha answer_html nem üres, a modellt nem hívjuk;
+    különben a context a modellnek szánt, tokenkeretre vágott kontextus (context.py).
+    """
+    # 0) cikkszám → közvetlen válasz a kódindexből
+    with metrics.stage("code_lookup"):
+        code_hits = _lookup_codes(kb, user_text, sources)
+    if code_hits and not all(_bare_code_hit(h) for h in code_hits):
+        return _format_code_hits(code_hits), ""
+
+    if code_hits:
+        # 0a) csak puszta kódsor (név/ár nélkül) → a kód oldalának bekezdései, mint a rangsorolt kontextus
+        with metrics.stage("prefilter"):
+            pre_context, para_ids = _code_page_context(kb, code_hits)
+    else:
+        # 0b) attribútum-kérdés (méret/ár) → indexelt SQL a terméktáblán
+        with metrics.stage("product_query"):
+            product_html = _product_answer(user_text, sources)
+        if product_html:
+            return product_html, ""
+
+        with metrics.stage("prefilter"):
+            pre_context, para_ids = _prefilter_ranked(kb, user_text, top_k=40, sources=sources)
+
+        # hard gate – kontextus nélkül nem kérdezünk
+        if not (pre_context or "").strip() or not CATALOG_KEYWORDS.search(pre_context.lower()):
+            return NO_CONTEXT_HTML, ""
+
+    # 1) próbáljuk saját kinyeréssel (csak explicit mezők)
+    with metrics.stage("extract"):
+        auto_html = _extract_catalog_entries(pre_context)
     if auto_html:
-        return JsonResponse({"answer_html": auto_html})
+        return auto_html, pre_context
+
+    with metrics.stage("context"):
+        return "", _model_context(kb, user_text, pre_context, para_ids)
+
+
+def _answer_key(kb, user_text: str, sources=None) -> str:
+    return cache_key(normalize_query(user_text), kb.corpus_version, OPENAI_MODEL, *(sources or ()))
+
+
+def _model_messages(user_text: str, pre_context: str) -> list:
+    metrics.observe("assistant_context_bytes", len(pre_context.encode("utf-8")))
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": (
+                    "Întrebare: " + user_text + "\n\n"
+                                                "Context din cataloage (fragmente relevante):\n"
+                    + pre_context
+            ),
+        },
+    ]
+
 
-    # 2) ha nincs strukturált találat, mehet a modell (csak a kontextussal)
+def _flight_key(user_text: str, context: str, temperature: float = MODEL_TEMPERATURE) -> str:
+    # azonos kérdés + azonos kontextus -> egyetlen modellhívás (singleflight.py)
+    context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()
+    return cache_key(normalize_query(user_text), context_hash, OPENAI_MODEL, temperature)
+
+
+def _complete(user_text: str, context: str, budget: Budget) -> str:
+    """
+    Modellhívás (nem streamelt) -> válaszszöveg. Az egyidejű, azonos kérdések
+    egy hívásra várnak (szálak és workerek között is), a hibát mind megkapják.
+    Korlátos sor (MODEL_GATE: Shed / QueueTimeout), a hívás a maradék keretig tarthat,
+    SDK-retry nélkül – a kimenetet a circuit breaker kapja. A másik hívására várás is
+    legfeljebb a maradék keretig tart (FlightTimeout -> tartalék válasz, nincs második hívás).
+    """
+    def call():
+        MODEL_GATE.acquire(max(0.0, budget.remaining()))
+        t0 = time.perf_counter()
+        try:
+            with metrics.stage("upstream"):
+                resp = _client().with_options(timeout=max(0.1, budget.remaining()), max_retries=0).chat.completions.create(
+                    model=OPENAI_MODEL,
+                    temperature=MODEL_TEMPERATURE,
+                    messages=_model_messages(user_text, context),
+                )
+        except Exception as e:
+            BREAKER.record(time.perf_counter() - t0, ok=not retryable(e))
+            metrics.inc("assistant_upstream_calls_total", outcome=type(e).__name__)
+            raise
+        finally:
+            MODEL_GATE.release()
+        BREAKER.record(time.perf_counter() - t0, ok=True)
+        metrics.inc("assistant_upstream_calls_total", outcome="ok")
+        metrics.record_usage(resp.usage)
+        return (resp.choices[0].message.content or "").strip()
+
+    return MODEL_FLIGHT.do(_flight_key(user_text, context), call, timeout=budget.remaining())
+
+
+@csrf_exempt
+def ask(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "POST only"}, status=405)
+
+    budget = Budget()  # a kérés elejétől számít
+    user_text, source = _read_message(request)
+    if not user_text:
+        return JsonResponse({"error": "empty message"}, status=400)
+
+    # tudásbázis (index)
+    kb = _get_index()
+    if not len(kb):
+        return JsonResponse({"answer_html": NO_KNOWLEDGE_HTML}, status=400)
+    sources, error = _source_filter(kb, source)
+    if error:
+        return error
+
+    answer_key = _answer_key(kb, user_text, sources)
+    cached = ANSWER_CACHE.get(answer_key)
+    if cached is not None:
+        return JsonResponse({"answer_html": cached})
+
+    answer_html, pre_context = _local_answer(kb, user_text, sources)
+    if answer_html:
+        ANSWER_CACHE.set(answer_key, answer_html)
+        return JsonResponse({"answer_html": answer_html})
+
+    # 2) ha nincs strukturált találat, mehet a modell (csak a kontextussal) –
+    #    ha a breaker nyitva van / nem fér bele a keretbe: a helyi fragmentumok
+    reason = BREAKER.degrade_reason(budget)
+    if reason:
+        return JsonResponse({"answer_html": _degraded_answer(pre_context, reason), "degraded": reason})
     try:
-        resp = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            temperature=0.2,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": (
-                            "Întrebare: " + user_text + "\n\n"
-                                                        "Context din cataloage (fragmente relevante):\n"
-                            + pre_context
-                    ),
-                },
-            ],
-        )
-        answer_text = (resp.choices[0].message.content or "").strip()
+        answer_text = _complete(user_text, pre_context, budget)
+    except Shed:
+        return _shed_response()
+    except QueueTimeout:
+        return JsonResponse({"answer_html": _degraded_answer(pre_context, "queue"), "degraded": "queue"})
+    except FlightTimeout:
+        return JsonResponse({"answer_html": _degraded_answer(pre_context, "wait"), "degraded": "wait"})
     except Exception as e:
         logger.exception("OpenAI error: %s", e)
-        return JsonResponse(
-            {"answer_html": f"Eroare server: <code>{type(e).__name__}: {e}</code>"},
-            status=500,
-        )
+        return JsonResponse({"answer_html": _degraded_answer(pre_context, "error"), "degraded": "error"})
 
     if not answer_text:
-        answer_text = (
-            "Nu am găsit ceva clar în fragmentele din context. "
-            "Îmi dai un cod sau o denumire mai precisă?"
-        )
+        answer_text = EMPTY_ANSWER_TEXT
+    else:
+        ANSWER_CACHE.set(answer_key, answer_text)
 
     return JsonResponse({"answer_html": answer_text})
 
 
+# --- Rendelési lista (batch) -------------------------------------------------
+@csrf_exempt
+def ask_batch(request):
+    """
+    Sok sor egyszerre (beillesztett rendelési lista), modell nélkül – batch.py.
+    Body: {"lines": [...]} vagy {"text": "soronként egy tétel"}; ?format=csv -> CSV letöltés.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST only"}, status=405)
+
+    payload = {}
+    try:
+        if request.body and request.content_type == "application/json":
+            payload = json.loads(request.body.decode("utf-8"))
+    except Exception:
+        payload = {}
+    if isinstance(payload.get("lines"), list):
+        lines = [str(x).strip() for x in payload["lines"] if str(x).strip()]
+    else:
+        lines = batch.parse_lines(payload.get("text") or request.POST.get("text") or "")
+    if not lines:
+        return JsonResponse({"error": "empty list"}, status=400)
+    if len(lines) > batch.BATCH_MAX_LINES:
+        return JsonResponse({"error": f"too many lines (max {batch.BATCH_MAX_LINES})"}, status=400)
+
+    kb = _get_index()
+    if not len(kb):
+        return JsonResponse({"answer_html": NO_KNOWLEDGE_HTML}, status=400)
+
+    with metrics.stage("batch"):
+        result = batch.lookup(kb, lines, _RANKER, MIN_OVERLAP)
+
+    if (request.GET.get("format") or payload.get("format") or "").lower() == "csv":
+        response = HttpResponse(batch.to_csv(result["rows"]), content_type="text/csv; charset=utf-8")
+        response["Content-Disposition"] = 'attachment; filename="batch.csv"'
+        return response
+    return JsonResponse(result, json_dumps_params={"ensure_ascii": False})
+
+
+# --- Streaming (SSE) ---------------------------------------------------------
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _stream_events(kb, user_text: str, budget: Budget, sources=None):
+    """
+    Eseménysor: "local" (helyi találatok, azonnal) VAGY "status" + "delta"* (modell tokenek),
+    a végén mindig "done"; hiba esetén "error".
+    Lassú/hibás modell (breaker, keret, az első token előtti hiba): "local" a helyi fragmentumokkal.
+    A breaker az első tokenig eltelt időt kapja.
+    """
+    answer_key = _answer_key(kb, user_text, sources)
+    cached = ANSWER_CACHE.get(answer_key)
+    if cached is not None:
+        yield _sse("local", {"answer_html": cached})
+        yield _sse("done", {})
+        return
+
+    answer_html, pre_context = _local_answer(kb, user_text, sources)
+    if answer_html:
+        ANSWER_CACHE.set(answer_key, answer_html)
+        yield _sse("local", {"answer_html": answer_html})
+        yield _sse("done", {})
+        return
+
+    reason = BREAKER.degrade_reason(budget)
+    if reason:
+        yield _sse("local", {"answer_html": _degraded_answer(pre_context, reason), "degraded": reason})
+        yield _sse("done", {})
+        return
+    try:
+        MODEL_GATE.acquire(max(0.0, budget.remaining()))
+    except Shed:
+        yield _sse("error", {"answer_html": SHED_HTML, "retry_after": SHED_RETRY_AFTER})
+        return
+    except QueueTimeout:
+        yield _sse("local", {"answer_html": _degraded_answer(pre_context, "queue"), "degraded": "queue"})
+        yield _sse("done", {})
+        return
+
+    parts = []
+    t0 = time.perf_counter()
+    try:
+        yield _sse("status", {"fragments": pre_context.count("[FILE:")})
+        with metrics.stage("upstream"):
+            # stream: a timeout chunkonként számít, így az első tokenre várást a keret korlátozza
+            stream = _client().with_options(timeout=max(0.1, budget.remaining()), max_retries=0).chat.completions.create(
+                model=OPENAI_MODEL,
+                temperature=MODEL_TEMPERATURE,
+                messages=_model_messages(user_text, pre_context),
+                stream=True,
+                stream_options={"include_usage": True},  # az utolsó chunk hozza a usage-t
+            )
+            for chunk in stream:
+                metrics.record_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                if delta:
+                    if not parts:
+                        BREAKER.record(time.perf_counter() - t0, ok=True)
+                    parts.append(delta)
+                    yield _sse("delta", {"text": delta})
+        metrics.inc("assistant_upstream_calls_total", outcome="ok")
+    except Exception as e:
+        metrics.inc("assistant_upstream_calls_total", outcome=type(e).__name__)
+        logger.exception("OpenAI stream error: %s", e)
+        if not parts:
+            BREAKER.record(time.perf_counter() - t0, ok=not retryable(e))
+            yield _sse("local", {"answer_html": _degraded_answer(pre_context, "error"), "degraded": "error"})
+            yield _sse("done", {})
+            return
+        yield _sse("error", {"answer_html": f"Eroare server: <code>{html.escape(type(e).__name__)}: {html.escape(str(e))}</code>"})
+        return
+    finally:
+        MODEL_GATE.release()
+
+    answer_text = "".join(parts).strip()
+    if answer_text:
+        ANSWER_CACHE.set(answer_key, answer_text)
+    else:
+        yield _sse("delta", {"text": EMPTY_ANSWER_TEXT})
+    yield _sse("done", {})
+
+
+@csrf_exempt
+def ask_stream(request):
+    """
+    Mint az ask/, de Server-Sent Events-ként: a helyi találatok azonnal mennek,
+    a modell válasza tokenenként (stream=True).
+    Ha a kliens nem kér text/event-stream-et, a sima ask/ JSON választ adjuk.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST only"}, status=405)
+    if "text/event-stream" not in request.headers.get("Accept", ""):
+        return ask(request)
+
+    budget = Budget()
+    user_text, source = _read_message(request)
+    if not user_text:
+        return JsonResponse({"error": "empty message"}, status=400)
+
+    kb = _get_index()
+    if not len(kb):
+        return JsonResponse({"answer_html": NO_KNOWLEDGE_HTML}, status=400)
+    sources, error = _source_filter(kb, source)
+    if error:
+        return error
+
+    response = StreamingHttpResponse(_stream_events(kb, user_text, budget, sources), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # nginx/Render proxy ne pufferelje
+    return response
+
+
 # --- Gyors modell-teszt ------------------------------------------------------
 @require_GET
 def ping(request):
     try:
-        r = client.chat.completions.create(
+        r = _client().chat.completions.create(
             model=OPENAI_MODEL,
             messages=[{"role": "user", "content": "ping"}],
         )
@@ -263,26 +737,158 @@ def ping(request):
         return JsonResponse({"ok": False, "model": OPENAI_MODEL, "error": str(e)}, status=500)
 
 
-# --- Debug: látja-e a szerver a TXT-ket? ------------------------------------
+# --- Debug nézetek ------------------------------------------------------------
+# lapozva (cursor) vagy NDJSON-folyamként, sosem a teljes korpusz egy válaszban;
+# a már betöltött / publikált generációt olvassuk, TXT-ből sosem építünk indexet
+DEBUG_PAGE_SIZE = 50
+DEBUG_PAGE_MAX = 500
+DEBUG_HEAD_CHARS = 400
+DEBUG_TEXT_MAX = 2000
+DEBUG_PREVIEW_TOP_K = 20
+DEBUG_PREVIEW_MAX_K = 100
+NDJSON = "application/x-ndjson; charset=utf-8"
+
+
+def _int_param(request, name: str, default: int, lo: int, hi: int) -> int:
+    try:
+        return max(lo, min(hi, int(request.GET.get(name) or default)))
+    except ValueError:
+        return default
+
+
+def _debug_index():
+    kb = _LIVE_INDEX.peek()
+    if kb is None and current_index_path(INDEX_DIR).exists():
+        kb = _LIVE_INDEX.get()  # mmap-olt generáció, nem újraolvasás
+    return kb
+
+
+def _ndjson_response(items):
+    # soronként egy JSON objektum, lustán generálva (a worker sosem tartja az egészet)
+    return StreamingHttpResponse((json.dumps(x, ensure_ascii=False) + "\n" for x in items), content_type=NDJSON)
+
+
+def _file_head(kb, file_idx: int, chars: int) -> str:
+    head = ""
+    for para_id in kb.paragraphs.file_paragraphs(file_idx):
+        if len(head) >= chars:
+            break
+        head += (head and "\n\n") + kb.text(para_id)
+    return head[:chars]
+
+
 @require_GET
 def debug_knowledge(request):
-    files = _list_text_files()
-    out = []
-    for p in files:
-        try:
-            txt = pathlib.Path(p).read_text(encoding="utf-8", errors="ignore")
-            head = txt[:400]
-        except Exception as e:
-            head = f"<< read error: {e} >>"
-        out.append({"path": p, "head_len": len(head), "head": head})
-    return JsonResponse({"count": len(files), "files": out})
+    """
+    A korpusz oldalai lapozva: ?limit=50&cursor=<next_cursor>&source=<katalógus>&page=<n>&head=400.
+    A cursor a korpusz-verzióhoz kötött: újra-ingest után 409, elölről kell kezdeni.
+    ?format=ndjson -> soronként egy oldal, az utolsó sor {"next_cursor": ...}.
+    """
+    kb = _debug_index()
+    if kb is None:
+        return JsonResponse({"error": "index not loaded"}, status=503)
+
+    version = kb.corpus_version[:8]
+    limit = _int_param(request, "limit", DEBUG_PAGE_SIZE, 1, DEBUG_PAGE_MAX)
+    chars = _int_param(request, "head", DEBUG_HEAD_CHARS, 0, DEBUG_TEXT_MAX)
+    source = (request.GET.get("source") or "").strip()
+    page = (request.GET.get("page") or "").strip()
+    if page and not page.isdigit():
+        return JsonResponse({"error": "page must be a number"}, status=400)
+    start = 0
+    cursor = (request.GET.get("cursor") or "").strip()
+    if cursor:
+        cur_version, _, pos = cursor.partition(".")
+        if not pos.isdigit():
+            return JsonResponse({"error": "bad cursor"}, status=400)
+        if cur_version != version:
+            return JsonResponse({"error": "index changed, restart without cursor", "corpus_version": version},
+                                status=409)
+        start = int(pos)
+
+    def window():
+        n = 0
+        for file_idx in range(start, len(kb.files)):
+            src, pg = kb.source_page(file_idx)
+            if (source and src != source) or (page and pg != int(page)):
+                continue
+            if n == limit:
+                yield {"next_cursor": f"{version}.{file_idx}"}
+                return
+            head = _file_head(kb, file_idx, chars)
+            yield {"file_idx": file_idx, "path": str(TXT_DIR / kb.files[file_idx]), "source": src, "page": pg,
+                   "paragraphs": len(kb.paragraphs.file_paragraphs(file_idx)), "head_len": len(head), "head": head}
+            n += 1
+        yield {"next_cursor": None}
+
+    if (request.GET.get("format") or "").lower() == "ndjson":
+        return _ndjson_response(window())
+    rows = list(window())
+    return JsonResponse({"count": len(kb.files), "corpus_version": version, "limit": limit,
+                         "files": rows[:-1], "next_cursor": rows[-1]["next_cursor"]})
+
 
 @require_GET
 def debug_preview(request):
+    """
+    Előszűrés + modell-kontextus egy kérdésre. ?scores=1 (vagy ?format=ndjson): a rangsorolás
+    szakaszonként (ranking.explain / shards.explain: shardonként is) – fragmentumonként
+    score/overlap/forrás, szakaszidők ms-ban.
+    ?top_k=20 (max 100), ?chars=300: a fragmentumszöveg hossza, ?source=: katalógusszűrő.
+    """
     q = (request.GET.get("q") or "").strip()
     if not q:
         return JsonResponse({"error": "missing ?q="}, status=400)
+    kb = _debug_index()
+    if kb is None:
+        return JsonResponse({"error": "index not loaded"}, status=503)
+
+    top_k = _int_param(request, "top_k", DEBUG_PREVIEW_TOP_K, 1, DEBUG_PREVIEW_MAX_K)
+    sources, error = _source_filter(kb, (request.GET.get("source") or "").strip())
+    if error:
+        return error
+    ndjson = (request.GET.get("format") or "").lower() == "ndjson"
+    if not (ndjson or request.GET.get("scores") in ("1", "true")):
+        pre_context, para_ids = _prefilter_ranked(kb, q, top_k=top_k, sources=sources)
+        context, stats = build_context(kb, tokenize(q), para_ids, OPENAI_MODEL, raw_context=pre_context)
+        return JsonResponse({"query": q, "pre_context": pre_context, "model_context": context,
+                             "context_stats": dict(stats._asdict(), saved=stats.saved)})
+
+    # cache nélkül, hogy az időzítések a valódi munkát mérjék
+    chars = _int_param(request, "chars", 300, 0, DEBUG_TEXT_MAX)
+    q_tokens = set(tokenize(q))
+    if sources is not None:
+        ex = shards.explain(kb, q_tokens, _RANKER, MIN_OVERLAP, sources, top_k=top_k)
+    else:
+        ex = explain(kb, q_tokens, _RANKER, MIN_OVERLAP, top_k=top_k)
+    t0 = time.perf_counter()
+    _context, stats = build_context(kb, q_tokens, [pid for _sc, pid, _ov in ex["ranked"]], OPENAI_MODEL)
+    ex["timings_ms"]["context"] = round((time.perf_counter() - t0) * 1000, 3)
+    summary = {"query": q, "tokens": sorted(q_tokens), "ranker": type(_RANKER).__name__,
+               "shards": ex.get("shards"),
+               "terms": ex["terms"], "matched": ex["matched"], "candidates": ex["candidates"],
+               "timings_ms": ex["timings_ms"], "context_stats": dict(stats._asdict(), saved=stats.saved)}
+
+    def fragments():
+        for rank_no, (score, pid, overlap) in enumerate(ex["ranked"], 1):
+            file_idx = kb.paragraphs.file_idx(pid)
+            src, pg = kb.source_page(file_idx)
+            yield {"rank": rank_no, "para_id": pid, "score": round(score, 4), "overlap": overlap,
+                   "file": kb.files[file_idx], "source": src, "page": pg, "text": kb.text(pid)[:chars]}
+
+    if ndjson:
+        return _ndjson_response(itertools.chain([summary], fragments()))
+    return JsonResponse(dict(summary, fragments=list(fragments())))
 
-    txt_files = _list_text_files()
-    pre_context = _prefilter_local_snippets(txt_files, q, top_k=20)
-    return JsonResponse({"query": q, "pre_context": pre_context})
+
+@require_GET
+def debug_cache(request):
+    return JsonResponse(dict(cache_stats(), singleflight=MODEL_FLIGHT.stats(),
+                             breaker=BREAKER.stats(), model_gate=MODEL_GATE.stats()))
+
+
+# --- Metrikák (Prometheus) ---------------------------------------------------
+@require_GET
+def metrics_view(request):
+    # az összes gunicorn worker pillanatképe összevonva (metrics.METRICS_DIR)
+    return HttpResponse(metrics.render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,72 @@
+﻿# assistant/warmup.py
+import gc
+import time
+import logging
+import resource
+from typing import Dict
+
+"""
+Start-up warm-up of the per-process knowledge state (apps.AssistantConfig.ready with
+ASSISTANT_WARMUP=1; gunicorn.conf.py runs it once in the master thanks to preload_app):
+- the live index generation (postings, code table, trigram index; the packed corpus is
+  mmapped) with its ranking statistics and per-catalog shard table (views._warm_index, the
+  same warm-up a reloaded generation gets), the context tokenizer and one warm-up query
+- freeze(): gc.freeze() right before the workers are forked; the loaded objects move to the
+  permanent generation, so a worker's collector never writes to their pages and they stay
+  shared copy-on-write
+- startup time per step and memory (RSS / PSS / private) are logged; memory_mb() is what
+  gunicorn.conf.py reports per worker
+"""
+
+logger = logging.getLogger(__name__)
+
+WARMUP_QUERY = "cheie reglabila pret"
+
+REPORT: Dict[str, float] = {}   # step -> ms, filled by warm_up()
+
+
+def memory_mb() -> Dict[str, float]:
+    """rss / pss / private (MB) from /proc/self/smaps_rollup; elsewhere only the peak RSS."""
+    try:
+        fields = {}
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[1].isdigit():
+                    fields[parts[0].rstrip(":")] = int(parts[1])
+        return {
+            "rss": round(fields["Rss"] / 1024, 1),
+            "pss": round(fields["Pss"] / 1024, 1),
+            "private": round((fields["Private_Clean"] + fields["Private_Dirty"]) / 1024, 1),
+        }
+    except (OSError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {"peak_rss": round(peak / 1024, 1)}
+
+
+def warm_up() -> Dict[str, float]:
+    from . import context, views  # Django must be ready (apps.py)
+
+    t0 = time.perf_counter()
+
+    def step(name, fn):
+        t = time.perf_counter()
+        value = fn()
+        REPORT[name] = round((time.perf_counter() - t) * 1000, 1)
+        return value
+
+    kb = step("index", views._get_index)
+    step("query", lambda: views._rank_local_snippets(kb, WARMUP_QUERY))  # BM25 statistics, regexes
+    step("tokenizer", lambda: context._encoder(views.OPENAI_MODEL))
+    REPORT["total"] = round((time.perf_counter() - t0) * 1000, 1)
+    logger.info("Warm-up %s ms (index %s, query %s, tokenizer %s); %d files, %d paragraphs; memory %s",
+                REPORT["total"], REPORT["index"], REPORT["query"], REPORT["tokenizer"],
+                len(kb.files), len(kb), memory_mb())
+    return REPORT
+
+
+def freeze() -> int:
+    """Call last thing before forking: collect once, then exempt everything from the GC."""
+    gc.collect()
+    gc.freeze()
+    return gc.get_freeze_count()
@@ -0,0 +1,63 @@
+﻿# gunicorn.conf.py
+import os
+import time
+
+"""
+gunicorn -c gunicorn.conf.py   (WSGI; ASGI: GUNICORN_APP=kiosk_site.asgi:application
+                                GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker)
+
+- preload_app: Django + the knowledge state are loaded once in the master (ASSISTANT_WARMUP,
+  assistant/warmup.py), then gc-frozen; workers are forked with it, shared copy-on-write,
+  so a new worker (scale-up, max_requests restart) is ready without loading anything
+- the OpenAI/httpx clients are created lazily inside each worker, never in the master
+- logs: master warm-up time + memory, and per worker its start-up time and RSS/PSS/private MB
+- metrics: a worker starts from an empty registry (the master's warm-up is not its
+  traffic), writes its last snapshot on exit, the master folds it into
+  cache/metrics/retired.json (assistant/metrics.py)
+"""
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "kiosk_site.settings")
+os.environ.setdefault("ASSISTANT_WARMUP", "1")
+
+wsgi_app = os.getenv("GUNICORN_APP", "kiosk_site.wsgi:application")
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+preload_app = True
+
+_started = time.perf_counter()
+
+
+def when_ready(server):
+    from assistant import views, warmup
+    frozen = warmup.freeze()
+    views._LIVE_INDEX.release()  # the master serves nothing: only workers hold index leases
+    server.log.info("Master ready in %.0f ms (warm-up %s, %d objects gc-frozen), memory %s",
+                    (time.perf_counter() - _started) * 1000, warmup.REPORT, frozen, warmup.memory_mb())
+
+
+def post_fork(server, worker):
+    from assistant import metrics, views
+    worker.forked_at = time.perf_counter()
+    views._LIVE_INDEX.after_fork()
+    metrics.REGISTRY.reset()  # the master's warm-up observations are not counted once per worker
+
+
+def post_worker_init(worker):
+    from assistant import warmup
+    worker.log.info("Worker %s ready %.0f ms after fork, memory %s", worker.pid,
+                    (time.perf_counter() - worker.forked_at) * 1000, warmup.memory_mb())
+
+
+def worker_exit(server, worker):
+    from assistant import metrics
+    metrics.flush(force=True)
+
+
+def child_exit(server, worker):
+    from assistant import metrics
+    metrics.retire(worker.pid)
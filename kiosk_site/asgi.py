@@ -0,0 +1,5 @@
+﻿import os
+from django.core.asgi import get_asgi_application
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kiosk_site.settings')
+os.environ.setdefault('ASSISTANT_ASGI', '1')  # assistant/upstream.py: per-loop async clients
+application = get_asgi_application()
@@ -31,6 +31,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    "assistant.metrics.metrics_middleware",  # Server-Timing + metrics/ (statikus fájlok nélkül)
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -58,6 +59,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "kiosk_site.wsgi.application"
+ASGI_APPLICATION = "kiosk_site.asgi.application"  # gunicorn -k uvicorn.workers.UvicornWorker kiosk_site.asgi
 
 # --- DB ---
 DATABASES = {
@@ -67,6 +69,28 @@ DATABASES = {
     }
 }
 
+# --- Cache ---
+# "assistant": a válasz-cache megosztott szintje minden gunicorn worker között
+# ASSISTANT_SHARED_CACHE = file | db | off  (db esetén: python manage.py createcachetable)
+ASSISTANT_SHARED_CACHE = os.getenv("ASSISTANT_SHARED_CACHE", "file").strip().lower()
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+}
+if ASSISTANT_SHARED_CACHE == "file":
+    CACHES["assistant"] = {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / "cache" / "assistant",
+        "TIMEOUT": 3600,
+        "OPTIONS": {"MAX_ENTRIES": 5000},
+    }
+elif ASSISTANT_SHARED_CACHE == "db":
+    CACHES["assistant"] = {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "assistant_cache",
+        "TIMEOUT": 3600,
+        "OPTIONS": {"MAX_ENTRIES": 5000},
+    }
+
 # --- i18n ---
 LANGUAGE_CODE = "ro-ro"
 TIME_ZONE = "Europe/Bucharest"
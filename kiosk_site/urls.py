@@ -4,7 +4,7 @@ from django.urls import path
 from django.conf import settings
 from django.conf.urls.static import static
 
-from assistant import views
+from assistant import views, async_views
 from assistant.views import index, ask, ping
 from assistant.views import ping, debug_knowledge
 from assistant.views import debug_preview
@@ -13,9 +13,16 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("", views.index, name="index"),
     path("ask/", views.ask, name="ask"),
+    path("ask/stream/", views.ask_stream, name="ask_stream"),
+    path("ask/batch/", views.ask_batch, name="ask_batch"),
     path("ping/", ping, name="ping"),
+    # async változatok (ASGI: kiosk_site/asgi.py)
+    path("ask/async/", async_views.ask_async, name="ask_async"),
+    path("ping/async/", async_views.ping_async, name="ping_async"),
     path("debug/knowledge/", debug_knowledge),
     path("debug/preview/", debug_preview),
+    path("debug/cache/", views.debug_cache),
+    path("metrics/", views.metrics_view, name="metrics"),
 ]
 
 # Servește STATIC și MEDIA doar în development